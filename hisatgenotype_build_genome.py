@@ -22,6 +22,7 @@
 
 import os, sys, subprocess, re
 import inspect
+import hashlib
 from argparse import ArgumentParser, FileType
 import hisatgenotype_typing_common as typing_common, hisatgenotype_gene_typing as gene_typing
 
@@ -36,6 +37,176 @@ def read_clnsig(fname):
     return clnsig_dic
 
 
+"""
+Read backbone sequences, variants, haplotypes, and links of a database (e.g. hla) once,
+  all indexed by gene name (e.g. A*01:01:01:01)
+"""
+def read_family_database(family):
+    allele_seqs = typing_common.read_allele_sequences("%s_backbone.fa" % family)
+    allele_vars = typing_common.read_variants("%s.snp" % family)
+    allele_index_vars = typing_common.read_variants("%s.index.snp" % family)
+    allele_haplotypes = typing_common.read_haplotypes("%s.haplotype" % family)
+
+    varID2gene = {}
+    for name, vars in allele_vars.items():
+        for _, _, _, var_id in vars:
+            varID2gene[var_id] = name
+    allele_links = {}
+    for var_id, allele_names in typing_common.read_links("%s.link" % family):
+        if var_id not in varID2gene:
+            continue
+        name = varID2gene[var_id]
+        if name not in allele_links:
+            allele_links[name] = []
+        allele_links[name].append([var_id, allele_names])
+
+    return allele_seqs, allele_vars, allele_index_vars, allele_haplotypes, allele_links
+
+
+"""
+Write chromosome sequences into a FASTA file piece by piece in lines of 60 bases,
+  without building each chromosome in memory, and write its FASTA index (.fai) along the way
+"""
+class FastaWriter:
+    def __init__(self, fname, line_width = 60):
+        self.out_file = open(fname, 'w')
+        self.fai_file = open(fname + ".fai", 'w')
+        self.line_width = line_width
+        self.chr_name = ""
+        self.offset = 0
+        self.length = 0
+
+    def begin_chr(self, chr_full_name):
+        self.out_file.write(">%s\n" % chr_full_name)
+        self.chr_name = chr_full_name.split()[0]
+        self.offset = self.out_file.tell()
+        self.length = 0
+
+    # Write seq[left:right] with no copy of the whole segment
+    def write(self, seq, left = 0, right = -1):
+        if right < 0:
+            right = len(seq)
+        line_width = self.line_width
+        while left < right:
+            # Fill up the current line
+            line_left = line_width - self.length % line_width
+            if line_left < line_width or right - left < line_width:
+                line_end = min(right, left + line_left)
+                self.out_file.write(seq[left:line_end])
+                self.length += (line_end - left)
+                if self.length % line_width == 0:
+                    self.out_file.write("\n")
+                left = line_end
+                continue
+
+            # Write full lines in blocks
+            num_lines = min((right - left) / line_width, 10000)
+            block_end = left + num_lines * line_width
+            self.out_file.write('\n'.join([seq[i:i+line_width] for i in xrange(left, block_end, line_width)]))
+            self.out_file.write("\n")
+            self.length += (block_end - left)
+            left = block_end
+
+    # Copy a chromosome sequence as it is from another FASTA file written in the same line width
+    def copy_chr(self, fasta_file, fai, chr, chr_full_name):
+        length, offset, line_bases, line_width = fai[chr]
+        assert line_bases == self.line_width and line_width == self.line_width + 1
+        self.begin_chr(chr_full_name)
+        size = length / line_bases * line_width + length % line_bases
+        fasta_file.seek(offset)
+        while size > 0:
+            buf = fasta_file.read(min(size, 1 << 20))
+            assert len(buf) > 0
+            self.out_file.write(buf)
+            size -= len(buf)
+        self.length = length
+
+    def end_chr(self):
+        if self.length % self.line_width != 0:
+            self.out_file.write("\n")
+        print >> self.fai_file, "%s\t%d\t%d\t%d\t%d" % \
+            (self.chr_name, self.length, self.offset, self.line_width, self.line_width + 1)
+
+    def close(self):
+        self.out_file.close()
+        self.fai_file.close()
+
+
+"""
+Manifest of the digests of the inputs used to build a genotype genome
+  e.g. database   hla  76a8e5...  (source files of the database)
+       chromosome 6    0c1f9b...  (genome.fa index entry and sequence, and backbone sequences inserted)
+       index      45d2aa...       (inputs to hisat2-build)
+"""
+def read_manifest(fname):
+    manifest = {"database" : {}, "chromosome" : {}, "index" : ""}
+    if not os.path.exists(fname):
+        return manifest
+    for line in open(fname):
+        fields = line.strip().split('\t')
+        if fields[0] == "index":
+            manifest["index"] = fields[1]
+        else:
+            manifest[fields[0]][fields[1]] = fields[2]
+    return manifest
+
+
+"""
+"""
+def write_manifest(fname, manifest):
+    manifest_file = open(fname, 'w')
+    for key in ["database", "chromosome"]:
+        for name, digest in sorted(manifest[key].items()):
+            print >> manifest_file, "%s\t%s\t%s" % (key, name, digest)
+    if manifest["index"] != "":
+        print >> manifest_file, "index\t%s" % manifest["index"]
+    manifest_file.close()
+
+
+"""
+Digest of some strings followed by files (directories are visited recursively)
+"""
+def get_digest(strs, fnames = []):
+    md5 = hashlib.md5()
+    for s in strs:
+        md5.update(s + '\n')
+
+    paths = []
+    for fname in fnames:
+        if os.path.isdir(fname):
+            for dname, sub_dnames, sub_fnames in os.walk(fname):
+                sub_dnames[:] = sorted([sub_dname for sub_dname in sub_dnames if sub_dname != ".git"])
+                paths += [os.path.join(dname, sub_fname) for sub_fname in sorted(sub_fnames)]
+        elif os.path.exists(fname):
+            paths.append(fname)
+    for path in paths:
+        md5.update(path + '\n')
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(1 << 20)
+                if not buf:
+                    break
+                md5.update(buf)
+    return md5.hexdigest()
+
+
+"""
+Digest of the bytes of a chromosome sequence in an indexed FASTA file
+"""
+def get_fasta_seq_digest(fasta_file, fai, chr):
+    length, offset, line_bases, line_width = fai[chr]
+    size = length / line_bases * line_width + length % line_bases
+    md5 = hashlib.md5()
+    fasta_file.seek(offset)
+    while size > 0:
+        buf = fasta_file.read(min(size, 1 << 20))
+        if not buf:
+            break
+        md5.update(buf)
+        size -= len(buf)
+    return md5.hexdigest()
+
+
 """
 """
 def build_genotype_genome(base_fname,                          
@@ -53,8 +224,9 @@ def build_genotype_genome(base_fname,
     if not typing_common.check_files(HISAT2_fnames):
         typing_common.download_genome_and_index()
 
-    # Load genomic sequences
-    chr_dic, chr_names, chr_full_names = typing_common.read_genome(open("genome.fa"))
+    # Chromosome sequences are loaded one at a time when writing the genotype genome
+    genome_fai = typing_common.read_fasta_index("genome.fa.fai")
+    chr_names = sorted(genome_fai.keys(), key=lambda chr: genome_fai[chr][1])
 
     genotype_vars, genotype_haplotypes, genotype_clnsig = {}, {}, {}
     if use_clinvar:
@@ -122,43 +294,60 @@ def build_genotype_genome(base_fname,
     # Genes to be genotyped
     genotype_genes = {}
 
+    # Digests of the inputs from the previous build
+    manifest_fname = "%s.manifest" % base_fname
+    prev_manifest = read_manifest(manifest_fname)
+    manifest = {"database" : {}, "chromosome" : {}, "index" : ""}
+
+    # Extract again only the databases whose source files have changed since the previous build
+    #   Databases without their source files are not checked, and hisatgenotype_extract_vars.py
+    #   clones hisatgenotype_db only when a database has to be extracted
+    for database_name in database_list:
+        source_dname = "hisatgenotype_db/%s" % database_name.upper()
+        if not os.path.exists(source_dname):
+            if database_name in prev_manifest["database"]:
+                manifest["database"][database_name] = prev_manifest["database"][database_name]
+            continue
+        extract_cmd = typing_common.get_extract_database_cmd(database_name, [], inter_gap, intra_gap, True)
+        digest = get_digest([' '.join(extract_cmd)],
+                            [source_dname])
+        manifest["database"][database_name] = digest
+        if database_name in prev_manifest["database"] and \
+           prev_manifest["database"][database_name] != digest:
+            print >> sys.stderr, "\t%s has changed since the previous build, and will be extracted again" % database_name
+            for fname in typing_common.get_database_fnames(database_name):
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+    # Extract HLA variants, backbone sequence, and other sequeces of all the databases concurrently
+    typing_common.extract_databases_if_not_exist(database_list,
+                                                 inter_gap,
+                                                 intra_gap,
+                                                 True,          # partial?
+                                                 threads,
+                                                 verbose)
+
     # Read genes or genomics regions
     for database_name in database_list:
-        # Extract HLA variants, backbone sequence, and other sequeces
-        typing_common.extract_database_if_not_exists(database_name,
-                                                     [],            # locus_list
-                                                     inter_gap,
-                                                     intra_gap,
-                                                     True,          # partial?
-                                                     verbose)
         locus_fname = "%s.locus" % database_name
         assert os.path.exists(locus_fname)
         for line in open(locus_fname):
             HLA_name, chr, left, right, length, exon_str, strand = line.strip().split()
             left, right = int(left), int(right)
             length = int(length)
-            if chr not in chr_names:
+            if chr not in genome_fai:
                 continue
             if chr not in genotype_genes:
                 genotype_genes[chr] = []
             genotype_genes[chr].append([left, right, length, HLA_name, database_name, exon_str, strand])
 
-    # Write genotype genome
-    var_num, haplotype_num = 0, 0
-    genome_out_file = open("%s.fa" % base_fname, 'w')
-    locus_out_file = open("%s.locus" % base_fname, 'w')
-    var_out_file = open("%s.snp" % base_fname, 'w')
-    index_var_out_file = open("%s.index.snp" % base_fname, 'w')
-    haplotype_out_file = open("%s.haplotype" % base_fname, 'w')
-    link_out_file = open("%s.link" % base_fname, 'w')
-    coord_out_file = open("%s.coord" % base_fname, 'w')
-    clnsig_out_file = open("%s.clnsig" % base_fname, 'w')
-    for c in range(len(chr_names)):
-        chr = chr_names[c]
-        chr_full_name = chr_full_names[c]
-        assert chr in chr_dic
-        chr_seq = chr_dic[chr]
-        chr_len = len(chr_seq)
+    # Decide which genes are inserted into each chromosome, and
+    #   which chromosome sequences are different from the previous build
+    family_dbs, chr_genes_dic, chr_inserted_dic = {}, {}, {}
+    rewrite_chrs = []
+    genome_file = open("genome.fa")
+    for chr in chr_names:
+        chr_len = genome_fai[chr][0]
         if chr in genotype_genes:
             chr_genes = genotype_genes[chr]
             def gene_cmp(a, b):
@@ -173,6 +362,107 @@ def build_genotype_genome(base_fname,
         else:
             chr_genes = []
 
+        chr_inserted = []
+        digest_strs = ["%s\t%s" % (chr, '\t'.join([str(num) for num in genome_fai[chr]])),
+                       get_fasta_seq_digest(genome_file, genome_fai, chr)]
+        prev_right = 0
+        for gene in chr_genes:
+            left, right, length, name, family, exon_str, strand = gene
+            chr_inserted.append(False)
+
+            # Read HLA backbone sequences, variants, haplotypes, and links once per database
+            if family not in family_dbs:
+                family_dbs[family] = read_family_database(family)
+            allele_seqs, allele_vars, allele_index_vars, allele_haplotypes, allele_links = family_dbs[family]
+
+            if name not in allele_seqs or \
+                    name not in allele_vars or \
+                    name not in allele_haplotypes:
+                continue
+            assert length == len(allele_seqs[name])
+            assert left < chr_len and right < chr_len
+            # Skipping overlapping genes
+            if left < prev_right:
+                print >> sys.stderr, "Warning: skipping %s ..." % (name)
+                continue
+            assert left < right
+            assert right - left + 1 <= length
+
+            chr_inserted[-1] = True
+            digest_strs.append("%s\t%d\t%d\t%s" % (name, left, right, allele_seqs[name]))
+            prev_right = right + 1
+
+        chr_genes_dic[chr], chr_inserted_dic[chr] = chr_genes, chr_inserted
+        manifest["chromosome"][chr] = get_digest(digest_strs)
+        if chr not in prev_manifest["chromosome"] or \
+           prev_manifest["chromosome"][chr] != manifest["chromosome"][chr]:
+            rewrite_chrs.append(chr)
+    genome_file.close()
+
+    # Write genotype genome (genotype_genome.fa and genotype_genome.fa.fai)
+    #   Unchanged chromosomes are copied from the previous genotype_genome.fa as they are
+    genome_fname = "%s.fa" % base_fname
+    prev_genome_fai = {}
+    if os.path.exists(genome_fname) and os.path.exists(genome_fname + ".fai"):
+        prev_genome_fai = typing_common.read_fasta_index(genome_fname + ".fai")
+    for chr in chr_names:
+        if chr in rewrite_chrs:
+            continue
+        if chr not in prev_genome_fai or prev_genome_fai[chr][2:] != [60, 61]:
+            rewrite_chrs.append(chr)
+    if len(rewrite_chrs) > 0 or set(prev_genome_fai.keys()) != set(chr_names):
+        print >> sys.stderr, "\tWriting %s (%d out of %d chromosomes changed)" % \
+            (genome_fname, len(rewrite_chrs), len(chr_names))
+        if verbose and len(rewrite_chrs) > 0:
+            print >> sys.stderr, "\t\tchanged chromosomes:", ','.join(rewrite_chrs)
+        rewrite_chrs = set(rewrite_chrs)
+        genome_file = open("genome.fa")
+        prev_genome_file = open(genome_fname) if len(prev_genome_fai) > 0 else None
+        genome_writer = FastaWriter("%s.tmp.fa" % base_fname)
+        for chr in chr_names:
+            chr_full_name = typing_common.get_fasta_header(genome_file, genome_fai, chr)
+            if chr not in rewrite_chrs:
+                genome_writer.copy_chr(prev_genome_file, prev_genome_fai, chr, chr_full_name)
+                genome_writer.end_chr()
+                continue
+
+            chr_len = genome_fai[chr][0]
+            chr_seq = typing_common.get_fasta_seq(genome_file, genome_fai, chr, 0, chr_len - 1)
+            genome_writer.begin_chr(chr_full_name)
+            prev_right = 0
+            for gene_i in range(len(chr_genes_dic[chr])):
+                if not chr_inserted_dic[chr][gene_i]:
+                    continue
+                left, right, length, name, family = chr_genes_dic[chr][gene_i][:5]
+                if prev_right < left:
+                    genome_writer.write(chr_seq, prev_right, left)
+                genome_writer.write(family_dbs[family][0][name])
+                prev_right = right + 1
+            genome_writer.write(chr_seq, prev_right)
+            genome_writer.end_chr()
+            chr_seq = ""
+        genome_writer.close()
+        genome_file.close()
+        if prev_genome_file:
+            prev_genome_file.close()
+        os.rename("%s.tmp.fa" % base_fname, genome_fname)
+        os.rename("%s.tmp.fa.fai" % base_fname, genome_fname + ".fai")
+    else:
+        print >> sys.stderr, "\t%s is unchanged" % genome_fname
+
+    # Write variants, haplotypes, and so on
+    var_num, haplotype_num = 0, 0
+    locus_out_file = open("%s.locus" % base_fname, 'w')
+    var_out_file = open("%s.snp" % base_fname, 'w')
+    index_var_out_file = open("%s.index.snp" % base_fname, 'w')
+    haplotype_out_file = open("%s.haplotype" % base_fname, 'w')
+    link_out_file = open("%s.link" % base_fname, 'w')
+    coord_out_file = open("%s.coord" % base_fname, 'w')
+    clnsig_out_file = open("%s.clnsig" % base_fname, 'w')
+    for chr in chr_names:
+        chr_len = genome_fai[chr][0]
+        chr_genes, chr_inserted = chr_genes_dic[chr], chr_inserted_dic[chr]
+
         chr_genotype_vars, chr_genotype_vari = [], 0
         if chr in genotype_vars:
             chr_genotype_vars = genotype_vars[chr]
@@ -220,63 +510,36 @@ def build_genotype_genome(base_fname,
 
             return chr_genotype_vari, chr_genotype_hti, haplotype_num
 
-        out_chr_seq = ""
-        
         off = 0
         prev_right = 0
-        for gene in chr_genes:
-            left, right, length, name, family, exon_str, strand = gene
+        for gene_i in range(len(chr_genes)):
+            left, right, length, name, family, exon_str, strand = chr_genes[gene_i]
 
             chr_genotype_vari, chr_genotype_hti, haplotype_num = add_vars(left, right, chr_genotype_vari, chr_genotype_hti, haplotype_num)
 
-            # Read HLA backbone sequences
-            allele_seqs = typing_common.read_allele_sequences("%s_backbone.fa" % family)
-
-            # Read HLA variants
-            allele_vars = typing_common.read_variants("%s.snp" % family)
-            allele_index_vars = typing_common.read_variants("%s.index.snp" % family)
-                
-            # Read HLA haplotypes
-            allele_haplotypes = typing_common.read_haplotypes("%s.haplotype" % family)
-
-            # Read HLA link information between haplotypes and variants
-            links = typing_common.read_links("%s.link" % family)
-
-            if name not in allele_seqs or \
-                    name not in allele_vars or \
-                    name not in allele_haplotypes:
+            if not chr_inserted[gene_i]:
                 continue
+            allele_seqs, allele_vars, allele_index_vars, allele_haplotypes, allele_links = family_dbs[family]
             allele_seq = allele_seqs[name]
             vars, index_vars = allele_vars[name], allele_index_vars[name]
+            links = allele_links[name] if name in allele_links else []
             index_var_ids = set()
             for _, _, _, var_id in index_vars:
                 index_var_ids.add(var_id)
 
             haplotypes = allele_haplotypes[name]
-            assert length == len(allele_seq)
-            assert left < chr_len and right < chr_len
-            # Skipping overlapping genes
-            if left < prev_right:
-                print >> sys.stderr, "Warning: skipping %s ..." % (name)
-                continue
-
             varID2htID = {}
-
-            assert left < right
             prev_length = right - left + 1
-            assert prev_length <= length
-
-            if prev_right < left:
-                out_chr_seq += chr_seq[prev_right:left]
 
             # Output gene (genotype_genome.gene)
+            gene_left = left + off
             print >> locus_out_file, "%s\t%s\t%s\t%d\t%d\t%s\t%s" % \
-                (family.upper(), name, chr, len(out_chr_seq), len(out_chr_seq) + length - 1, exon_str, strand)
+                (family.upper(), name, chr, gene_left, gene_left + length - 1, exon_str, strand)
 
             # Output coord (genotype_genome.coord)
             print >> coord_out_file, "%s\t%d\t%d\t%d" % \
-                (chr, len(out_chr_seq), left, right - left + 1)
-            out_chr_seq += allele_seq
+                (chr, gene_left, left, right - left + 1)
+            out_chr_len = gene_left + length
 
             # Output variants (genotype_genome.snp and genotype_genome.index.snp)
             for var in vars:
@@ -285,11 +548,11 @@ def build_genotype_genome(base_fname,
                 varID2htID[var_id] = new_var_id
                 new_var_left = var_left + left + off
                 assert var_type in ["single", "deletion", "insertion"]
-                assert new_var_left < len(out_chr_seq)
+                assert new_var_left < out_chr_len
                 if var_type == "single":                    
-                    assert out_chr_seq[new_var_left] != var_data
+                    assert allele_seq[var_left] != var_data
                 elif var_type == "deletion":
-                    assert new_var_left + var_data <= len(out_chr_seq)
+                    assert new_var_left + var_data <= out_chr_len
                 else:
                     assert var_type == "insertion"
 
@@ -303,10 +566,10 @@ def build_genotype_genome(base_fname,
             for haplotype in haplotypes:
                 ht_left, ht_right, ht_vars = haplotype
                 new_ht_left = ht_left + left + off
-                assert new_ht_left < len(out_chr_seq)
+                assert new_ht_left < out_chr_len
                 new_ht_right = ht_right + left + off
                 assert new_ht_left <= new_ht_right
-                assert new_ht_right <= len(out_chr_seq)
+                assert new_ht_right <= out_chr_len
                 new_ht_vars = []
                 for var_id in ht_vars:
                     assert var_id in varID2htID
@@ -331,18 +594,8 @@ def build_genotype_genome(base_fname,
         chr_genotype_vari, chr_genotype_hti, haplotype_num = add_vars(sys.maxint, sys.maxint, chr_genotype_vari, chr_genotype_hti, haplotype_num)            
             
         print >> coord_out_file, "%s\t%d\t%d\t%d" % \
-            (chr, len(out_chr_seq), prev_right, len(chr_seq) - prev_right)
-        out_chr_seq += chr_seq[prev_right:]
-
-        assert len(out_chr_seq) == len(chr_seq) + off
-
-        # Output chromosome sequence
-        print >> genome_out_file, ">%s" % (chr_full_name)
-        line_width = 60
-        for s in range(0, len(out_chr_seq), line_width):
-            print >> genome_out_file, out_chr_seq[s:s+line_width]
+            (chr, prev_right + off, prev_right, chr_len - prev_right)
 
-    genome_out_file.close()
     locus_out_file.close()
     var_out_file.close()
     index_var_out_file.close()
@@ -358,12 +611,26 @@ def build_genotype_genome(base_fname,
             print >> partial_out_file, "%s\t%s" % (database.upper(), allele_name)
     partial_out_file.close()
 
-    # Index genotype_genome.fa
-    index_cmd = ["samtools", "faidx", "%s.fa" % base_fname]
-    subprocess.call(index_cmd)
+    # Compile the above files into a binary database (genotype_genome.db) for faster loading
+    typing_common.compile_database(base_fname)
+
+    # The manifest is first written without the index digest so that a failed index build is retried
+    write_manifest(manifest_fname, manifest)
 
     # Build HISAT-genotype graph indexes based on the above information
+    #   only if the genome sequence, variants, or haplotypes have changed
     hisat2_index_fnames = ["%s.%d.ht2" % (base_fname, i+1) for i in range(8)]
+    index_digest = get_digest([manifest["chromosome"][chr] for chr in chr_names],
+                              ["%s.index.snp" % base_fname,
+                               "%s.haplotype" % base_fname])
+    if prev_manifest["index"] == index_digest and \
+       typing_common.check_files(hisat2_index_fnames):
+        print >> sys.stderr, "\tHISAT2 graph index is up to date, so hisat2-build does not need to run"
+        manifest["index"] = index_digest
+        write_manifest(manifest_fname, manifest)
+        return
+
+    print >> sys.stderr, "\tGenome sequence, variants, or haplotypes have changed, so hisat2-build must run"
     build_cmd = ["hisat2-build",
                  "-p", str(threads),
                  "--snp", "%s.index.snp" % base_fname,
@@ -378,6 +645,9 @@ def build_genotype_genome(base_fname,
         print >> sys.stderr, "Error: indexing failed!  Perhaps, you may have forgotten to build hisat2 executables?"
         sys.exit(1)
 
+    manifest["index"] = index_digest
+    write_manifest(manifest_fname, manifest)
+
         
 """
 """
@@ -24,6 +24,9 @@ import sys, os, subprocess, re
 import inspect
 import random
 import glob
+import string
+import multiprocessing
+from itertools import islice, izip
 from argparse import ArgumentParser, FileType
 import hisatgenotype_typing_common as typing_common
 
@@ -74,6 +77,180 @@ def wait_pids(pids):
             os.waitpid(pid, 0)
             
 
+"""
+Build a set of k-mers (on both strands) from the loci of the genotype genome
+  with their flanking sequences, including k-mers spanning known variants
+"""
+def build_prefilter_kmers(base_fname,
+                          region_loci,
+                          kmer_len,
+                          flank_len,
+                          verbose):
+    fai = typing_common.read_fasta_index("%s.fa.fai" % base_fname)
+    genome_file = open("%s.fa" % base_fname)
+    allele_vars = typing_common.read_variants("%s.snp" % base_fname)
+    comp_table = string.maketrans("ACGTacgt", "TGCAtgca")
+
+    kmers = set()
+    def add_kmers(seq):
+        seq = seq.upper()
+        rc_seq = seq.translate(comp_table)[::-1]
+        for i in range(len(seq) - kmer_len + 1):
+            kmers.add(seq[i:i+kmer_len])
+            kmers.add(rc_seq[i:i+kmer_len])
+
+    for chr, loci in region_loci.items():
+        if chr not in fai:
+            continue
+        chr_vars = allele_vars[chr] if chr in allele_vars else []
+        for _, _, locus_left, locus_right in loci.values():
+            left, right = max(0, locus_left - flank_len), locus_right + flank_len
+            seq = typing_common.get_fasta_seq(genome_file, fai, chr, left, right).upper()
+            add_kmers(seq)
+
+            # Add k-mers spanning alternative bases, deletions, and insertions
+            var_i = typing_common.lower_bound(chr_vars, left)
+            while var_i < len(chr_vars):
+                var_left, var_type, var_data, _ = chr_vars[var_i]
+                if var_left > right:
+                    break
+                var_i += 1
+                var_off = var_left - left
+                prefix = seq[max(0, var_off - kmer_len + 1):var_off]
+                if var_type == "single":
+                    suffix = seq[var_off+1:var_off+kmer_len]
+                elif var_type == "deletion":
+                    suffix = seq[var_off+var_data:var_off+var_data+kmer_len-1]
+                    var_data = ""
+                else:
+                    assert var_type == "insertion"
+                    suffix = seq[var_off:var_off+kmer_len-1]
+                add_kmers(prefix + var_data + suffix)
+    genome_file.close()
+
+    if verbose:
+        print >> sys.stderr, "\tNumber of prefilter %d-mers: %d" % (kmer_len, len(kmers))
+    return kmers
+
+
+"""
+Prefilter worker state, set once per worker process
+"""
+prefilter_kmers, prefilter_kmer_len, prefilter_kmer_step = set(), 0, 1
+
+def init_prefilter_worker(kmers, kmer_len, kmer_step):
+    global prefilter_kmers, prefilter_kmer_len, prefilter_kmer_step
+    prefilter_kmers, prefilter_kmer_len, prefilter_kmer_step = kmers, kmer_len, kmer_step
+
+
+"""
+Keep reads (or read pairs) with at least one mate sharing a k-mer with the loci
+"""
+def prefilter_chunk(chunk):
+    kmers, kmer_len, kmer_step = prefilter_kmers, prefilter_kmer_len, prefilter_kmer_step
+    candidates = []
+    for records in chunk:
+        for record in records:
+            seq = record[1].rstrip()
+            last_i = len(seq) - kmer_len
+            found = False
+            for i in range(0, last_i + 1, kmer_step):
+                if seq[i:i+kmer_len] in kmers:
+                    found = True
+                    break
+            # Always look at the last k-mer so that the 3' end of a read is covered
+            if not found and last_i >= 0 and seq[last_i:] in kmers:
+                found = True
+            if found:
+                candidates.append(records)
+                break
+    return candidates
+
+
+"""
+Stream reads from a (gzipped) FASTQ or FASTA file as lists of lines
+  FASTA records start with '>' and may have multiple sequence lines, which are joined into one line.
+  FASTQ records are four lines starting with '@' and '+'.
+"""
+def read_records(fname, fastq):
+    if fname.endswith(".gz"):
+        read_proc = subprocess.Popen(["gzip", "-cd", fname],
+                                     stdout=subprocess.PIPE,
+                                     stderr=open("/dev/null", 'w'))
+        read_file = read_proc.stdout
+    else:
+        read_file = open(fname)
+    if fastq:
+        while True:
+            record = list(islice(read_file, 4))
+            if len(record) == 0:
+                break
+            if len(record) < 4 or not record[0].startswith('@') or not record[2].startswith('+'):
+                print >> sys.stderr, "Error: %s is not in a FASTQ format with four lines per read" % fname
+                sys.exit(1)
+            yield record
+    else:
+        header, seq = "", []
+        for line in read_file:
+            if line.startswith('>'):
+                if header != "":
+                    yield [header, ''.join(seq) + '\n']
+                header, seq = line, []
+            elif header != "":
+                seq.append(line.strip())
+        if header != "":
+            yield [header, ''.join(seq) + '\n']
+    read_file.close()
+
+
+"""
+Stream reads (or read pairs) through a pool of prefilter workers,
+  and write candidate reads for alignment
+"""
+def prefilter_reads(fq_fname,
+                    fq_fname2,
+                    out_fname,
+                    out_fname2,
+                    kmers,
+                    kmer_len,
+                    fastq,
+                    threads,
+                    verbose):
+    if fq_fname2 != "":
+        reads = izip(read_records(fq_fname, fastq), read_records(fq_fname2, fastq))
+    else:
+        reads = ((record,) for record in read_records(fq_fname, fastq))
+
+    chunk_size = 20000
+    def chunks():
+        while True:
+            chunk = list(islice(reads, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+    out_files = [open(out_fname, 'w')]
+    if out_fname2 != "":
+        out_files.append(open(out_fname2, 'w'))
+    kmer_step = max(1, kmer_len / 4)
+    pool = multiprocessing.Pool(max(1, threads),
+                                init_prefilter_worker,
+                                (kmers, kmer_len, kmer_step))
+    num_candidates = 0
+    for candidates in pool.imap(prefilter_chunk, chunks()):
+        for records in candidates:
+            for i in range(len(records)):
+                out_files[i].write(''.join(records[i]))
+        num_candidates += len(candidates)
+    pool.close()
+    pool.join()
+    for out_file in out_files:
+        out_file.close()
+
+    if verbose:
+        print >> sys.stderr, "\t\t%d candidate reads (or pairs) after prefiltering" % num_candidates
+
+
 """
 """
 def extract_reads(base_fname,
@@ -88,6 +265,9 @@ def extract_reads(base_fname,
                   threads,
                   max_sample,
                   job_range,
+                  prefilter,
+                  prefilter_kmer_len,
+                  prefilter_flank_len,
                   verbose):
     genotype_fnames = ["%s.fa" % base_fname,
                        "%s.locus" % base_fname,
@@ -98,6 +278,8 @@ def extract_reads(base_fname,
                        "%s.clnsig" % base_fname]
     # hisat2 graph index files
     genotype_fnames += ["%s.%d.ht2" % (base_fname, i+1) for i in range(8)]
+    if prefilter:
+        genotype_fnames += ["%s.fa.fai" % base_fname]
     if not typing_common.check_files(genotype_fnames):        
         print >> sys.stderr, "Error: %s related files do not exist as follows:" % base_fname
         for fname in genotype_fnames:
@@ -129,6 +311,15 @@ def extract_reads(base_fname,
     if out_dir != "" and not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
+    # Build k-mers from the loci once, shared by all the read files
+    prefilter_kmers = set()
+    if prefilter:
+        prefilter_kmers = build_prefilter_kmers(base_fname,
+                                                region_loci,
+                                                prefilter_kmer_len,
+                                                prefilter_flank_len,
+                                                verbose)
+
     # Extract reads
     if len(read_fname) > 0:
         if paired:
@@ -186,6 +377,32 @@ def extract_reads(base_fname,
                  ranges,
                  simulation,
                  verbose):
+            out_dir_slash = out_dir
+            if out_dir != "":
+                out_dir_slash += "/"
+
+            # Only reads sharing k-mers with the loci are passed to hisat2
+            prefilter_fnames = []
+            if prefilter:
+                read_suffix = "fq" if fastq else "fa"
+                if paired:
+                    prefilter_fnames = ["%s%s.prefiltered.1.%s" % (out_dir_slash, fq_fname_base, read_suffix),
+                                        "%s%s.prefiltered.2.%s" % (out_dir_slash, fq_fname_base, read_suffix)]
+                else:
+                    prefilter_fnames = ["%s%s.prefiltered.%s" % (out_dir_slash, fq_fname_base, read_suffix)]
+                prefilter_reads(fq_fname,
+                                fq_fname2,
+                                prefilter_fnames[0],
+                                prefilter_fnames[1] if paired else "",
+                                prefilter_kmers,
+                                prefilter_kmer_len,
+                                fastq,
+                                threads,
+                                verbose)
+                fq_fname = prefilter_fnames[0]
+                if paired:
+                    fq_fname2 = prefilter_fnames[1]
+
             aligner_cmd = ["hisat2"]
             if not fastq:
                 aligner_cmd += ["-f"]
@@ -204,9 +421,6 @@ def extract_reads(base_fname,
                                           stderr=open("/dev/null", 'w'))
 
             gzip_dic = {}
-            out_dir_slash = out_dir
-            if out_dir != "":
-                out_dir_slash += "/"
             for database in database_list:
                 if paired:
                     # LP6005041-DNA_A01.extracted.1.fq.gz
@@ -294,7 +508,11 @@ def extract_reads(base_fname,
                 if paired:
                     gzip2_proc.stdin.close()                        
 
-        if threads <= 1:
+            for fname in prefilter_fnames:
+                os.remove(fname)
+
+        # With --prefilter, threads are used by the prefilter workers within each read file
+        if threads <= 1 or prefilter:
             work(fq_fname_base, 
                  fq_fname, 
                  fq_fname2,
@@ -311,7 +529,7 @@ def extract_reads(base_fname,
                           simulation,
                           verbose)
 
-    if threads > 1:
+    if threads > 1 and not prefilter:
         wait_pids(pids)
 
 
@@ -383,6 +601,20 @@ if __name__ == '__main__':
                         type=str,
                         default="0,1",
                         help="two numbers (e.g. 1,3)")
+    parser.add_argument('--prefilter',
+                        dest='prefilter',
+                        action='store_true',
+                        help='Align only reads sharing k-mers with the loci (Default: False)')
+    parser.add_argument("--prefilter-kmer-len",
+                        dest="prefilter_kmer_len",
+                        type=int,
+                        default=31,
+                        help="k-mer length for --prefilter (default: 31)")
+    parser.add_argument("--prefilter-flank-len",
+                        dest="prefilter_flank_len",
+                        type=int,
+                        default=500,
+                        help="Length of flanking sequences around the loci for --prefilter (default: 500)")
     parser.add_argument('-v', '--verbose',
                         dest='verbose',
                         action='store_true',
@@ -426,5 +658,8 @@ if __name__ == '__main__':
                   args.threads,
                   args.max_sample,
                   job_range,
+                  args.prefilter,
+                  args.prefilter_kmer_len,
+                  args.prefilter_flank_len,
                   args.verbose)
 
@@ -21,8 +21,12 @@
 
 
 import os, sys, subprocess, re
+import hashlib, marshal, mmap
+import multiprocessing
 import inspect
 import glob
+from itertools import compress, imap
+from operator import ne
 from argparse import ArgumentParser, FileType
 import hisatgenotype_typing_common as typing_common, hisatgenotype_gene_typing as gene_typing
 
@@ -44,70 +48,286 @@ def create_map(seq):
 
 
 """
+Compare variants
+"""
+def cmp_varKey(a, b):
+    a_locus, a_type, a_data = a.split('-')
+    b_locus, b_type, b_data = b.split('-')
+    a_locus, b_locus = int(a_locus), int(b_locus)
+    if a_locus != b_locus:
+        return a_locus - b_locus
+    if a_type != b_type:
+        if a_type == 'I':
+            return -1
+        elif b_type == 'I':
+            return 1
+        elif a_type == 'M':
+            return -1
+        else:
+            assert b_type == 'M'
+            return 1
+    assert a_data != b_data
+    if a_type in "MI":
+        if a_data < b_data:
+            return -1
+        else:
+            return 1
+    else:
+        assert a_type == 'D'
+        return int(a_data) - int(b_data)
+
+
+"""
+Align the sequences of all genes to the human reference genome (GRCh38) in a single HISAT2 run
+  Read IDs are prefixed with gene names (e.g. A|HLA:HLA00001) so that the best alignment
+  of each gene, [read ID, chromosome, left, right, strand, AS], can be found in one pass.
+"""
+def align_to_genome(query_fname,
+                    aligner_opts = [],
+                    ungapped = False):
+    cigar_re = re.compile('\d+\w')
+    aligner_cmd = ["hisat2"] + aligner_opts
+    aligner_cmd += ["--no-unal",
+                    "-x", "grch38/genome",
+                    "-f", query_fname]
+    align_proc = subprocess.Popen(aligner_cmd,
+                                  stdout=subprocess.PIPE,
+                                  stderr=open("/dev/null", 'w'))
+    best_alignments = {}
+    for line in align_proc.stdout:
+        if line.startswith('@'):
+            continue
+        line = line.strip()
+        cols = line.split()
+        read_id, flag, chr, left, _, cigar_str = cols[:6]
+        gene, read_id = read_id.split('|', 1)
+        left = int(left) - 1
+        right = left
+        cigars = cigar_re.findall(cigar_str)
+        cigars = [[cigar[-1], int(cigar[:-1])] for cigar in cigars]
+        if ungapped and (len(cigars) > 1 or cigars[0][0] != 'M'):
+            continue
+        for i in range(len(cigars)):
+            cigar_op, length = cigars[i]
+            if cigar_op in "MND":
+                right += length
+
+        flag = int(flag)
+        strand = '-' if flag & 0x10 else '+'
+        AS = ""
+        for i in range(11, len(cols)):
+            col = cols[i]
+            if col.startswith("AS"):
+                AS = col[5:]
+        assert AS != ""
+        AS = int(AS)
+        if gene not in best_alignments or AS > best_alignments[gene][-1]:
+            best_alignments[gene] = [read_id, chr, left, right, strand, AS]
+
+    align_proc.communicate()
+    return best_alignments
+
+
+"""
+Parse an MSF file into allele names (to numeric IDs), alignment rows, and
+  sub-names of the alleles (e.g. A*01:01 for A*01:01:01:01)
+"""
+def parse_MSF_file(fname):
+    names = {} # HLA allele names to numeric IDs
+    rows = []  # pieces of HLA multiple alignment sequences
+    sub_names = {}
+    for line in open(fname):
+        line = line.strip()
+        if not line or \
+                not line[0].isalnum():
+            continue
+
+        if line.startswith("MSF"):
+            continue
+
+        if line.startswith("Name"):
+            try:
+                name = line.split('\t')[0]
+                name = name.split()[1]
+            except ValueError:
+                continue
+
+            if name in names:
+                print >> sys.stderr, "Warning: %s is found more than once in Names" % (name)
+                continue
+
+            names[name] = len(names)
+        else:
+            if len(rows) == 0:
+                rows = [[] for i in range(len(names))]
+            try:
+                cols = line.split()
+                name = cols[0]
+                fives = cols[1:]
+                assert len(fives) > 0
+            except ValueError:
+                continue
+
+            if name not in names:
+                names[name] = len(names)
+
+            id = names[name]
+            if id >= len(rows):
+                assert id == len(rows)
+                rows.append([])
+
+            # Add sub-names of the allele
+            if len(rows[id]) == 0:
+                sub_name = ""
+                for group in name.split(':')[:-1]:
+                    if sub_name != "":
+                        sub_name += ":"
+                    sub_name += group
+                    if sub_name not in sub_names:
+                        sub_names[sub_name] = [name]
+                    else:
+                        sub_names[sub_name].append(name)
+            rows[id] += fives
+
+    seqs = [''.join(row) for row in rows]
+    return names, seqs, sub_names
+
+
+"""
+Write parsed MSF data into a cache file, which consists of
+  a header line (MD5 of the MSF file and the size of the table part),
+  a marshalled table of names, sequence lengths, and sub-names, and
+  the alignment rows packed one after another
+"""
+def write_MSF_cache(cache_fname, md5, names, seqs, sub_names):
+    cache_dname = os.path.dirname(cache_fname)
+    if cache_dname != "" and not os.path.exists(cache_dname):
+        try:
+            os.makedirs(cache_dname)
+        except OSError:
+            pass
+    ID2name = [""] * len(names)
+    for name, id in names.items():
+        ID2name[id] = name
+    table = marshal.dumps([ID2name, [len(seq) for seq in seqs], sub_names])
+    tmp_cache_fname = "%s.%d.tmp" % (cache_fname, os.getpid())
+    cache_file = open(tmp_cache_fname, 'wb')
+    cache_file.write("%s\t%d\n" % (md5, len(table)))
+    cache_file.write(table)
+    for seq in seqs:
+        cache_file.write(seq)
+    cache_file.close()
+    os.rename(tmp_cache_fname, cache_fname)
+
+
+"""
+Read a cache file written by write_MSF_cache through a memory map
+  Return None if the cache is absent or does not match the MD5 of the MSF file.
+"""
+def read_MSF_cache(cache_fname, md5):
+    if not os.path.exists(cache_fname):
+        return None
+    cache_file = open(cache_fname, 'rb')
+    header = cache_file.readline().split('\t')
+    if len(header) != 2 or header[0] != md5:
+        cache_file.close()
+        return None
+    table_len = int(header[1])
+    cache_map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+    offset = cache_file.tell()
+    ID2name, seq_lens, sub_names = marshal.loads(cache_map[offset:offset + table_len])
+    offset += table_len
+    names, seqs = {}, []
+    for id in range(len(ID2name)):
+        names[ID2name[id]] = id
+    for seq_len in seq_lens:
+        seqs.append(cache_map[offset:offset + seq_len])
+        offset += seq_len
+    cache_map.close()
+    cache_file.close()
+    return names, seqs, sub_names
+
+
+"""
+Read an MSF file, from its cached copy in cache_dname if up to date,
+  and add flanking sequences to the alignment rows
+"""
+def read_MSF_file(fname, left_ext_seq = "", right_ext_seq = "", cache_dname = ""):
+    MSF_data = None
+    if cache_dname != "":
+        md5 = hashlib.md5(open(fname, 'rb').read()).hexdigest()
+        cache_fname = "%s/%s.cache" % (cache_dname, os.path.basename(fname))
+        MSF_data = read_MSF_cache(cache_fname, md5)
+    if MSF_data == None:
+        MSF_data = parse_MSF_file(fname)
+        if cache_dname != "":
+            write_MSF_cache(cache_fname, md5, *MSF_data)
+    names, seqs, sub_names = MSF_data
+    if len(left_ext_seq) > 0 or len(right_ext_seq) > 0:
+        seqs = [left_ext_seq + seq + right_ext_seq for seq in seqs]
+    return names, seqs, sub_names
+
+
+"""
+Identify a consensus sequence and base frequencies of a multiple sequence alignment (MSA).
+  The MSA is laid out as one row-major string so that each column is a strided slice,
+  and bases are counted per column by built-in string operations.
 """
 def create_consensus_seq(seqs,
                          seq_len,
                          min_var_freq,
                          remove_empty = True):
-    consensus_freq = [[0, 0, 0, 0, 0] for i in range(seq_len)]
-    for i in range(len(seqs)):                
-        seq = seqs[i]
-        if len(seq) != seq_len:
-            continue                    
-        for j in range(seq_len):
-            nt = seq[j]
-            assert nt in "ACGT.E"
-            if nt == 'A':
-                consensus_freq[j][0] += 1
-            elif nt == 'C':
-                consensus_freq[j][1] += 1
-            elif nt == 'G':
-                consensus_freq[j][2] += 1
-            elif nt == 'T':
-                consensus_freq[j][3] += 1
-            else:
-                assert nt in ".E"
-                consensus_freq[j][4] += 1
-
-    for j in range(len(consensus_freq)):
-        for k in range(len(consensus_freq[j])):
-            consensus_freq[j][k] /= float(len(seqs))
-            consensus_freq[j][k] *= 100.0
-
-    consensus_seq = ""
+    num_seqs = float(len(seqs))
+    msa = ''.join([seq for seq in seqs if len(seq) == seq_len])
+    consensus_freq = []
+    for j in range(seq_len):
+        col = msa[j::seq_len]
+        A, C, G, T = col.count('A'), col.count('C'), col.count('G'), col.count('T')
+        E = len(col) - A - C - G - T
+        assert E == col.count('.') + col.count('E')
+        consensus_freq.append([A / num_seqs * 100.0,
+                               C / num_seqs * 100.0,
+                               G / num_seqs * 100.0,
+                               T / num_seqs * 100.0,
+                               E / num_seqs * 100.0])
+
+    consensus_seq = []
     has_empty = False
-    for c in range(len(consensus_freq)):
-        freq = consensus_freq[c]
-        A, C, G, T, E = freq
+    for freq in consensus_freq:
         # No alleles have bases at this particular location
-        if E >= 100.0:
+        if freq[4] >= 100.0:
             has_empty = True
-            consensus_seq += 'E'
+            consensus_seq.append('E')
             continue
-        if E >= 100.0 - min_var_freq:
+        if freq[4] >= 100.0 - min_var_freq:
             idx = 4
         else:
             idx = freq.index(max(freq[:4]))
         assert idx < 5
-        consensus_seq += "ACGT."[idx]
+        consensus_seq.append("ACGT."[idx])
     consensus_seq = ''.join(consensus_seq)
 
     # Remove dots (deletions)
     skip_pos = set()
     if has_empty and remove_empty:
-        for seq_i in range(len(seqs)):
-            seqs[seq_i] = list(seqs[seq_i])
+        # Ranges of columns to be kept
+        keep_ranges = []
         for i in range(len(consensus_seq)):
-            if consensus_seq[i] != 'E':
-                continue
-            skip_pos.add(i)
-            for seq_i in range(len(seqs)):
-                if i >= len(seqs[seq_i]):
-                    continue
-                seqs[seq_i][i] = 'E'
+            if consensus_seq[i] == 'E':
+                skip_pos.add(i)
+            elif len(keep_ranges) > 0 and keep_ranges[-1][1] == i:
+                keep_ranges[-1][1] = i + 1
+            else:
+                keep_ranges.append([i, i + 1])
+        # Columns beyond the alignment length are kept as they are
+        if len(keep_ranges) > 0 and keep_ranges[-1][1] == len(consensus_seq):
+            keep_ranges[-1][1] = None
+        else:
+            keep_ranges.append([len(consensus_seq), None])
         for seq_i in range(len(seqs)):
-            seqs[seq_i] = ''.join(seqs[seq_i])
-            seqs[seq_i] = seqs[seq_i].replace('E', '')
+            seq = seqs[seq_i]
+            seq = ''.join([seq[left:right] for left, right in keep_ranges])
+            seqs[seq_i] = seq.replace('E', '')
         consensus_seq = consensus_seq.replace('E', '')
 
     # Convert a list form of consensus_freq to a dictionary form
@@ -131,60 +351,534 @@ def create_consensus_seq(seqs,
 
 
 """
-Left-shift deletions if poissble
+Extract variants of a gene w.r.t. the consensus (backbone) sequence of its MSF file(s),
+  and haplotypes of the variants with their variants numbered from 0
+Return [name_items, seqs, backbone_name, backbone_seq, Vars, Vars_, keys, haplotypes, exons],
+  or None if MSF files are missing.  exons are reversed for a gene on '-' strand.
 """
-def leftshift_deletions(backbone_seq, seq, debug = False):
-    if len(seq) != len(backbone_seq):
-        return seq
-    seq = list(seq)
-    seq_len = len(seq)
-    bp_i = 0
-    # Skip the first deletion
-    while bp_i < seq_len:
-        if seq[bp_i] in "ACGT":
-            break
-        bp_i += 1
-
-    while bp_i < seq_len:
-        bp = seq[bp_i]
-        if bp != '.':
-            bp_i += 1
-            continue
-        bp_j = bp_i + 1
-        while bp_j < seq_len:
-            bp2 = seq[bp_j]
-            if bp2 != '.':
+def extract_gene_vars(gene,
+                      ref_gene,
+                      strand,
+                      exons,
+                      left_ext_seq,
+                      right_ext_seq,
+                      base_fname,
+                      inter_gap,
+                      intra_gap,
+                      whole_haplotype,
+                      min_var_freq,
+                      leftshift,
+                      partial,
+                      msf_cache_dname):
+    gene_exons = {}
+    if exons != None:
+        gene_exons[gene] = exons
+    if base_fname == "hla":
+        MSA_fname = "hisatgenotype_db/%s/msf/%s_gen.msf" % (base_fname.upper(), gene)
+    else:
+        MSA_fname = "hisatgenotype_db/%s/msf/%s_gen.msf" % (base_fname.upper(), gene)
+        
+    if not os.path.exists(MSA_fname):
+        print >> sys.stderr, "Warning: %s does not exist" % MSA_fname
+        return None
+
+    names, seqs, full_alleles = read_MSF_file(MSA_fname, left_ext_seq, right_ext_seq, msf_cache_dname)
+
+    # Identify a consensus sequence
+    assert len(seqs) > 0
+
+    # Check sequences are of equal length
+    def find_seq_len(seqs):
+        seq_lens = {}
+        for s in range(len(seqs)):
+            seq_len = len(seqs[s])
+            if seq_len not in seq_lens:
+                seq_lens[seq_len] = 1
+            else:
+                seq_lens[seq_len] += 1
+
+        max_seq_count = 0
+        for tmp_seq_len, tmp_seq_count in seq_lens.items():
+            if tmp_seq_count > max_seq_count:
+                seq_len = tmp_seq_len
+                max_seq_count = tmp_seq_count
+        return seq_len
+
+    seq_len = find_seq_len(seqs)        
+    backbone_name = "%s*BACKBONE" % gene
+    backbone_seq, backbone_freq = create_consensus_seq(seqs,
+                                                       seq_len,
+                                                       min_var_freq,
+                                                       not partial) # Remove empty sequences?
+    # Allele sequences can shrink, so readjust the sequence length
+    if not partial:
+        seq_len = find_seq_len(seqs)
+
+    if partial and base_fname == "hla":
+        partial_MSA_fname = "hisatgenotype_db/HLA/msf/%s_nuc.msf" % gene
+        if not os.path.exists(partial_MSA_fname):
+            print >> sys.stderr, "Warning: %s does not exist" % partial_MSA_fname
+            return None
+        partial_names, partial_seqs, _ = read_MSF_file(partial_MSA_fname, "", "", msf_cache_dname)
+
+        # DK - debugging purposes
+        # Partial alleles vs. Full alleles
+        """
+        counts = [0, 0, 0, 0]
+        for partial_name in partial_names.keys():
+            if partial_name in names:
+                continue
+            name_group = partial_name.split(':')
+            for group_i in [3, 2, 1, 0]:
+                if group_i == 0:
+                    counts[group_i] += 1
+                if group_i > len(name_group):
+                    continue
+                sub_name = ':'.join(name_group[:group_i])
+                if sub_name in full_alleles:
+                    print partial_name, sub_name, full_alleles[sub_name][:5]
+                    counts[group_i] += 1
+                    break
+        print "DK: counts:", counts
+        sys.exit(1)
+        """
+            
+        ref_seq = seqs[names[ref_gene]]
+        ref_seq_map = create_map(ref_seq)
+        ref_partial_seq = partial_seqs[partial_names[ref_gene]]
+        ref_partial_seq_map = create_map(ref_partial_seq)
+        exons = gene_exons[gene]
+        exon_len = 0
+        ref_exons = [] # converted exons to MSF file (e.g. A_gen.msf)
+        ref_partial_exons = [] # converted exons to MSF file (e.g. A_nuc.msf)
+
+        complete = True
+        for exon in exons:
+            left, right = exon
+            ref_exons.append([ref_seq_map[left], ref_seq_map[right]])
+            next_exon_len = right - left + exon_len
+            if next_exon_len >= len(ref_partial_seq_map):
+                print >> sys.stderr, "Warning: partial sequences (%s) seem to be incomplete" % gene
+                complete = False
                 break
+            ref_partial_exons.append([ref_partial_seq_map[exon_len], ref_partial_seq_map[next_exon_len]])
+            exon_len += (right - left + 1)
+            # Make sure two MSF files (e.g. A_gen.msf and A_nuc.msf) share the same MSF lengths in the exonic sequences
+            ref_exon_len = ref_exons[-1][1] - ref_exons[-1][0] + 1
+            ref_partial_exon_len = ref_partial_exons[-1][1] - ref_partial_exons[-1][0] + 1
+            assert ref_exon_len == ref_partial_exon_len
+
+        if complete:
+            partial_seq_len = find_seq_len(partial_seqs)
+            partial_backbone_seq, partial_backbone_freq = create_consensus_seq(partial_seqs,
+                                                                               partial_seq_len,
+                                                                               min_var_freq,
+                                                                               False) # Remove empty sequences?
+            for name, seq_id in partial_names.items():
+                if name in names:
+                    continue
+                seq = partial_seqs[seq_id]
+                new_seq = ""
+                right = 0
+                for e in range(len(exons)):
+                    ref_exon = ref_exons[e]
+                    ref_partial_exon = ref_partial_exons[e]
+                    new_seq += backbone_seq[right:ref_exon[0]]
+                    exon_seq = seq[ref_partial_exon[0]:ref_partial_exon[1] + 1]
+                    nt_exon_seq = exon_seq.replace('.', '')
+                    if len(nt_exon_seq) == 0:
+                        exon_seq = partial_backbone_seq[ref_partial_exon[0]:ref_partial_exon[1] + 1]
+                    new_seq += exon_seq
+                    right = ref_exon[1] + 1
+                new_seq += backbone_seq[right:]
+                names[name] = len(seqs)
+                seqs.append(new_seq)
+
+            backbone_seq, backbone_freq = create_consensus_seq(seqs,
+                                                               seq_len,
+                                                               min_var_freq,
+                                                               True) # Remove empty sequences?
+            seq_len = find_seq_len(seqs)
+            
+    if min_var_freq <= 0.0:
+        assert '.' not in backbone_seq and 'E' not in backbone_seq
+    
+    # Reverse complement MSF if this gene is on '-' strand
+    if strand == '-':
+        # Reverse exons
+        ref_seq = seqs[names[ref_gene]]
+        ref_seq = ref_seq.replace('.', '')
+        ref_seq_len = len(ref_seq)
+        if base_fname == "hla":
+            exons = []
+            for left, right in reversed(gene_exons[gene]):
+                left, right = ref_seq_len - right - 1, ref_seq_len - left - 1
+                exons.append([left, right])
+            gene_exons[gene] = exons
+
+        for i in range(len(seqs)):
+            seqs[i] = typing_common.reverse_complement(seqs[i])
+        backbone_seq, backbone_freq = create_consensus_seq(seqs, seq_len, min_var_freq, True)
+
+    if leftshift:
+        seqs = typing_common.leftshift_deletions(backbone_seq, seqs)
+        backbone_seq, backbone_freq = create_consensus_seq(seqs, seq_len, min_var_freq, True)
+        seq_len = find_seq_len(seqs)
+
+    print >> sys.stderr, "%s: number of HLA alleles is %d." % (gene, len(names))
+
+    # Frequency of a variant from the base frequencies of the backbone
+    def get_var_freq(type, backbone_pos, data):
+        if type == 'M':
+            assert backbone_pos < backbone_freq
+            assert data in backbone_freq[backbone_pos]
+            freq = backbone_freq[backbone_pos][data]
+        elif type == 'D':
+            del_len = int(data)
+            freq = 100.0
+            assert backbone_pos + del_len <= backbone_freq
+            for d in range(del_len):
+                assert '.' in backbone_freq[backbone_pos + d]
+                freq2 = backbone_freq[backbone_pos + d]['.']
+                if freq2 < freq:
+                    freq = freq2
+        else:
+            assert type == 'I'
+            ins_len = len(data)
+            freq = 100.0
+            assert backbone_pos + ins_len <= backbone_freq
+            for i in range(ins_len):
+                nt = data[i]
+                assert nt in backbone_freq[backbone_pos + i]
+                freq2 = backbone_freq[backbone_pos + i][nt]
+                if freq2 < freq:
+                    freq = freq2
+            assert freq <= min_var_freq
+        return freq
+
+    # Number of dots in the backbone sequence before each column
+    dot_counts = [0]
+    for bc in backbone_seq:
+        dot_counts.append(dot_counts[-1] + (1 if bc == '.' else 0))
+
+    # Variants, keyed on (position, type, data), and the IDs of alleles having them
+    var_freqs, var_allele_ids = {}, {}
+    def insertVar(type, info, id):
+        pos, backbone_pos, data = info
+        var = (pos, type, data)
+        if var not in var_freqs:
+            var_freqs[var] = get_var_freq(type, backbone_pos, data)
+            var_allele_ids[var] = [id]
+        else:
+            var_allele_ids[var].append(id)
+
+    for cmp_name, id in names.items():
+        if cmp_name == backbone_name:
+            continue
+        assert id < len(seqs)
+        cmp_seq = seqs[id]
+        if len(cmp_seq) != seq_len:
+            print >> sys.stderr, "Warning: the length of %s (%d) is different from %d" % \
+                (cmp_name, len(cmp_seq), seq_len)
+            continue
+
+        # Columns where the allele differs from the backbone,
+        #   consecutive insertion (or deletion) columns only separated by columns
+        #   with dots in both the backbone and the allele form one insertion (or deletion)
+        run, prev_s = [], -1
+        for s in compress(xrange(seq_len), imap(ne, backbone_seq, cmp_seq)):
+            bc, cc = backbone_seq[s], cmp_seq[s]
+            if bc == '.':
+                type = 'I'
+            elif cc == '.':
+                type = 'D'
+            else:
+                type = 'M'
+            if run:
+                if run[0] == type and \
+                   dot_counts[s] - dot_counts[prev_s + 1] == s - prev_s - 1:
+                    if type == 'I':
+                        run[1][2] += cc
+                    else:
+                        run[1][2] += 1
+                    prev_s = s
+                    continue
+                insertVar(run[0], run[1], id)
+                run = []
+            if type == 'M':
+                insertVar('M', [s - dot_counts[s], s, cc], id)
+            else:
+                run = [type, [s - dot_counts[s], s, cc if type == 'I' else 1]]
+            prev_s = s
+        if run:
+            insertVar(run[0], run[1], id)
+
+    ID2name = {}
+    for name, id in names.items():
+        ID2name[id] = name
+    Vars = {}
+    for var, freq in var_freqs.items():
+        Vars["%d-%s-%s" % var] = [freq, [ID2name[id] for id in var_allele_ids[var]]]
+
+    print >> sys.stderr, "Number of variants is %d." % (len(Vars.keys()))
+
+    Vars_ = {}
+    for key, values in Vars.items():
+        freq, names_ = values
+        for name in names_:
+            if not name in Vars_:
+                Vars_[name] = [key]
             else:
-                bp_j += 1
+                Vars_[name].append(key)
+    for name, vars in Vars_.items():
+        Vars_[name] = sorted(vars, cmp=cmp_varKey)
+
+    # Sanity check -
+    #    (1) Reconstruct the other sequences from the backbone sequence and variants and
+    #    (2) Confirm these constructed sequences are the same as those input sequences.
+    #    Each sequence is assembled in one pass from backbone segments between its variants.
+    backbone_seq_ = backbone_seq.replace('.', '')
+    for cmp_name, id in names.items():
+        if cmp_name == backbone_name:
+            continue
 
-        if bp_j >= seq_len:
-            bp_i = bp_j
-            break
+        if cmp_name not in Vars_:
+            continue
+        
+        constr_seq = []
+        backbone_pos = 0
+        for var in Vars_[cmp_name]:
+            try:
+                locus, type, data = var.split('-')
+                locus = int(locus)
+            except ValueError:
+                continue
 
-        if debug:
-            print >> sys.stderr, bp_i, bp_j, backbone_seq[bp_i-10:bp_i], backbone_seq[bp_i:bp_j], backbone_seq[bp_j:bp_j+10]
-            print >> sys.stderr, bp_i, bp_j, ''.join(seq[bp_i-10:bp_i]), ''.join(seq[bp_i:bp_j]), ''.join(seq[bp_j:bp_j+10])
-        prev_i, prev_j = bp_i, bp_j
+            assert backbone_pos <= locus and locus <= len(backbone_seq_)
+            constr_seq.append(backbone_seq_[backbone_pos:locus])
+            if type == 'M':
+                assert len(data) == 1 and locus < len(backbone_seq_)
+                constr_seq.append(data)
+                backbone_pos = locus + 1
+            elif type == 'I':
+                constr_seq.append(data)
+                backbone_pos = locus
+            else:
+                assert type == 'D'
+                del_len = int(data)
+                assert locus + del_len <= len(backbone_seq_)
+                backbone_pos = locus + del_len
+        constr_seq.append(backbone_seq_[backbone_pos:])
+
+        constr_seq = "".join(constr_seq)
+        assert id < len(seqs)
+        cmp_seq = seqs[id].replace('.', '')
+        if len(constr_seq) != len(cmp_seq):
+            print >> sys.stderr, "Error: reconstruction fails (%s)! Lengths different: %d vs. %d" % \
+                (cmp_name, len(constr_seq), len(cmp_seq))
+            assert False
+
+        if constr_seq != cmp_seq:
+            for s in range(len(constr_seq)):
+                if constr_seq[s] != cmp_seq[s]:
+                    print >> sys.stderr, "Differ at %d: %s vs. %s (reconstruction vs. original)" % \
+                        (s, constr_seq[s], cmp_seq[s])
+                    print "%s:%s vs. %s:%s" % \
+                        (constr_seq[s-10:s], constr_seq[s:s+10], cmp_seq[s-10:s], cmp_seq[s:s+10])
+            print >> sys.stderr, "Error: reconstruction fails for %s" % (cmp_name)
+            assert False
+
+    keys = sorted(Vars.keys(), cmp=cmp_varKey)
+    haplotypes = get_haplotypes(keys,
+                                Vars,
+                                Vars_,
+                                inter_gap,
+                                intra_gap,
+                                whole_haplotype,
+                                min_var_freq)
+    # Allele names are returned as a list in the order of names.items() so that
+    #   the order is kept when the result is passed from another process
+    return [names.items(), seqs, backbone_name, backbone_seq, Vars, Vars_, keys, haplotypes, gene_exons.get(gene)]
 
-        while bp_i > 0 and seq[bp_i-1] in "ACGT" and backbone_seq[bp_j-1] in "ACGT":
-            if seq[bp_i-1] != backbone_seq[bp_j-1]:
-                break
-            seq[bp_j-1] = seq[bp_i-1]
-            seq[bp_i-1] = '.'
-            bp_i -= 1
-            bp_j -= 1
-        bp_i = bp_j
-        while bp_i < seq_len:
-            if seq[bp_i] in "ACGT":
-                break
-            bp_i += 1
 
-        # DK - debugging purposes
-        if debug:
-            print prev_i, prev_j, ''.join(seq[prev_i-10:prev_i]), ''.join(seq[prev_i:prev_j]), ''.join(seq[prev_j:prev_j+10])
+"""
+"""
+def extract_gene_vars_worker(args):
+    return extract_gene_vars(*args)
 
-    return ''.join(seq)
+
+"""
+Identify haplotypes, [left, right, indexes of variants in keys], of a gene's variants (keys sorted by cmp_varKey)
+"""
+def get_haplotypes(keys,
+                   Vars,
+                   Vars_,
+                   inter_gap,
+                   intra_gap,
+                   whole_haplotype,
+                   min_var_freq):
+    var2ID = {}
+    for k in range(len(keys)):
+        var2ID[keys[k]] = k
+    haplotype_list = []
+    add_seq_len = 0
+    excluded_vars = set()
+    var_leftmost, var_rightmost = sys.maxint, -1
+    for k in range(len(keys)):
+        key = keys[k]
+        if Vars[key][0] < min_var_freq:
+            excluded_vars.add(key)
+
+        # Update leftmost and rightmost of Vars
+        locus, type, data = key.split('-')
+        left = right = int(locus)
+        if type == 'D':
+            right = left + int(data) - 1
+        if k == 0:
+            var_leftmost = left
+        if var_rightmost < right:
+            var_rightmost = right
+
+    i = 0
+    while i < len(keys):
+        key_i = keys[i]
+        locus, type, data = key_i.split('-')
+        locus = int(locus)
+        if type == 'D':
+            locus += (int(data) - 1)
+        prev_locus = locus
+        if whole_haplotype:
+            j = len(keys)
+        else:
+            j = i + 1
+            while j < len(keys):
+                key_j = keys[j]
+                locus2, type2, data2 = key_j.split('-')
+                locus2 = int(locus2)
+                if prev_locus + inter_gap < locus2:
+                    break
+                prev_locus = locus2
+                if type == 'D':
+                    prev_locus += (int(data) - 1)
+                j += 1
+
+        alleles = set()
+        for k in range(i, j):
+            key_k = keys[k]
+            freq, names_ = Vars[key_k]
+            if freq < min_var_freq:
+                continue
+            add_alleles = set(names_)
+            alleles |= add_alleles
+
+        haplotypes = set()
+        cur_vars = set(keys[i:j]) - excluded_vars
+        for allele in alleles:
+            allele_vars = set(Vars_[allele]) - excluded_vars
+            allele_cur_vars = '#'.join(sorted(list(cur_vars & allele_vars), cmp=cmp_varKey))
+            haplotypes.add(allele_cur_vars)
+
+        # Split some haplotypes that include large gaps inside
+        def split_haplotypes(haplotypes):
+            split_haplotypes = set()
+            for haplotype in haplotypes:
+                haplotype = haplotype.split('#')
+                assert len(haplotype) > 0
+                if len(haplotype) == 1:
+                    split_haplotypes.add(haplotype[0])
+                    continue
+                prev_s, s = 0, 1
+                while s < len(haplotype):
+                    prev_locus, prev_type, prev_data = haplotype[s-1].split('-')
+                    locus, type, data = haplotype[s].split('-')
+                    prev_locus, locus = int(prev_locus), int(locus)
+                    if prev_type == 'D':
+                        prev_locus += (int(prev_data) - 1)
+                    if prev_locus + intra_gap < locus:
+                        split_haplotypes.add('#'.join(haplotype[prev_s:s]))
+                        prev_s = s
+                    s += 1
+                    if s == len(haplotype):
+                        split_haplotypes.add('#'.join(haplotype[prev_s:s]))
+            return split_haplotypes
+
+        if not whole_haplotype:
+            haplotypes = split_haplotypes(haplotypes)
+
+        def cmp_haplotype(a, b):
+            a = a.split('#')
+            a1_locus, _, _ = a[0].split('-')
+            a2_locus, a2_type, a2_data = a[-1].split('-')
+            a_begin, a_end = int(a1_locus), int(a2_locus)
+            if a2_type == 'D':
+                a_end += (int(a2_data) - 1)
+            b = b.split('#')
+            b1_locus, _, _ = b[0].split('-')
+            b2_locus, b2_type, b2_data = b[-1].split('-')
+            b_begin, b_end = int(b1_locus), int(b2_locus)
+            if b2_type == 'D':
+                b_end += (int(b2_data) - 1)
+            if a_begin != b_begin:
+                return a_begin - b_begin
+            return a_end - b_end
+
+        haplotypes = sorted(list(haplotypes), cmp=cmp_haplotype)
+        
+        # DK - for debugging purposes
+        """
+        dis = prev_locus - locus
+        print "\n[%d, %d]: %d haplotypes" % (i, j, len(haplotypes)), dis
+        if len(cur_vars) in range(0, 1000):
+            # print "vars:", sorted(list(cur_vars), cmp=cmp_varKey
+            print "num:", len(haplotypes)
+            for haplotype in haplotypes:
+                print haplotype.split('#')
+            print "\nnum:", len(haplotypes2)
+            for haplotype in haplotypes2:
+                print haplotype.split('#')
+        """
+
+        # Write haplotypes
+        sanity_vars = set()
+        for h_i in range(len(haplotypes)):
+            h = haplotypes[h_i].split('#')
+            varIDs = []
+            for var in h:
+                varIDs.append(var2ID[var])
+                # DK - for debugging purposes
+                # varIDs.append(var)
+                sanity_vars.add(var2ID[var])
+            if whole_haplotype:
+                h_begin, h_end = var_leftmost, var_rightmost
+            else:
+                h1_locus, _, _ = h[0].split('-')
+                h2_locus, h2_type, h2_data = h[-1].split('-')
+                h_begin, h_end = int(h1_locus), int(h2_locus)
+                if h2_type == 'D':
+                    h_end += (int(h2_data) - 1)
+                assert h_begin <= h_end
+                h_new_begin = h_begin
+                for h_j in reversed(range(0, h_i)):
+                    hc = haplotypes[h_j].split('#')
+                    hc_begin, hc_type, hc_data = hc[-1].split('-')
+                    hc_begin = int(hc_begin)
+                    hc_end = hc_begin
+                    if hc_type == 'D':
+                        hc_end += (int(hc_data) - 1)
+                    if hc_end + inter_gap < h_begin:
+                        break
+                    if h_new_begin > hc_end:
+                        h_new_begin = hc_end
+                assert h_new_begin <= h_begin
+                h_begin = h_new_begin
+            haplotype_list.append([h_begin, h_end, varIDs])
+            add_seq_len += (h_end - h_begin + 1)
+        assert len(sanity_vars) == len(cur_vars)
+                
+        i = j
+
+    print >> sys.stderr, "Length of additional sequences for haplotypes:", add_seq_len
+    return haplotype_list
 
 
 """
@@ -199,6 +893,8 @@ def extract_vars(base_fname,
                  ext_seq_len,
                  leftshift,
                  partial,
+                 msf_cache,
+                 threads,
                  verbose):
     base_fullpath_name = base_fname
     if base_dname != "" and not os.path.exists(base_dname):
@@ -223,6 +919,10 @@ def extract_vars(base_fname,
     if not os.path.exists("hisatgenotype_db"):
         typing_common.clone_hisatgenotype_database()
     fasta_dname = "hisatgenotype_db/%s/fasta" % base_fname.upper()
+    if msf_cache:
+        msf_cache_dname = "hisatgenotype_msf_cache/%s" % base_fname.upper()
+    else:
+        msf_cache_dname = ""
 
     # Check HLA genes
     gene_names = []
@@ -240,65 +940,41 @@ def extract_vars(base_fname,
     if locus_list == []:
         locus_list = gene_names
 
-    cigar_re = re.compile('\d+\w')
-    remove_locus_list = []
+    # Write the sequences of all the genes into one file so that HISAT2 loads its index only once
+    gen_fname = base_fullpath_name + ".gen.fa"
+    gen_file = open(gen_fname, 'w')
+    allele_names = {}
     for gene in locus_list:
-        aligner_cmd = ["hisat2"]
-        if base_fname in ["hla", "coids"]:
-            aligner_cmd += ["--score-min", "C,0"]
-        aligner_cmd += ["--no-unal",
-                        "-x", "grch38/genome",
-                        "-f", "%s/%s_gen.fasta" % (fasta_dname, gene)]
-        align_proc = subprocess.Popen(aligner_cmd,
-                                      stdout=subprocess.PIPE,
-                                      stderr=open("/dev/null", 'w'))
-        allele_id = ""
-        best_chr, best_left, best_right, best_AS, best_strand = "", -1, -1, -sys.maxint, ''
-        for line in align_proc.stdout:
-            if line.startswith('@'):
-                continue
+        gene_fname = "%s/%s_gen.fasta" % (fasta_dname, gene)
+        if not os.path.exists(gene_fname):
+            continue
+        for line in open(gene_fname):
             line = line.strip()
-            cols = line.split()
-            temp_allele_id, flag, chr, left, _, cigar_str = cols[:6]
-            left = int(left) - 1
-            right = left
-            cigars = cigar_re.findall(cigar_str)
-            cigars = [[cigar[-1], int(cigar[:-1])] for cigar in cigars]
-            if len(cigars) > 1 or cigars[0][0] != 'M':
-                continue
-            for i in range(len(cigars)):
-                cigar_op, length = cigars[i]
-                if cigar_op in "MND":
-                    right += length
-
-            flag = int(flag)
-            strand = '-' if flag & 0x10 else '+'
-            AS = ""
-            for i in range(11, len(cols)):
-                col = cols[i]
-                if col.startswith("AS"):
-                    AS = col[5:]
-            assert AS != ""
-            AS = int(AS)
-            if AS > best_AS:
-                allele_id = temp_allele_id
-                best_chr, best_left, best_right, best_AS, best_strand = chr, left, right, AS, strand
-
-        chr, left, right, strand = best_chr, best_left, best_right, best_strand
-        align_proc.communicate()
-        if allele_id == "":
+            if line.startswith('>'):
+                if base_fname == "hla":
+                    tmp_allele_id, tmp_allele_name = line[1:].split()[:2]
+                    allele_names[(gene, tmp_allele_id)] = tmp_allele_name
+                line = ">%s|%s" % (gene, line[1:])
+            print >> gen_file, line
+    gen_file.close()
+
+    aligner_opts = []
+    if base_fname in ["hla", "coids"]:
+        aligner_opts += ["--score-min", "C,0"]
+    gene_alignments = align_to_genome(gen_fname,
+                                      aligner_opts,
+                                      True) # ungapped
+    os.remove(gen_fname)
+
+    remove_locus_list = []
+    ext_genes, ext_ranges = [], []
+    for gene in locus_list:
+        if gene not in gene_alignments:
             remove_locus_list.append(gene)
             continue
+        allele_id, chr, left, right, strand, _ = gene_alignments[gene]
         if base_fname == "hla":
-            allele_name = ""
-            for line in open("%s/%s_gen.fasta" % (fasta_dname, gene)):
-                line = line.strip()
-                if not line.startswith('>'):
-                    continue
-                tmp_allele_id, tmp_allele_name = line[1:].split()[:2]
-                if allele_id == tmp_allele_id:
-                    allele_name = tmp_allele_name
-                    break
+            allele_name = allele_names[(gene, allele_id)]
         else:
             allele_name = allele_id
         assert allele_name != "" and strand != ''
@@ -309,32 +985,21 @@ def extract_vars(base_fname,
 
         assert chr != "" and left >= 0 and right > left
         if ext_seq_len > 0:
-            left_ext_seq, right_ext_seq = "", ""
+            # Flanking regions in samtools' 1-based coordinates, converted to 0-based
             left1, left2 = max(1, left - ext_seq_len), max(1, left - 1)
-            if left2 > 0:
-                extract_seq_cmd = ["samtools", "faidx", "genome.fa", "%s:%d-%d" % (chr, left1, left2)]
-                extract_seq_proc = subprocess.Popen(extract_seq_cmd,
-                                                    stdout=subprocess.PIPE,
-                                                    stderr=open("/dev/null", 'w'))
-                for line in extract_seq_proc.stdout:
-                    if line.startswith('>'):
-                        continue
-                    line = line.strip()
-                    left_ext_seq += line
-            extract_seq_cmd = ["samtools", "faidx", "genome.fa", "%s:%d-%d" % (chr, right, right + ext_seq_len - 1)]
-            extract_seq_proc = subprocess.Popen(extract_seq_cmd,
-                                                stdout=subprocess.PIPE,
-                                                stderr=open("/dev/null", 'w'))
-            for line in extract_seq_proc.stdout:
-                if line.startswith('>'):
-                    continue
-                line = line.strip()
-                right_ext_seq += line
-
-            if strand == '-':
+            ext_genes.append(gene)
+            ext_ranges.append([chr, left1 - 1, left2 - 1])
+            ext_ranges.append([chr, right - 1, right + ext_seq_len - 2])
+
+    # Fetch the flanking sequences of all the genes from genome.fa at once
+    if ext_seq_len > 0:
+        ext_seqs = typing_common.get_fasta_seqs("genome.fa", ext_ranges)
+        for g in range(len(ext_genes)):
+            gene = ext_genes[g]
+            left_ext_seq, right_ext_seq = ext_seqs[g * 2], ext_seqs[g * 2 + 1]
+            if gene_strand[gene] == '-':
                 left_ext_seq, right_ext_seq = typing_common.reverse_complement(right_ext_seq), typing_common.reverse_complement(left_ext_seq)
             left_ext_seq_dic[gene], right_ext_seq_dic[gene] = left_ext_seq, right_ext_seq
-            
 
     # Extract exon information from hla.data
     gene_exons = {}
@@ -396,434 +1061,71 @@ def extract_vars(base_fname,
     # Write all the sequences with dots removed into a file
     input_file = open(base_fullpath_name + "_sequences.fa", 'w')
     num_vars, num_haplotypes = 0, 0
-    full_alleles = {}
+    # Extract variants of the genes independently of one another, in parallel if threads > 1
+    extract_args = []
     for gene, ref_gene in genes.items():
-        strand = gene_strand[gene]
         left_ext_seq, right_ext_seq = "", ""
         if gene in left_ext_seq_dic:
             left_ext_seq, right_ext_seq = left_ext_seq_dic[gene], right_ext_seq_dic[gene]
+        extract_args.append([gene,
+                             ref_gene,
+                             gene_strand[gene],
+                             gene_exons.get(gene),
+                             left_ext_seq,
+                             right_ext_seq,
+                             base_fname,
+                             inter_gap,
+                             intra_gap,
+                             whole_haplotype,
+                             min_var_freq,
+                             leftshift,
+                             partial,
+                             msf_cache_dname])
+    if threads > 1 and len(extract_args) > 1:
+        pool = multiprocessing.Pool(min(threads, len(extract_args)))
+        extract_results = pool.map(extract_gene_vars_worker, extract_args, 1)
+        pool.close()
+        pool.join()
+    else:
+        extract_results = map(extract_gene_vars_worker, extract_args)
 
-        def read_MSF_file(fname, left_ext_seq = "", right_ext_seq = ""):
-            names = {} # HLA allele names to numeric IDs
-            seqs = []  # HLA multiple alignment sequences
-            for line in open(fname):
-                line = line.strip()
-                if not line or \
-                        not line[0].isalnum():
-                    continue
-
-                if line.startswith("MSF"):
-                    continue
-
-                if line.startswith("Name"):
-                    try:
-                        name = line.split('\t')[0]
-                        name = name.split()[1]
-                    except ValueError:
-                        continue
-
-                    if name in names:
-                        print >> sys.stderr, "Warning: %s is found more than once in Names" % (name)
-                        continue
-
-                    names[name] = len(names)
-                else:
-                    if len(seqs) == 0:
-                        seqs = [left_ext_seq for i in range(len(names))]
-                    try:
-                        cols = line.split()
-                        name = cols[0]
-                        fives = cols[1:]
-                        assert len(fives) > 0
-                    except ValueError:
-                        continue
-
-                    if name not in names:
-                        names[name] = len(names)
-
-                    id = names[name]
-                    if id >= len(seqs):
-                        assert id == len(seqs)
-                        seqs.append(left_ext_seq)
-                        
-                    seqs[id] += ''.join(fives)
-
-                    # Add sub-names of the allele
-                    sub_name = ""
-                    for group in name.split(':')[:-1]:
-                        if sub_name != "":
-                            sub_name += ":"
-                        sub_name += group
-                        if sub_name not in full_alleles:
-                            full_alleles[sub_name] = [name]
-                        else:
-                            full_alleles[sub_name].append(name)
-
-            if len(right_ext_seq) > 0:
-                for i_ in range(len(seqs)):
-                    seqs[i_] += right_ext_seq
-
-            return names, seqs
-
-        if base_fname == "hla":
-            MSA_fname = "hisatgenotype_db/%s/msf/%s_gen.msf" % (base_fname.upper(), gene)
-        else:
-            MSA_fname = "hisatgenotype_db/%s/msf/%s_gen.msf" % (base_fname.upper(), gene)
-            
-        if not os.path.exists(MSA_fname):
-            print >> sys.stderr, "Warning: %s does not exist" % MSA_fname
+    # Variants of each gene, [name_items, seqs, backbone_name, backbone_seq, Vars, Vars_, keys, haplotypes]
+    gene_vars = {}
+    for args_, result in zip(extract_args, extract_results):
+        if result == None:
             continue
+        gene = args_[0]
+        exons = result.pop()
+        if exons != None:
+            gene_exons[gene] = exons
+        gene_vars[gene] = result
+
+    # Remap the backbone alleles of all the genes, which are sometimes slighly different from
+    #   fasta version, in a single HISAT2 run
+    remap_fname = base_fullpath_name + ".remap.fa"
+    remap_file = open(remap_fname, 'w')
+    for gene, ref_gene in genes.items():
+        if gene not in gene_vars:
+            continue
+        name_items, seqs = gene_vars[gene][:2]
+        names = dict(name_items)
+        print >> remap_file, ">%s|%s" % (gene, ref_gene)
+        print >> remap_file, seqs[names[ref_gene]].replace('.', '')
+    remap_file.close()
 
-        names, seqs = read_MSF_file(MSA_fname, left_ext_seq, right_ext_seq)
-
-        # Identify a consensus sequence
-        assert len(seqs) > 0
-
-        # Check sequences are of equal length
-        def find_seq_len(seqs):
-            seq_lens = {}
-            for s in range(len(seqs)):
-                seq_len = len(seqs[s])
-                if seq_len not in seq_lens:
-                    seq_lens[seq_len] = 1
-                else:
-                    seq_lens[seq_len] += 1
-
-            max_seq_count = 0
-            for tmp_seq_len, tmp_seq_count in seq_lens.items():
-                if tmp_seq_count > max_seq_count:
-                    seq_len = tmp_seq_len
-                    max_seq_count = tmp_seq_count
-            return seq_len
-
-        seq_len = find_seq_len(seqs)        
-        backbone_name = "%s*BACKBONE" % gene
-        backbone_seq, backbone_freq = create_consensus_seq(seqs,
-                                                           seq_len,
-                                                           min_var_freq,
-                                                           not partial) # Remove empty sequences?
-        # Allele sequences can shrink, so readjust the sequence length
-        if not partial:
-            seq_len = find_seq_len(seqs)
-
-        if partial and base_fname == "hla":
-            partial_MSA_fname = "hisatgenotype_db/HLA/msf/%s_nuc.msf" % gene
-            if not os.path.exists(partial_MSA_fname):
-                print >> sys.stderr, "Warning: %s does not exist" % partial_MSA_fname
-                continue
-            partial_names, partial_seqs = read_MSF_file(partial_MSA_fname)
-
-            # DK - debugging purposes
-            # Partial alleles vs. Full alleles
-            """
-            counts = [0, 0, 0, 0]
-            for partial_name in partial_names.keys():
-                if partial_name in names:
-                    continue
-                name_group = partial_name.split(':')
-                for group_i in [3, 2, 1, 0]:
-                    if group_i == 0:
-                        counts[group_i] += 1
-                    if group_i > len(name_group):
-                        continue
-                    sub_name = ':'.join(name_group[:group_i])
-                    if sub_name in full_alleles:
-                        print partial_name, sub_name, full_alleles[sub_name][:5]
-                        counts[group_i] += 1
-                        break
-            print "DK: counts:", counts
-            sys.exit(1)
-            """
-                
-            ref_seq = seqs[names[ref_gene]]
-            ref_seq_map = create_map(ref_seq)
-            ref_partial_seq = partial_seqs[partial_names[ref_gene]]
-            ref_partial_seq_map = create_map(ref_partial_seq)
-            exons = gene_exons[gene]
-            exon_len = 0
-            ref_exons = [] # converted exons to MSF file (e.g. A_gen.msf)
-            ref_partial_exons = [] # converted exons to MSF file (e.g. A_nuc.msf)
-
-            complete = True
-            for exon in exons:
-                left, right = exon
-                ref_exons.append([ref_seq_map[left], ref_seq_map[right]])
-                next_exon_len = right - left + exon_len
-                if next_exon_len >= len(ref_partial_seq_map):
-                    print >> sys.stderr, "Warning: partial sequences (%s) seem to be incomplete" % gene
-                    complete = False
-                    break
-                ref_partial_exons.append([ref_partial_seq_map[exon_len], ref_partial_seq_map[next_exon_len]])
-                exon_len += (right - left + 1)
-                # Make sure two MSF files (e.g. A_gen.msf and A_nuc.msf) share the same MSF lengths in the exonic sequences
-                ref_exon_len = ref_exons[-1][1] - ref_exons[-1][0] + 1
-                ref_partial_exon_len = ref_partial_exons[-1][1] - ref_partial_exons[-1][0] + 1
-                assert ref_exon_len == ref_partial_exon_len
-
-            if complete:
-                partial_seq_len = find_seq_len(partial_seqs)
-                partial_backbone_seq, partial_backbone_freq = create_consensus_seq(partial_seqs,
-                                                                                   partial_seq_len,
-                                                                                   min_var_freq,
-                                                                                   False) # Remove empty sequences?
-                for name, seq_id in partial_names.items():
-                    if name in names:
-                        continue
-                    seq = partial_seqs[seq_id]
-                    new_seq = ""
-                    right = 0
-                    for e in range(len(exons)):
-                        ref_exon = ref_exons[e]
-                        ref_partial_exon = ref_partial_exons[e]
-                        new_seq += backbone_seq[right:ref_exon[0]]
-                        exon_seq = seq[ref_partial_exon[0]:ref_partial_exon[1] + 1]
-                        nt_exon_seq = exon_seq.replace('.', '')
-                        if len(nt_exon_seq) == 0:
-                            exon_seq = partial_backbone_seq[ref_partial_exon[0]:ref_partial_exon[1] + 1]
-                        new_seq += exon_seq
-                        right = ref_exon[1] + 1
-                    new_seq += backbone_seq[right:]
-                    names[name] = len(seqs)
-                    seqs.append(new_seq)
-
-                backbone_seq, backbone_freq = create_consensus_seq(seqs,
-                                                                   seq_len,
-                                                                   min_var_freq,
-                                                                   True) # Remove empty sequences?
-                seq_len = find_seq_len(seqs)
-                
-        if min_var_freq <= 0.0:
-            assert '.' not in backbone_seq and 'E' not in backbone_seq
-        
-        # Reverse complement MSF if this gene is on '-' strand
-        if strand == '-':
-            # Reverse exons
-            ref_seq = seqs[names[ref_gene]]
-            ref_seq = ref_seq.replace('.', '')
-            ref_seq_len = len(ref_seq)
-            if base_fname == "hla":
-                exons = []
-                for left, right in reversed(gene_exons[gene]):
-                    left, right = ref_seq_len - right - 1, ref_seq_len - left - 1
-                    exons.append([left, right])
-                gene_exons[gene] = exons
-
-            for i in range(len(seqs)):
-                seqs[i] = typing_common.reverse_complement(seqs[i])
-            backbone_seq, backbone_freq = create_consensus_seq(seqs, seq_len, min_var_freq, True)
-
-        if leftshift:
-            for seq_i in range(len(seqs)):
-                seqs[seq_i] = leftshift_deletions(backbone_seq, seqs[seq_i])
-            backbone_seq, backbone_freq = create_consensus_seq(seqs, seq_len, min_var_freq, True)
-            seq_len = find_seq_len(seqs)
-
-        print >> sys.stderr, "%s: number of HLA alleles is %d." % (gene, len(names))
-
-        Vars = {}
-        for cmp_name, id in names.items():
-            if cmp_name == backbone_name:
-                continue
-            assert id < len(seqs)
-            cmp_seq = seqs[id]
-            if len(cmp_seq) != seq_len:
-                print >> sys.stderr, "Warning: the length of %s (%d) is different from %d" % \
-                    (cmp_name, len(cmp_seq), seq_len)
-                continue
-
-            # DK - debugging purposes
-            """
-            if cmp_name == "A*03:01:07":
-                print cmp_name
-                cmp_seq2 = seqs[names["A*32:29"]]
-                for s in range(0, seq_len, 100):
-                    print s, backbone_seq[s:s+100]
-                    print s, cmp_seq2[s:s+100]
-                    print s, cmp_seq[s:s+100]
-                # sys.exit(1)
-            """
-            def insertVar(type, info):
-                pos, backbone_pos, data = info
-                if type in "MI":
-                    varKey = "%d-%s-%s" % (pos, type, data)
-                else:
-                    varKey = "%d-%s-%d" % (pos, type, data)
-
-                if varKey not in Vars:
-                    if type == 'M':
-                        assert backbone_pos < backbone_freq
-                        assert data in backbone_freq[backbone_pos]
-                        freq = backbone_freq[backbone_pos][data]
-                    elif type == 'D':
-                        del_len = int(data)
-                        freq = 100.0
-                        assert backbone_pos + del_len <= backbone_freq
-                        for d in range(del_len):
-                            assert '.' in backbone_freq[backbone_pos + d]
-                            freq2 = backbone_freq[backbone_pos + d]['.']
-                            if freq2 < freq:
-                                freq = freq2
-                    else:
-                        assert type == 'I'
-                        ins_len = len(data)
-                        freq = 100.0
-                        assert backbone_pos + ins_len <= backbone_freq
-                        for i in range(ins_len):
-                            nt = data[i]
-                            assert nt in backbone_freq[backbone_pos + i]
-                            freq2 = backbone_freq[backbone_pos + i][nt]
-                            if freq2 < freq:
-                                freq = freq2
-                        assert freq <= min_var_freq
-                    
-                    Vars[varKey] = [freq, [cmp_name]]
-                else:
-                    Vars[varKey][1].append(cmp_name)
-
-            insertion, deletion = [], []
-            ndots = 0
-            for s in range(seq_len):
-                assert not (insertion and deletion)
-                bc = backbone_seq[s]
-                cc = cmp_seq[s]
-                if bc != '.' and cc != '.':
-                    if insertion:
-                        insertVar('I', insertion)
-                        insertion = []
-                    elif deletion:
-                        insertVar('D', deletion)
-                        deletion = []
-                    if bc != cc:
-                        mismatch = [s - ndots, s, cc]
-                        insertVar('M', mismatch)
-                elif bc == '.' and cc != '.':
-                    if deletion:
-                        insertVar('D', deletion)
-                        deletion = []
-                    if insertion:
-                        insertion[2] += cc
-                    else:
-                        insertion = [s - ndots, s, cc]
-                elif bc != '.' and cc == '.':
-                    if insertion:
-                        insertVar('I', insertion)
-                        insertion = []
-                    if deletion:
-                        deletion[2] += 1
-                    else:
-                        deletion = [s - ndots, s, 1]
-
-                if bc == '.':
-                    ndots += 1
-
-                """
-                if backbone_seq[s] != cmp_seq[s]:
-                    print "%s is different %s at %d: %s vs. %s" % \
-                        (backbone_name, cmp_name, s+1, backbone_seq[s], cmp_seq[s])
-                """
-
-            if insertion:
-                insertVar('I', insertion)
-            elif deletion:
-                insertVar('D', deletion)
-
-
-        print >> sys.stderr, "Number of variants is %d." % (len(Vars.keys()))
-
-        # Compare variants
-        def cmp_varKey(a, b):
-            a_locus, a_type, a_data = a.split('-')
-            b_locus, b_type, b_data = b.split('-')
-            a_locus, b_locus = int(a_locus), int(b_locus)
-            if a_locus != b_locus:
-                return a_locus - b_locus
-            if a_type != b_type:
-                if a_type == 'I':
-                    return -1
-                elif b_type == 'I':
-                    return 1
-                elif a_type == 'M':
-                    return -1
-                else:
-                    assert b_type == 'M'
-                    return 1
-            assert a_data != b_data
-            if a_type in "MI":
-                if a_data < b_data:
-                    return -1
-                else:
-                    return 1
-            else:
-                assert a_type == 'D'
-                return int(a_data) - int(b_data)            
-
-        Vars_ = {}
-        for key, values in Vars.items():
-            freq, names_ = values
-            for name in names_:
-                if not name in Vars_:
-                    Vars_[name] = [key]
-                else:
-                    Vars_[name].append(key)
-        for name, vars in Vars_.items():
-            Vars_[name] = sorted(vars, cmp=cmp_varKey)
-
-        # Sanity check -
-        #    (1) Reconstruct the other sequences from the backbone sequence and variants and
-        #    (2) Confirm these constructed sequences are the same as those input sequences.
-        for cmp_name, id in names.items():
-            if cmp_name == backbone_name:
-                continue
-
-            constr_seq = backbone_seq.replace('.', '')
-            constr_seq = list(constr_seq)
-            locus_diff = 0
-
-            if cmp_name not in Vars_:
-                continue
-            
-            for var in Vars_[cmp_name]:
-                try:
-                    locus, type, data = var.split('-')
-                    locus = int(locus)
-                except ValueError:
-                    continue
-
-                if type == 'M':
-                    assert len(data) == 1
-                    constr_seq[locus + locus_diff] = data[0]
-                elif type == 'I':
-                    assert locus + locus_diff >= 0
-                    assert locus + locus_diff <= len(constr_seq)
-                    constr_seq = constr_seq[:locus + locus_diff] + list(data) + constr_seq[locus + locus_diff:]
-                    locus_diff += len(data)
-                else:
-                    assert type == 'D'
-                    assert locus + locus_diff + len(data) <= len(constr_seq)
-                    assert locus + locus_diff >= 0
-                    del_len = int(data)
-                    constr_seq = constr_seq[:locus + locus_diff] + constr_seq[locus + locus_diff + del_len:]
-                    locus_diff -= del_len
-
-            constr_seq = "".join(constr_seq)
-            assert id < len(seqs)
-            cmp_seq = seqs[id].replace('.', '')
-            if len(constr_seq) != len(cmp_seq):
-                print >> sys.stderr, "Error: reconstruction fails (%s)! Lengths different: %d vs. %d" % \
-                    (cmp_name, len(constr_seq), len(cmp_seq))
-                assert False
-
-            # Sanity check
-            for s in range(len(constr_seq)):
-                if constr_seq[s] != cmp_seq[s]:
-                    print >> sys.stderr, "Differ at %d: %s vs. %s (reconstruction vs. original)" % \
-                        (s, constr_seq[s], cmp_seq[s])
-                    print "%s:%s vs. %s:%s" % \
-                        (constr_seq[s-10:s], constr_seq[s:s+10], cmp_seq[s-10:s], cmp_seq[s:s+10])
+    aligner_opts = []
+    if base_fname == "hla":
+        aligner_opts += ["--score-min", "C,0"]
+    remap_alignments = align_to_genome(remap_fname,
+                                       aligner_opts)
+    os.remove(remap_fname)
 
-            if constr_seq != cmp_seq.replace('.', ''):
-                print >> sys.stderr, "Error: reconstruction fails for %s" % (cmp_name)
-                assert False
+    for gene, ref_gene in genes.items():
+        if gene not in gene_vars:
+            continue
+        name_items, seqs, backbone_name, backbone_seq, Vars, Vars_, keys, haplotypes = gene_vars[gene]
+        names = dict(name_items)
+        del gene_vars[gene]
 
         # Write the backbone sequences into a fasta file
         print >> backbone_file, ">%s" % (backbone_name)
@@ -831,51 +1133,11 @@ def extract_vars(base_fname,
         for s in range(0, len(backbone_seq_), 60):
             print >> backbone_file, backbone_seq_[s:s+60]
 
-        # Remap the backbone allele, which is sometimes slighly different from
-        #   fasta version
-        ref_backbone_id = names[ref_gene]
-        ref_backbone_seq = seqs[ref_backbone_id]
-        aligner_cmd = ["hisat2"]
-        if base_fname == "hla":
-            aligner_cmd += ["--score-min", "C,0"]
-        aligner_cmd += ["--no-unal",
-                        "-x", "grch38/genome",
-                        "-f", 
-                        "-c", "%s" % ref_backbone_seq.replace('.', '')]
-        align_proc = subprocess.Popen(aligner_cmd,
-                                      stdout=subprocess.PIPE,
-                                      stderr=open("/dev/null", 'w'))
-        best_chr, best_left, best_right, best_AS = "", 0, 0, -sys.maxint
-        for line in align_proc.stdout:
-            if line.startswith('@'):
-                continue
-            line = line.strip()
-            cols = line.split()
-            allele_id, flag, chr, left, mapQ, cigar_str = cols[:6]
-            flag = int(flag)
-            assert flag & 0x10 == 0
-            left = int(left) - 1
-            right = left
-            AS = ""
-            for i in range(11, len(cols)):
-                col = cols[i]
-                if col.startswith("AS"):
-                    AS = col[5:]
-            AS = int(AS)
-            cigars = cigar_re.findall(cigar_str)
-            cigars = [[cigar[-1], int(cigar[:-1])] for cigar in cigars]
-            for i in range(len(cigars)):
-                cigar_op, length = cigars[i]
-                if cigar_op in "MND":
-                    right += length
-            if AS > best_AS:
-                best_chr, best_left, best_right, best_AS = chr, left, right, AS
-
-        chr, left, right = best_chr, best_left, best_right
-        align_proc.communicate()
-        if left == right:
+        if gene not in remap_alignments:
             print >> sys.stderr, "Warning: %s (%s) is not remapped" % (gene, ref_gene)
             continue
+        _, chr, left, right, strand, _ = remap_alignments[gene]
+        assert strand == '+'
         assert left < right
 
         base_locus = 0                
@@ -969,8 +1231,6 @@ def extract_vars(base_fname,
         # Write
         #       (1) variants w.r.t the backbone sequences into a SNP file
         #       (2) pairs of a variant and the corresponding HLA allels into a LINK file    
-        keys = sorted(Vars.keys(), cmp=cmp_varKey)
-        var2ID = {}
         for k in range(len(keys)):
             locus, type, data = keys[k].split('-')
             locus = int(locus)
@@ -984,7 +1244,7 @@ def extract_vars(base_fname,
 
             freq, names_ = Vars[keys[k]]
             names_ = sorted(names_)            
-            varID = "hv%d" % (num_vars)
+            varID = "hv%d" % (num_vars + k)
             tmp_backbone_name = backbone_name
             print >> var_file, "%s\t%s\t%s\t%d\t%s" % \
                 (varID, type_str, tmp_backbone_name, base_locus + locus, data)
@@ -993,173 +1253,18 @@ def extract_vars(base_fname,
                     (varID, type_str, tmp_backbone_name, base_locus + locus, data)
             print >> var_freq_file, "%s\t%.2f" % (varID, freq)
             print >> link_file, "%s\t%s" % (varID, ' '.join(names_))
-            var2ID[keys[k]] = num_vars
-            num_vars += 1
 
-        add_seq_len = 0
         # Write haplotypes
-        excluded_vars = set()
-        var_leftmost, var_rightmost = sys.maxint, -1
-        for k in range(len(keys)):
-            key = keys[k]
-            if Vars[key][0] < min_var_freq:
-                excluded_vars.add(key)
-
-            # Update leftmost and rightmost of Vars
-            locus, type, data = key.split('-')
-            left = right = int(locus)
-            if type == 'D':
-                right = left + int(data) - 1
-            if k == 0:
-                var_leftmost = left
-            if var_rightmost < right:
-                var_rightmost = right
-
-        i = 0
-        while i < len(keys):
-            key_i = keys[i]
-            locus, type, data = key_i.split('-')
-            locus = int(locus)
-            if type == 'D':
-                locus += (int(data) - 1)
-            prev_locus = locus
-            if whole_haplotype:
-                j = len(keys)
-            else:
-                j = i + 1
-                while j < len(keys):
-                    key_j = keys[j]
-                    locus2, type2, data2 = key_j.split('-')
-                    locus2 = int(locus2)
-                    if prev_locus + inter_gap < locus2:
-                        break
-                    prev_locus = locus2
-                    if type == 'D':
-                        prev_locus += (int(data) - 1)
-                    j += 1
-
-            alleles = set()
-            for k in range(i, j):
-                key_k = keys[k]
-                freq, names_ = Vars[key_k]
-                if freq < min_var_freq:
-                    continue
-                add_alleles = set(names_)
-                alleles |= add_alleles
-
-            haplotypes = set()
-            cur_vars = set(keys[i:j]) - excluded_vars
-            for allele in alleles:
-                allele_vars = set(Vars_[allele]) - excluded_vars
-                allele_cur_vars = '#'.join(sorted(list(cur_vars & allele_vars), cmp=cmp_varKey))
-                haplotypes.add(allele_cur_vars)
-
-            # Split some haplotypes that include large gaps inside
-            def split_haplotypes(haplotypes):
-                split_haplotypes = set()
-                for haplotype in haplotypes:
-                    haplotype = haplotype.split('#')
-                    assert len(haplotype) > 0
-                    if len(haplotype) == 1:
-                        split_haplotypes.add(haplotype[0])
-                        continue
-                    prev_s, s = 0, 1
-                    while s < len(haplotype):
-                        prev_locus, prev_type, prev_data = haplotype[s-1].split('-')
-                        locus, type, data = haplotype[s].split('-')
-                        prev_locus, locus = int(prev_locus), int(locus)
-                        if prev_type == 'D':
-                            prev_locus += (int(prev_data) - 1)
-                        if prev_locus + intra_gap < locus:
-                            split_haplotypes.add('#'.join(haplotype[prev_s:s]))
-                            prev_s = s
-                        s += 1
-                        if s == len(haplotype):
-                            split_haplotypes.add('#'.join(haplotype[prev_s:s]))
-                return split_haplotypes
-
-            if not whole_haplotype:
-                haplotypes = split_haplotypes(haplotypes)
-
-            def cmp_haplotype(a, b):
-                a = a.split('#')
-                a1_locus, _, _ = a[0].split('-')
-                a2_locus, a2_type, a2_data = a[-1].split('-')
-                a_begin, a_end = int(a1_locus), int(a2_locus)
-                if a2_type == 'D':
-                    a_end += (int(a2_data) - 1)
-                b = b.split('#')
-                b1_locus, _, _ = b[0].split('-')
-                b2_locus, b2_type, b2_data = b[-1].split('-')
-                b_begin, b_end = int(b1_locus), int(b2_locus)
-                if b2_type == 'D':
-                    b_end += (int(b2_data) - 1)
-                if a_begin != b_begin:
-                    return a_begin - b_begin
-                return a_end - b_end
-
-            haplotypes = sorted(list(haplotypes), cmp=cmp_haplotype)
-            
-            # DK - for debugging purposes
-            """
-            dis = prev_locus - locus
-            print "\n[%d, %d]: %d haplotypes" % (i, j, len(haplotypes)), dis
-            if len(cur_vars) in range(0, 1000):
-                # print "vars:", sorted(list(cur_vars), cmp=cmp_varKey
-                print "num:", len(haplotypes)
-                for haplotype in haplotypes:
-                    print haplotype.split('#')
-                print "\nnum:", len(haplotypes2)
-                for haplotype in haplotypes2:
-                    print haplotype.split('#')
-            """
-
-            # Write haplotypes
-            sanity_vars = set()
-            for h_i in range(len(haplotypes)):
-                h = haplotypes[h_i].split('#')
-                varIDs = []
-                for var in h:
-                    varIDs.append("hv%s" % var2ID[var])
-                    # DK - for debugging purposes
-                    # varIDs.append(var)
-                    sanity_vars.add(var2ID[var])
-                if whole_haplotype:
-                    h_begin, h_end = var_leftmost, var_rightmost
-                else:
-                    h1_locus, _, _ = h[0].split('-')
-                    h2_locus, h2_type, h2_data = h[-1].split('-')
-                    h_begin, h_end = int(h1_locus), int(h2_locus)
-                    if h2_type == 'D':
-                        h_end += (int(h2_data) - 1)
-                    assert h_begin <= h_end
-                    h_new_begin = h_begin
-                    for h_j in reversed(range(0, h_i)):
-                        hc = haplotypes[h_j].split('#')
-                        hc_begin, hc_type, hc_data = hc[-1].split('-')
-                        hc_begin = int(hc_begin)
-                        hc_end = hc_begin
-                        if hc_type == 'D':
-                            hc_end += (int(hc_data) - 1)
-                        if hc_end + inter_gap < h_begin:
-                            break
-                        if h_new_begin > hc_end:
-                            h_new_begin = hc_end
-                    assert h_new_begin <= h_begin
-                    h_begin = h_new_begin
-                tmp_backbone_name = backbone_name
-                print >> haplotype_file, "ht%d\t%s\t%d\t%d\t%s" % \
-                    (num_haplotypes, tmp_backbone_name, base_locus + h_begin, base_locus + h_end, ','.join(varIDs))
-                num_haplotypes += 1
-                add_seq_len += (h_end - h_begin + 1)
-            assert len(sanity_vars) == len(cur_vars)
-                    
-            i = j
-
-        print >> sys.stderr, "Length of additional sequences for haplotypes:", add_seq_len
+        for h_begin, h_end, varIDs in haplotypes:
+            varIDs = ["hv%d" % (num_vars + k) for k in varIDs]
+            tmp_backbone_name = backbone_name
+            print >> haplotype_file, "ht%d\t%s\t%d\t%d\t%s" % \
+                (num_haplotypes, tmp_backbone_name, base_locus + h_begin, base_locus + h_end, ','.join(varIDs))
+            num_haplotypes += 1
+        num_vars += len(keys)
                     
         # Write all the sequences with dots removed into a file
-        for name, ID in names.items():
+        for name, ID in name_items:
             print >> input_file, ">%s" % (name)
             assert ID < len(seqs)
             seq = seqs[ID].replace('.', '')
@@ -1192,6 +1297,9 @@ def extract_vars(base_fname,
     for partial_allele in partial_allele_list:
         print >> partial_file, partial_allele
     partial_file.close()
+
+    # Compile the above files into a binary database (e.g. hla.db) for faster loading
+    typing_common.compile_database(base_fullpath_name)
    
     
         
@@ -1242,6 +1350,15 @@ if __name__ == '__main__':
                         dest="partial",
                         action="store_false",
                         help="Exclude partial alleles, exon-only sequences in HLA")
+    parser.add_argument("--no-msf-cache",
+                        dest="msf_cache",
+                        action="store_false",
+                        help="Parse MSF files without reading or writing their cached copies in hisatgenotype_msf_cache")
+    parser.add_argument("-p", "--threads",
+                        dest="threads",
+                        type=int,
+                        default=1,
+                        help="Number of threads")
     parser.add_argument("-v", "--verbose",
                         dest="verbose",
                         action="store_true",
@@ -1274,5 +1391,7 @@ if __name__ == '__main__':
                  args.ext_seq_len,
                  args.leftshift,
                  args.partial,
+                 args.msf_cache,
+                 args.threads,
                  args.verbose)
 
@@ -21,6 +21,8 @@
 
 import sys, os, subprocess, re
 import inspect, random
+import itertools
+import multiprocessing
 import math
 from datetime import datetime, date, time
 from argparse import ArgumentParser, FileType
@@ -95,13 +97,14 @@ def get_rep_alleles(Links, exon_vars):
     
 
 """
+Correct sequencing errors using mpileup, where Var_table is for looking up known variants
+  (e.g. Var_table[("single", 100, 'A')] = "hv10")
 """
 def error_correct(ref_seq,
                   read_seq,
                   read_pos,
                   mpileup,
-                  Vars,
-                  Var_list,
+                  Var_table,
                   cmp_list,
                   debug = False):
     if debug:
@@ -125,7 +128,7 @@ def error_correct(ref_seq,
                 
                 read_bp, ref_bp = read_seq[read_pos + j], ref_seq[left + j]
                 assert left + j < len(mpileup)
-                nt_set = mpileup[left + j][0]
+                nt_set = mpileup.nt_sets[left + j]
                 if len(nt_set) > 0 and read_bp not in nt_set:
                     read_bp = 'N' if len(nt_set) > 1 else nt_set[0]                    
                     read_seq = read_seq[:read_pos + j] + read_bp + read_seq[read_pos + j + 1:]
@@ -133,17 +136,7 @@ def error_correct(ref_seq,
                     new_cmp = ["mismatch", left + j, 1, "unknown"]
                     num_correction += 1
                     if read_bp != 'N':
-                        var_idx = typing_common.lower_bound(Var_list, left + j)
-                        while var_idx < len(Var_list):
-                            var_pos, var_id = Var_list[var_idx]
-                            if var_pos > left + j:
-                                break
-                            if var_pos == left + j:
-                                var_type, _, var_data = Vars[var_id]
-                                if var_type == "single" and read_bp == var_data:
-                                    new_cmp[3] = var_id
-                                    break                                                        
-                            var_idx += 1
+                        new_cmp[3] = Var_table.get(("single", left + j, read_bp), "unknown")
                     if j > last_j:
                         middle_cmp_list.append(["match", left + last_j, j- last_j])
                     middle_cmp_list.append(new_cmp)
@@ -158,10 +151,10 @@ def error_correct(ref_seq,
             assert type == "mismatch"
             read_bp, ref_bp = read_seq[read_pos], ref_seq[left]
             assert left < len(mpileup)
-            nt_set = mpileup[left][0]
+            nt_set = mpileup.nt_sets[left]
 
             if debug:
-                print >> sys.stderr, left, read_bp, ref_bp, mpileup[left]
+                print >> sys.stderr, left, read_bp, ref_bp, mpileup.get_nt_dic(left)
 
             if len(nt_set) > 0 and read_bp not in nt_set:
                 read_bp = 'N' if len(nt_set) > 1 else nt_set[0]
@@ -172,21 +165,10 @@ def error_correct(ref_seq,
                     cmp_list[i] = ["match", left, 1]
                     num_correction += 1
                 else:
-                    cmp_list[i][3] = "unknown"
-                    var_idx = typing_common.lower_bound(Var_list, left)
-                    while var_idx < len(Var_list):
-                        var_pos, var_id = Var_list[var_idx]
-                        if var_pos > left:
-                            break
-                        if var_pos == left:
-                            var_type, _, var_data = Vars[var_id]
-                            if var_type == "single" and read_bp == var_data:
-                                cmp_list[i][3] = var_id
-                                break                                                        
-                        var_idx += 1
+                    cmp_list[i][3] = Var_table.get(("single", left, read_bp), "unknown")
 
                 if debug:
-                    print >> sys.stderr, left, read_bp, ref_bp, mpileup[left]
+                    print >> sys.stderr, left, read_bp, ref_bp, mpileup.get_nt_dic(left)
                     print >> sys.stderr, cmp_list[i]
 
         read_pos += length
@@ -211,6 +193,42 @@ def error_correct(ref_seq,
     return cmp_list, read_seq, num_correction
 
 
+"""
+Compatible alleles of read pairs computed in worker processes, where the function
+  (a closure in typing) is passed to the workers when they are forked
+"""
+pair_cmpt_func = None
+def init_pair_cmpt_worker(func):
+    global pair_cmpt_func
+    pair_cmpt_func = func
+
+
+"""
+Counts of compatible alleles of a chunk of read pairs, in the order of their first appearance
+"""
+def get_pair_cmpts_worker(pair_hts_list):
+    Gene_cmpt, Gene_gen_cmpt = [{}, []], [{}, []]
+    for read_id, positive_hts in pair_hts_list:
+        cur_cmpt, cur_cmpt_gen = pair_cmpt_func(read_id, positive_hts)
+        add_cmpt_count(Gene_cmpt, cur_cmpt, 1)
+        add_cmpt_count(Gene_gen_cmpt, cur_cmpt_gen, 1)
+    return [[[cmpt, Gene_cmpt[0][cmpt]] for cmpt in Gene_cmpt[1]],
+            [[cmpt, Gene_gen_cmpt[0][cmpt]] for cmpt in Gene_gen_cmpt[1]]]
+
+
+"""
+Add count to a compatibility class (a bitset of alleles) of [counts, classes in the order of their first appearance]
+"""
+def add_cmpt_count(Gene_cmpt, cmpt, count):
+    if cmpt == 0:
+        return
+    if cmpt not in Gene_cmpt[0]:
+        Gene_cmpt[0][cmpt] = count
+        Gene_cmpt[1].append(cmpt)
+    else:
+        Gene_cmpt[0][cmpt] += count
+
+
 """
 """
 def typing(simulation,
@@ -284,8 +302,9 @@ def typing(simulation,
             ref_locus = refGene_loci[gene]
             ref_exons = ref_locus[-1]
             
-            novel_var_count = 0        
-            gene_vars, gene_var_list = deepcopy(Vars[gene]), deepcopy(Var_list[gene])
+            # Novel variants are added on top of the loaded variants (see typing_common.VarOverlay),
+            #   and gene_var_list has the loaded variants only
+            gene_vars, gene_var_list = typing_common.VarOverlay(Vars[gene]), Var_list[gene]
             cur_maxright = -1
             gene_var_maxrights = {}
             for var_pos, var_id in gene_var_list:
@@ -294,36 +313,27 @@ def typing(simulation,
                     var_pos = var_pos + int(var_data) - 1
                 cur_maxright = max(cur_maxright, var_pos)
                 gene_var_maxrights[var_id] = cur_maxright
+
+            # Position to variant table (e.g. ("single", 100, 'A') or ("deletion", 100, 2))
+            #   for variants that are not reported in Zs, where the first in gene_var_list is used
+            gene_var_table = {}
+            def add_var_table(var_id):
+                var_type, var_pos, var_data = gene_vars[var_id]
+                if var_type == "insertion":
+                    var_data = len(var_data)
+                elif var_type == "deletion":
+                    var_data = int(var_data)
+                var_key = (var_type, var_pos, var_data)
+                if var_key not in gene_var_table:
+                    gene_var_table[var_key] = var_id
+            for _, var_id in gene_var_list:
+                add_var_table(var_id)
                     
             var_count = {}
-            def add_novel_var(gene_vars,
-                              gene_var_list,
-                              novel_var_count,
-                              var_type,
-                              var_pos,
-                              var_data):
-                var_idx = typing_common.lower_bound(gene_var_list, var_pos)
-                while var_idx < len(gene_var_list):
-                    pos_, id_ = gene_var_list[var_idx]
-                    if pos_ > var_pos:
-                        break
-                    if pos_ == var_pos:
-                        type_, _, data_ = gene_vars[id_]
-                        assert type_ != var_type or data_ != var_data
-                        if type_ != var_type:
-                            if var_type == "insertion":
-                                break
-                            elif var_type == "single" and type_ == "deletion":
-                                break
-                        else:
-                            if var_data < data_:
-                                break
-                    var_idx += 1
-                var_id = "nv%d" % novel_var_count
-                assert var_id not in gene_vars
-                gene_vars[var_id] = [var_type, var_pos, var_data]
-                gene_var_list.insert(var_idx, [var_pos, var_id])                
-                return var_id, novel_var_count + 1
+            def add_novel_var(var_type, var_pos, var_data):
+                var_id = gene_vars.add_novel_var(var_type, var_pos, var_data)
+                add_var_table(var_id)
+                return var_id
 
             if not os.path.exists(alignment_fname + ".bai"):
                 os.system("samtools index %s" % alignment_fname)
@@ -339,28 +349,25 @@ def typing(simulation,
 
             if index_type == "graph":
                 alignview_cmd += [ref_allele]
-                mpileup = typing_common.get_mpileup(alignview_cmd,
+                # Alignments in the region are read once, and used for mpileup, pair distances, and typing
+                alignments = typing_common.read_alignment_batch(alignview_cmd)
+                Zs_var_ids, Zs_var_index = [], {}
+                typing_common.decode_alignment_edits(alignments,
+                                                     base_locus,
+                                                     Zs_var_ids,
+                                                     Zs_var_index)
+                mpileup = typing_common.get_mpileup(alignments,
                                                     ref_seq,
                                                     base_locus,
                                                     gene_vars,
                                                     allow_discordant)
 
                 if base_fname == "codis":
-                    pair_interdist = typing_common.get_pair_interdist(alignview_cmd,
+                    pair_interdist = typing_common.get_pair_interdist(alignments,
                                                                       simulation,
                                                                       verbose)
                 else:
                     pair_interdist = None
-
-                bamview_proc = subprocess.Popen(alignview_cmd,
-                                                stdout=subprocess.PIPE,
-                                                stderr=open("/dev/null", 'w'))
-
-                sort_read_cmd = ["sort", "-k", "1,1", "-s"] # -s for stable sorting
-                alignview_proc = subprocess.Popen(sort_read_cmd,
-                                                  stdin=bamview_proc.stdout,
-                                                  stdout=subprocess.PIPE,
-                                                  stderr=open("/dev/null", 'w'))
             else:
                 alignview_proc = subprocess.Popen(alignview_cmd,
                                              stdout=subprocess.PIPE,
@@ -481,9 +488,81 @@ def typing(simulation,
                 read_nodes = []
                 read_vars_list = []
 
-                # 
+                # Alleles are represented as bitsets over their sorted names, and
+                #   the alleles of each variant (Links) are turned into bitsets when first needed
+                Gene_allele_names = sorted([allele for allele in Genes[gene].keys() if allele.find("BACKBONE") == -1])
+                Gene_allele_index = {}
+                for allele_i in range(len(Gene_allele_names)):
+                    Gene_allele_index[Gene_allele_names[allele_i]] = allele_i
+                Gene_allele_all_bits = (1 << len(Gene_allele_names)) - 1
+                if len(allele_rep_set) > 0:
+                    Gene_allele_rep_bits = typing_common.get_allele_bits(allele_rep_set, Gene_allele_index)
+                else:
+                    Gene_allele_rep_bits = Gene_allele_all_bits
+                Links_bits = {}
+                def get_link_bits(var_id):
+                    if var_id not in Links_bits:
+                        Links_bits[var_id] = typing_common.get_allele_bits(Links[var_id], Gene_allele_index)
+                    return Links_bits[var_id]
+
+                def get_alleles_from_bits(bits):
+                    return [Gene_allele_names[i] for i in typing_common.get_bit_indexes(bits)]
+
+                # Alleles compatible with haplotypes, which recur across reads
+                #   Novel variants (nv) are not involved, so the compatibility of a haplotype does not change
+                ht_alleles_cache = typing_common.LRUCache(1 << 14)
+
+                # Add counts, in bit planes (see typing_common.add_bit_counter), to the alleles compatible with a haplotype
                 def add_count(count_per_read, ht, add):
-                    orig_ht = ht
+                    alleles = ht_alleles_cache.get(ht)
+                    if alleles == None:
+                        alleles = get_ht_alleles(ht)
+                        ht_alleles_cache.put(ht, alleles)
+                    
+                    assert add > 0
+                    for _ in range(add):
+                        typing_common.add_bit_counter(count_per_read, alleles)
+
+                    return alleles
+
+                # Alleles compatible with a read (pair) as bitsets, exonic (HLA) and genomic ones
+                #   Exonic ones are chosen among representative alleles
+                def get_pair_cmpt(read_id, positive_hts):
+                    Gene_count_per_read, Gene_gen_count_per_read = [], []
+                    for positive_ht in positive_hts:
+                        exon_hts = get_exon_haplotypes(positive_ht, ref_exons)
+
+                        if read_id == "aHSQ1008:175:C0JVFACXX:5:1109:17665:21583":
+                            print "positive_ht:", positive_ht, "exon_hts:", exon_hts
+
+                        for exon_ht in exon_hts:
+                            add_count(Gene_count_per_read, exon_ht, 1)
+                        add_count(Gene_gen_count_per_read, positive_ht, 1)
+
+                    # DK - debugging purposes
+                    if read_id.startswith("a30"):
+                        gen_count_per_read = {}
+                        for allele_i in range(len(Gene_allele_names)):
+                            allele = Gene_allele_names[allele_i]
+                            gen_count_per_read[allele] = typing_common.get_bit_counter_value(Gene_gen_count_per_read, allele_i)
+                        print gen_count_per_read
+
+                    cur_cmpt = 0
+                    if base_fname == "hla":
+                        cur_cmpt = typing_common.get_max_bit_counter(Gene_count_per_read, Gene_allele_all_bits) & Gene_allele_rep_bits
+                    cur_cmpt_gen = typing_common.get_max_bit_counter(Gene_gen_count_per_read, Gene_allele_all_bits)
+                    return cur_cmpt, cur_cmpt_gen
+
+                # Gene_cmpt is kept as [counts keyed by bitsets of alleles, bitsets in the order of their first appearance]
+                #   until all the reads are processed
+                Gene_cmpt, Gene_gen_cmpt = [{}, []], [{}, []]
+
+                # Read pairs whose compatible alleles are computed in parallel (see get_pair_cmpts_worker)
+                #   after novel variants are all identified
+                pair_hts_list = []
+                parallel = threads > 1 and not (simulation and verbose >= 2)
+
+                def get_ht_alleles(ht):
                     ht = ht.split('-')
 
                     assert len(ht) >= 2
@@ -491,15 +570,15 @@ def typing(simulation,
                     assert left <= right
 
                     ht = ht[1:-1]
-                    alleles = set(Genes[gene].keys()) - set([ref_allele])
+                    alleles = Gene_allele_all_bits
                     for i in range(len(ht)):
                         var_id = ht[i]
                         if var_id.startswith("nv"):
                             continue
-                        alleles &= set(Links[var_id])
+                        alleles &= get_link_bits(var_id)
                     ht = set(ht)
 
-                    tmp_alleles = set()
+                    tmp_alleles = 0
                     var_idx = typing_common.lower_bound(gene_var_list, right + 1)
                     var_idx = min(var_idx, len(gene_var_list) - 1)
                     while var_idx >= 0:
@@ -515,14 +594,10 @@ def typing(simulation,
                             var_right = var_left + int(var_data) - 1
                         if (var_left >= left and var_left <= right) or \
                            (var_right >= left and var_right <= right):
-                            tmp_alleles |= set(Links[var_id])
+                            tmp_alleles |= get_link_bits(var_id)
                         var_idx -= 1                        
-                    alleles -= tmp_alleles
-                    
-                    for allele in alleles:
-                        count_per_read[allele] += add
-
-                    return len(alleles)
+                    alleles &= ~tmp_alleles
+                    return alleles
 
                 # Identify best pairs
                 def choose_pairs(left_positive_hts, right_positive_hts):
@@ -639,17 +714,16 @@ def typing(simulation,
                 # Positive evidence for left and right reads
                 left_positive_hts, right_positive_hts = set(), set()
                 
-                # Cigar regular expression
-                cigar_re = re.compile('\d+\w')
-                for line in alignview_proc.stdout:
-                    line = line.strip()
-                    cols = line.split()
-                    read_id, flag, chr, pos, mapQ, cigar_str = cols[:6]
+                edit_ops, edit_ref_poss, edit_read_poss, edit_lens, edit_var_idxs = \
+                    [alignments[col] for col in ["edit_op", "edit_ref_pos", "edit_read_pos", "edit_len", "edit_var_idx"]]
+                # Alignments are processed as soon as both mates of a read are seen
+                for aln_i in itertools.chain.from_iterable(typing_common.get_alignment_pairs(alignments, simulation)):
+                    read_id, flag, pos, cigar_str = \
+                        alignments["read_id"][aln_i], alignments["flag"][aln_i], alignments["pos"][aln_i], alignments["cigar"][aln_i]
                     node_read_id = orig_read_id = read_id
                     if simulation:
                         read_id = read_id.split('|')[0]
-                    read_seq, read_qual = cols[9], cols[10]
-                    flag, pos = int(flag), int(pos)
+                    read_seq, read_qual = alignments["seq"][aln_i], alignments["qual"][aln_i]
                     pos -= (base_locus + 1)
                     if pos < 0:
                         continue
@@ -658,7 +732,7 @@ def typing(simulation,
                     if flag & 0x4 != 0:
                         if simulation and verbose >= 2:
                             print "Unaligned"
-                            print "\t", line
+                            print "\t", typing_common.get_alignment_line(alignments, aln_i)
                         continue
 
                     # Concordantly mapped?
@@ -667,17 +741,7 @@ def typing(simulation,
                     else:
                         concordant = False
 
-                    NM, Zs, MD, NH = "", "", "", ""
-                    for i in range(11, len(cols)):
-                        col = cols[i]
-                        if col.startswith("Zs"):
-                            Zs = col[5:]
-                        elif col.startswith("MD"):
-                            MD = col[5:]
-                        elif col.startswith("NM"):
-                            NM = int(col[5:])
-                        elif col.startswith("NH"):
-                            NH = int(col[5:])
+                    NM, MD, NH = alignments["NM"][aln_i], alignments["MD"][aln_i], alignments["NH"][aln_i]
 
                     if NM > num_editdist:
                         continue
@@ -706,210 +770,100 @@ def typing(simulation,
                         if not simulation:
                             node_read_id += '|R'
 
-                    if Zs:
-                        Zs = Zs.split(',')             
-
                     assert MD != ""
-                    MD_str_pos, MD_len = 0, 0
-                    Zs_pos, Zs_i = 0, 0
-                    for _i in range(len(Zs)):
-                        Zs[_i] = Zs[_i].split('|')
-                        Zs[_i][0] = int(Zs[_i][0])
-                    if Zs_i < len(Zs):
-                        Zs_pos += Zs[Zs_i][0]
                     read_pos, left_pos = 0, pos
                     right_pos = left_pos
-                    cigars = cigar_re.findall(cigar_str)
-                    cigars = [[cigar[-1], int(cigar[:-1])] for cigar in cigars]
                     cmp_list = []
                     num_error_correction = 0
                     likely_misalignment = False
 
-                    # Extract variants w.r.t backbone from CIGAR string
+                    # Extract variants w.r.t backbone from edit operations (decoded from CIGAR, MD, and Zs)
                     softclip = [0, 0]
-                    for i in range(len(cigars)):
-                        cigar_op, length = cigars[i]
-                        if cigar_op == 'M':
-                            first = True
-                            MD_len_used = 0
-                            cmp_list_i = len(cmp_list)
-                            while True:
-                                if not first or MD_len == 0:
-                                    if MD[MD_str_pos].isdigit():
-                                        num = int(MD[MD_str_pos])
-                                        MD_str_pos += 1
-                                        while MD_str_pos < len(MD):
-                                            if MD[MD_str_pos].isdigit():
-                                                num = num * 10 + int(MD[MD_str_pos])
-                                                MD_str_pos += 1
-                                            else:
-                                                break
-                                        MD_len += num
-                                # Insertion or full match followed
-                                if MD_len >= length:
-                                    MD_len -= length
-                                    if length > MD_len_used:
-                                        cmp_list.append(["match", right_pos + MD_len_used, length - MD_len_used])
-                                    break
-                                first = False
-                                read_base = read_seq[read_pos + MD_len]
-                                MD_ref_base = MD[MD_str_pos]
-                                MD_str_pos += 1
-                                assert MD_ref_base in "ACGT"
-                                if MD_len > MD_len_used:
-                                    cmp_list.append(["match", right_pos + MD_len_used, MD_len - MD_len_used])
-
-                                _var_id = "unknown"
-                                if read_pos + MD_len == Zs_pos and Zs_i < len(Zs):
-                                    assert Zs[Zs_i][1] == 'S'
-                                    _var_id = Zs[Zs_i][2]
-                                    Zs_i += 1
-                                    Zs_pos += 1
-                                    if Zs_i < len(Zs):
-                                        Zs_pos += Zs[Zs_i][0]
-                                else:
-                                    # Search for a known (yet not indexed) variant or a novel variant
-                                    ref_pos = right_pos + MD_len
-                                    var_idx = typing_common.lower_bound(gene_var_list, ref_pos)
-                                    while var_idx < len(gene_var_list):
-                                        var_pos, var_id = gene_var_list[var_idx]
-                                        if var_pos > ref_pos:
-                                            break
-                                        if var_pos == ref_pos:
-                                            var_type, _, var_data = gene_vars[var_id]
-                                            if var_type == "single" and var_data == read_base:
-                                                _var_id = var_id
-                                                break
-                                        var_idx += 1
-
-                                cmp_list.append(["mismatch", right_pos + MD_len, 1, _var_id])
-                                MD_len_used = MD_len + 1
-                                MD_len += 1
-                                # Full match
-                                if MD_len == length:
-                                    MD_len = 0
-                                    break
-
-                            # Correction for sequencing errors and update for cmp_list
-                            if error_correction:
-                                assert cmp_list_i < len(cmp_list)
-                                new_cmp_list, read_seq, _num_error_correction = error_correct(ref_seq,
-                                                                                              read_seq,
-                                                                                              read_pos,
-                                                                                              mpileup,
-                                                                                              gene_vars,
-                                                                                              gene_var_list,
-                                                                                              cmp_list[cmp_list_i:],
-                                                                                              node_read_id == "aHSQ1008:175:C0JVFACXX:5:1109:17665:21583|L")
-                                cmp_list = cmp_list[:cmp_list_i] + new_cmp_list
-                                num_error_correction += _num_error_correction
-
-                        elif cigar_op == 'I':
-                            _var_id = "unknown"
-                            if read_pos == Zs_pos and Zs_i < len(Zs):
-                                assert Zs[Zs_i][1] == 'I'
-                                _var_id = Zs[Zs_i][2]
-                                Zs_i += 1
-                                if Zs_i < len(Zs):
-                                    Zs_pos += Zs[Zs_i][0]
+                    edit_begin, edit_end = alignments["edit_offset"][aln_i], alignments["edit_offset"][aln_i + 1]
+                    for edit_i in range(edit_begin, edit_end):
+                        edit_op, length, var_idx = edit_ops[edit_i], edit_lens[edit_i], edit_var_idxs[edit_i]
+                        assert edit_ref_poss[edit_i] == right_pos and edit_read_poss[edit_i] == read_pos
+                        M_begin = edit_op in [typing_common.EDIT_MATCH, typing_common.EDIT_MISMATCH] and \
+                                  (edit_i == edit_begin or edit_ops[edit_i - 1] not in [typing_common.EDIT_MATCH, typing_common.EDIT_MISMATCH])
+                        M_end = edit_op in [typing_common.EDIT_MATCH, typing_common.EDIT_MISMATCH] and \
+                                (edit_i + 1 == edit_end or edit_ops[edit_i + 1] not in [typing_common.EDIT_MATCH, typing_common.EDIT_MISMATCH])
+                        if M_begin:
+                            M_read_pos, cmp_list_i = read_pos, len(cmp_list)
+
+                        if edit_op == typing_common.EDIT_MATCH:
+                            cmp_list.append(["match", right_pos, length])
+
+                        elif edit_op == typing_common.EDIT_MISMATCH:
+                            if var_idx >= 0:
+                                _var_id = Zs_var_ids[var_idx]
                             else:
                                 # Search for a known (yet not indexed) variant or a novel variant
-                                var_idx = typing_common.lower_bound(gene_var_list, right_pos)
-                                while var_idx < len(gene_var_list):
-                                    var_pos, var_id = gene_var_list[var_idx]
-                                    if var_pos > right_pos:
-                                        break
-                                    if var_pos == right_pos:
-                                        var_type, _, var_data = gene_vars[var_id]
-                                        if var_type == "insertion" and len(var_data) == length:
-                                            _var_id = var_id
-                                            break
-                                    var_idx += 1                            
+                                _var_id = gene_var_table.get(("single", right_pos, read_seq[read_pos]), "unknown")
+                            cmp_list.append(["mismatch", right_pos, 1, _var_id])
+
+                        elif edit_op == typing_common.EDIT_INSERTION:
+                            if var_idx >= 0:
+                                _var_id = Zs_var_ids[var_idx]
+                            else:
+                                _var_id = gene_var_table.get(("insertion", right_pos, length), "unknown")
                             cmp_list.append(["insertion", right_pos, length, _var_id])
                             if 'N' in read_seq[read_pos:read_pos+length]:
                                 likely_misalignment = True
                                 
-                        elif cigar_op == 'D':
-                            if MD[MD_str_pos] == '0':
-                                MD_str_pos += 1
-                            assert MD[MD_str_pos] == '^'
-                            MD_str_pos += 1
-                            while MD_str_pos < len(MD):
-                                if not MD[MD_str_pos] in "ACGT":
-                                    break
-                                MD_str_pos += 1
-                            _var_id = "unknown"
-                            if read_pos == Zs_pos and \
-                               Zs_i < len(Zs) and \
-                               Zs[Zs_i][1] == 'D':
-                                _var_id = Zs[Zs_i][2]
-                                Zs_i += 1
-                                if Zs_i < len(Zs):
-                                    Zs_pos += Zs[Zs_i][0]
+                        elif edit_op == typing_common.EDIT_DELETION:
+                            if var_idx >= 0:
+                                _var_id = Zs_var_ids[var_idx]
                             else:
-                                # Search for a known (yet not indexed) variant or a novel variant
-                                var_idx = typing_common.lower_bound(gene_var_list, right_pos)
-                                while var_idx < len(gene_var_list):
-                                    var_pos, var_id = gene_var_list[var_idx]
-                                    if var_pos > right_pos:
-                                        break
-                                    if var_pos == right_pos:
-                                        var_type, _, var_data = gene_vars[var_id]
-                                        if var_type == "deletion" and int(var_data) == length:
-                                            _var_id = var_id
-                                            break
-                                    var_idx += 1
-
+                                _var_id = gene_var_table.get(("deletion", right_pos, length), "unknown")
                             cmp_list.append(["deletion", right_pos, length, _var_id])
 
                             # Check if this deletion is artificial alignment
                             if right_pos < len(mpileup):
-                                del_count, nt_count = 0, 0
-                                for nt, value in mpileup[right_pos][1].items():
-                                    count = value[0]
-                                    if nt == 'D':
-                                        del_count += count
-                                    else:
-                                        nt_count += count
+                                del_count = mpileup.get_count(right_pos, 'D')
+                                nt_count = mpileup.get_depth(right_pos) - del_count
 
                                 # DK - debugging purposes
                                 if base_fname == "hla":
                                     if del_count * 6 < nt_count: # and nt_count >= 15:
                                         likely_misalignment = True
                             
-                        elif cigar_op == 'S':
-                            if i == 0:
+                        elif edit_op == typing_common.EDIT_SOFTCLIP:
+                            if edit_i == edit_begin:
                                 softclip[0] = length
-                                Zs_pos += length
                             else:
-                                assert i + 1 == len(cigars)
                                 softclip[1] = length
                         else:                    
-                            assert cigar_op == 'N'
+                            assert edit_op == typing_common.EDIT_INTRON
                             assert False
                             cmp_list.append(["intron", right_pos, length])
 
-                        if cigar_op in "MND":
+                        if edit_op in [typing_common.EDIT_MATCH, typing_common.EDIT_MISMATCH, typing_common.EDIT_INTRON, typing_common.EDIT_DELETION]:
                             right_pos += length
 
-                        if cigar_op in "MIS":
+                        if edit_op in [typing_common.EDIT_MATCH, typing_common.EDIT_MISMATCH, typing_common.EDIT_INSERTION, typing_common.EDIT_SOFTCLIP]:
                             read_pos += length
 
-                    # Remove softclip in cigar and modify read_seq and read_qual accordingly
+                        # Correction for sequencing errors and update for cmp_list
+                        if M_end and error_correction:
+                            assert cmp_list_i < len(cmp_list)
+                            new_cmp_list, read_seq, _num_error_correction = error_correct(ref_seq,
+                                                                                          read_seq,
+                                                                                          M_read_pos,
+                                                                                          mpileup,
+                                                                                          gene_var_table,
+                                                                                          cmp_list[cmp_list_i:],
+                                                                                          node_read_id == "aHSQ1008:175:C0JVFACXX:5:1109:17665:21583|L")
+                            cmp_list = cmp_list[:cmp_list_i] + new_cmp_list
+                            num_error_correction += _num_error_correction
+
+                    # Remove softclip in read_seq and read_qual
                     if sum(softclip) > 0:
                         if softclip[0] > 0:
-                            cigars = cigars[1:]
                             read_seq = read_seq[softclip[0]:]
                             read_qual = read_qual[softclip[0]:]
                         if softclip[1] > 0:
-                            cigars = cigars[:-1]
                             read_seq = read_seq[:-softclip[1]]
                             read_qual = read_qual[:-softclip[1]]
-
-                        cigar_str = ""
-                        for type, length in cigars:
-                            cigar_str += str(length)
-                            cigar_str += type
                    
                     if right_pos > len(ref_seq):
                         continue
@@ -938,12 +892,9 @@ def typing(simulation,
                                     assert type_ == "insertion"
                                     data_ = read_seq[read_pos:read_pos + length_]
                                 if add:
-                                    var_id, novel_var_count = add_novel_var(gene_vars,
-                                                                            gene_var_list,
-                                                                            novel_var_count,
-                                                                            type_ if type_ != "mismatch" else "single",
-                                                                            pos_,
-                                                                            data_)
+                                    var_id = add_novel_var(type_ if type_ != "mismatch" else "single",
+                                                           pos_,
+                                                           data_)
                                     cmp_list[cmp_i][3] = var_id
                             if var_id not in var_count:
                                 var_count[var_id] = 1
@@ -956,147 +907,55 @@ def typing(simulation,
                     # Count the number of reads aligned uniquely with some constraints
                     num_reads += 1
 
-                    def add_stat(Gene_cmpt, Gene_counts, Gene_count_per_read, include_alleles = set()):
-                        max_count = max(Gene_count_per_read.values())
-                        cur_cmpt = set()
-                        for allele, count in Gene_count_per_read.items():
-                            if count < max_count:
-                                continue
-                            if len(include_alleles) > 0 and allele not in include_alleles:
-                                continue
-                            
-                            cur_cmpt.add(allele)                    
-                            if allele not in Gene_counts:
-                                Gene_counts[allele] = 1
-                            else:
-                                Gene_counts[allele] += 1
-
-                        if len(cur_cmpt) == 0:
-                            return ""
-
-                        if verbose >= 2:
-                            alleles = ["", ""]
-                            allele1_found, allele2_found = False, False
-                            if alleles[0] != "":
-                                for allele, count in Gene_count_per_read.items():
-                                    if count < max_count:
-                                        continue
-                                    if allele == alleles[0]:
-                                        allele1_found = True
-                                    elif allele == alleles[1]:
-                                        allele2_found = True
-                                if allele1_found != allele2_found:
-                                    print >> sys.stderr, alleles[0], Gene_count_per_read[alleles[0]]
-                                    print >> sys.stderr, alleles[1], Gene_count_per_read[alleles[1]]
-                                    if allele1_found:
-                                        print >> sys.stderr, ("%s\tread_id %s - %d vs. %d]" % (alleles[0], prev_read_id, max_count, Gene_count_per_read[alleles[1]]))
-                                    else:
-                                        print >> sys.stderr, ("%s\tread_id %s - %d vs. %d]" % (alleles[1], prev_read_id, max_count, Gene_count_per_read[alleles[0]]))
-
-                        cur_cmpt = sorted(list(cur_cmpt))
-                        cur_cmpt = '-'.join(cur_cmpt)
-                        if not cur_cmpt in Gene_cmpt:
-                            Gene_cmpt[cur_cmpt] = 1
-                        else:
-                            Gene_cmpt[cur_cmpt] += 1
-
-                        return cur_cmpt
-
                     if read_id != prev_read_id:
                         if prev_read_id != None:
                             num_pairs += 1
                             if base_fname == "codis" and gene == "D18S51":
                                 left_positive_hts, right_positive_hts = choose_pairs(left_positive_hts, right_positive_hts)
 
-                            for positive_ht in left_positive_hts | right_positive_hts:
-                                exon_hts = get_exon_haplotypes(positive_ht, ref_exons)
-
-                                if prev_read_id == "aHSQ1008:175:C0JVFACXX:5:1109:17665:21583":
-                                    print "positive_ht:", positive_ht, "exon_hts:", exon_hts
-                                    
-                                for exon_ht in exon_hts:
-                                    add_count(Gene_count_per_read, exon_ht, 1)
-                                add_count(Gene_gen_count_per_read, positive_ht, 1)
-
-                            # DK - debugging purposes
-                            if prev_read_id.startswith("a30"):
-                                print Gene_gen_count_per_read
-
-                            # DK - debugging purposes
-                            """
-                            debug_allele_id = "A*02:406"
-                            assert debug_allele_id in Gene_count_per_read
-                            debug_max_read_count = max(Gene_count_per_read.values())
-                            debug_read_count = Gene_count_per_read[debug_allele_id]
-                            if debug_read_count == debug_max_read_count and \
-                               Gene_count_per_read["A*11:01:01:01"] < debug_max_read_count and \
-                               Gene_count_per_read["A*02:01:01:01"] < debug_max_read_count:
-                                print prev_read_id
-                                None
-                            if prev_read_id == "HSQ1008:175:C0JVFACXX:5:1109:17665:21583":
-                                for line in prev_lines:
-                                    print line
-                                print "left_positive_hts :", left_positive_hts
-                                print "right_positive_hts:", right_positive_hts
-                                print "exon:", debug_read_count, "max:", debug_max_read_count
-                                print "gen:", Gene_gen_count_per_read[debug_allele_id], "max:", max(Gene_gen_count_per_read.values())
-
-                                for allele_id, count in Gene_count_per_read.items():
-                                    if count == debug_max_read_count:
-                                        None
-                                        # print "allele max:", allele_id, count
-                                # sys.exit(1)
-                                None
-                            """
-                                
-
-                            cur_cmpt, cur_cmpt_gen = "", ""
-                            if base_fname == "hla":
-                                cur_cmpt = add_stat(Gene_cmpt, Gene_counts, Gene_count_per_read, allele_rep_set)
-                                cur_cmpt_gen = add_stat(Gene_gen_cmpt, Gene_gen_counts, Gene_gen_count_per_read)
+                            cur_cmpt, cur_cmpt_gen = 0, 0
+                            if parallel:
+                                pair_hts_list.append([prev_read_id, left_positive_hts | right_positive_hts])
                             else:
-                                cur_cmpt = add_stat(Gene_gen_cmpt, Gene_gen_counts, Gene_gen_count_per_read)
+                                cur_cmpt, cur_cmpt_gen = get_pair_cmpt(prev_read_id, left_positive_hts | right_positive_hts)
+                                add_cmpt_count(Gene_cmpt, cur_cmpt, 1)
+                                add_cmpt_count(Gene_gen_cmpt, cur_cmpt_gen, 1)
+                                if base_fname != "hla":
+                                    cur_cmpt, cur_cmpt_gen = cur_cmpt_gen, 0
                             for read_id_, read_node in read_nodes:
                                 asm_graph.add_node(read_id_,
                                                    read_node,
                                                    simulation)
                             read_nodes, read_var_list = [], []
-                            if simulation and \
+                            if not parallel and \
+                               simulation and \
                                verbose >= 2 and \
                                base_fname in ["hla", "codis"]:
-                                cur_cmpt = cur_cmpt.split('-') if cur_cmpt != "" else set()
-                                cur_cmpt_gen = cur_cmpt_gen.split('-') if cur_cmpt_gen != "" else set()
-                                show_debug = (partial and cur_cmpt != "" and not set(cur_cmpt) & set(test_Gene_names)) or \
-                                              (not partial and cur_cmpt_gen != "" and not set(cur_cmpt_gen) & set(test_Gene_names))
+                                cur_cmpt = get_alleles_from_bits(cur_cmpt)
+                                cur_cmpt_gen = get_alleles_from_bits(cur_cmpt_gen)
+                                show_debug = (partial and len(cur_cmpt) > 0 and not set(cur_cmpt) & set(test_Gene_names)) or \
+                                              (not partial and len(cur_cmpt_gen) > 0 and not set(cur_cmpt_gen) & set(test_Gene_names))
                                               
                                 if show_debug:
-                                    print "%s are chosen instead of %s" % (cur_cmpt if partial else cur_cmpt_gen, '-'.join(test_Gene_names))
-                                    for prev_line in prev_lines:
-                                        print "\t", prev_line
+                                    print "%s are chosen instead of %s" % ('-'.join(cur_cmpt if partial else cur_cmpt_gen), '-'.join(test_Gene_names))
+                                    for prev_aln_i in prev_lines:
+                                        print "\t", typing_common.get_alignment_line(alignments, prev_aln_i)
 
                             prev_lines = []
 
                         left_positive_hts, right_positive_hts = set(), set()
-                        
-                        Gene_count_per_read, Gene_gen_count_per_read = {}, {}
-                        for Gene_name in Gene_names[gene]:
-                            if Gene_name.find("BACKBONE") != -1:
-                                continue
-                            Gene_count_per_read[Gene_name] = 0
-                            Gene_gen_count_per_read[Gene_name] = 0
 
-                    prev_lines.append(line)
+                    prev_lines.append(aln_i)
 
                     # Remove mismatches due to unknown or novel variants
                     cmp_list2 = []
                     for cmp in cmp_list:
-                        cmp = deepcopy(cmp)
                         type, pos, length = cmp[:3]
                         if type == "match":
                             if len(cmp_list2) > 0 and cmp_list2[-1][0] == "match":
                                 cmp_list2[-1][2] += length
                             else:
-                                cmp_list2.append(cmp)
+                                cmp_list2.append(cmp[:])
                         elif type == "mismatch" and \
                              (cmp[3] == "unknown" or cmp[3].startswith("nv")):
                             if len(cmp_list2) > 0 and cmp_list2[-1][0] == "match":
@@ -1144,7 +1003,7 @@ def typing(simulation,
                     DK_debug = False
                     if orig_read_id.startswith("a30|R"):
                         DK_debug = True
-                        print line
+                        print typing_common.get_alignment_line(alignments, aln_i)
                         print cmp_list
                         print "positive hts:", left_positive_hts, right_positive_hts
                         print "cmp_list [%d, %d]" % (cmp_list_left, cmp_list_right)
@@ -1212,21 +1071,50 @@ def typing(simulation,
                     num_pairs += 1
                     if base_fname == "codis" and gene == "D18S51":
                         left_positive_hts, right_positive_hts = choose_pairs(left_positive_hts, right_positive_hts)                            
-                    for positive_ht in left_positive_hts | right_positive_hts:
-                        exon_hts = get_exon_haplotypes(positive_ht, ref_exons)
-                        for exon_ht in exon_hts:
-                            add_count(Gene_count_per_read, exon_ht, 1)
-                        add_count(Gene_gen_count_per_read, positive_ht, 1)
-
-                    if base_fname == "hla":
-                        add_stat(Gene_cmpt, Gene_counts, Gene_count_per_read, allele_rep_set)
-                    add_stat(Gene_gen_cmpt, Gene_gen_counts, Gene_gen_count_per_read)
+                    if parallel:
+                        pair_hts_list.append([prev_read_id, left_positive_hts | right_positive_hts])
+                    else:
+                        cur_cmpt, cur_cmpt_gen = get_pair_cmpt(prev_read_id, left_positive_hts | right_positive_hts)
+                        add_cmpt_count(Gene_cmpt, cur_cmpt, 1)
+                        add_cmpt_count(Gene_gen_cmpt, cur_cmpt_gen, 1)
                     for read_id_, read_node in read_nodes:
                         asm_graph.add_node(read_id_,
                                            read_node,
                                            simulation)
                     read_nodes, read_var_list = [], []
 
+                # Chunks of read pairs are processed by worker processes, and their counts are merged in order
+                if parallel and len(pair_hts_list) > 0:
+                    chunk_size = (len(pair_hts_list) + threads * 4 - 1) / (threads * 4)
+                    pair_hts_chunks = [pair_hts_list[i:i+chunk_size] for i in range(0, len(pair_hts_list), chunk_size)]
+                    pool = multiprocessing.Pool(threads,
+                                                initializer = init_pair_cmpt_worker,
+                                                initargs = (get_pair_cmpt,))
+                    for chunk_cmpt, chunk_gen_cmpt in pool.imap(get_pair_cmpts_worker, pair_hts_chunks):
+                        for cmpt, count in chunk_cmpt:
+                            add_cmpt_count(Gene_cmpt, cmpt, count)
+                        for cmpt, count in chunk_gen_cmpt:
+                            add_cmpt_count(Gene_gen_cmpt, cmpt, count)
+                    pool.close()
+                    pool.join()
+                    pair_hts_list = []
+
+                # Convert bitsets of alleles into allele names (e.g. A*01:01:01:01-A*01:01:01:02N)
+                def get_named_cmpt(Gene_cmpt, Gene_counts):
+                    Gene_cmpt_ = {}
+                    for cmpt_bits in Gene_cmpt[1]:
+                        count = Gene_cmpt[0][cmpt_bits]
+                        alleles = get_alleles_from_bits(cmpt_bits)
+                        for allele in alleles:
+                            if allele not in Gene_counts:
+                                Gene_counts[allele] = count
+                            else:
+                                Gene_counts[allele] += count
+                        Gene_cmpt_['-'.join(alleles)] = count
+                    return Gene_cmpt_
+                Gene_cmpt = get_named_cmpt(Gene_cmpt, Gene_counts)
+                Gene_gen_cmpt = get_named_cmpt(Gene_gen_cmpt, Gene_gen_counts)
+
                 if num_reads <= 0:
                     continue
 
@@ -1436,7 +1324,7 @@ def typing(simulation,
                             if print_output:
                                 if cmp_var_in_exon:
                                     print >> sys.stderr, "\033[94mexon%d\033[00m" % (exon_i + 1),
-                                print >> sys.stderr, cmp_var_id, cmp_var, "\t\t\t", mpileup[cmp_var[1]]
+                                print >> sys.stderr, cmp_var_id, cmp_var, "\t\t\t", mpileup.get_nt_dic(cmp_var[1])
                             var_i += 1; var_j += 1
                             continue
                         if cmp_var[1] <= node_var[1]:
@@ -1447,7 +1335,7 @@ def typing(simulation,
                                             for f_ in [sys.stderr, report_file]:
                                                 print >> f_, "\033[94mexon%d\033[00m" % (exon_i + 1),
                                         for f_ in [sys.stderr, report_file]:
-                                            print >> f_, "***", cmp_var_id, cmp_var, "==", "\t\t\t", mpileup[cmp_var[1]]
+                                            print >> f_, "***", cmp_var_id, cmp_var, "==", "\t\t\t", mpileup.get_nt_dic(cmp_var[1])
                                     mismatches += 1
                             var_i += 1
                         else:
@@ -1456,7 +1344,7 @@ def typing(simulation,
                                     for f_ in [sys.stderr, report_file]:
                                         print >> f_, "\033[94mexon%d\033[00m" % (exon_i + 1),
                                 for f_ in [sys.stderr, report_file]:
-                                    print >> f_, "*** ==", node_var_id, node_var, "\t\t\t", mpileup[node_var[1]]
+                                    print >> f_, "*** ==", node_var_id, node_var, "\t\t\t", mpileup.get_nt_dic(node_var[1])
                             mismatches += 1
                             var_j += 1
                             
@@ -1641,6 +1529,8 @@ def read_backbone_alleles(genotype_genome, refGene_loci, Genes):
 
         
 """
+Replace the backbone sequence of each gene with the allele sequences of the gene
+  (typing_common.AlleleSeqs), made from the backbone sequence and variants on demand
 """
 def read_Gene_alleles_from_vars(Vars, Var_list, Links, Genes):
     for gene_name in Genes:
@@ -1655,26 +1545,12 @@ def read_Gene_alleles_from_vars(Vars, Var_list, Links, Genes):
                     allele_vars[allele_name] = []
                 allele_vars[allele_name].append(var_id)
 
+        allele_seqs = typing_common.AlleleSeqs(backbone_allele_name,
+                                               backbone_seq,
+                                               gene_vars)
         for allele_name, vars in allele_vars.items():
-            seq = ""
-            prev_pos = 0
-            for var_id in vars:
-                type, pos, data = gene_vars[var_id]
-                assert prev_pos <= pos
-                if pos > prev_pos:
-                    seq += backbone_seq[prev_pos:pos]
-                if type == "single":
-                    prev_pos = pos + 1
-                    seq += data
-                elif type == "deletion":
-                    prev_pos = pos + int(data)
-                else:
-                    assert type == "insertion"
-                    seq += data
-                    prev_pos = pos
-            if prev_pos < len(backbone_seq):
-                seq += backbone_seq[prev_pos:]
-            Genes[gene_name][allele_name] = seq
+            allele_seqs.add_allele(allele_name, vars)
+        Genes[gene_name] = allele_seqs
             
     
 """
@@ -1696,9 +1572,13 @@ def read_Gene_alleles(fname, Genes):
 """
 """
 def read_Gene_vars(fname):
+    db, _ = typing_common.read_database_of(fname)
+    if db != None:
+        var_iter = typing_common.iter_database_vars(db, sort = True)
+    else:
+        var_iter = (line.strip().split('\t') for line in open(fname))
     Vars, Var_list = {}, {}
-    for line in open(fname):
-        var_id, var_type, allele, pos, data = line.strip().split('\t')
+    for var_id, var_type, allele, pos, data in var_iter:
         pos = int(pos)
         gene = allele.split('*')[0]
         if not gene in Vars:
@@ -1726,9 +1606,13 @@ def read_Gene_vars_genotype_genome(fname, refGene_loci):
             loci[chr] = []
         loci[chr].append([allele_name, left, right])
         
+    db, _ = typing_common.read_database_of(fname)
+    if db != None:
+        var_iter = typing_common.iter_database_vars(db, sort = True)
+    else:
+        var_iter = (line.strip().split('\t') for line in open(fname))
     Vars, Var_list = {}, {}
-    for line in open(fname):
-        var_id, var_type, var_chr, pos, data = line.strip().split('\t')
+    for var_id, var_type, var_chr, pos, data in var_iter:
         if var_chr not in loci:
             continue
         pos = int(pos)
@@ -1760,6 +1644,12 @@ def read_Gene_vars_genotype_genome(fname, refGene_loci):
 """
 def read_Gene_links(fname):
     Links = {}
+    db, _ = typing_common.read_database_of(fname)
+    if db != None:
+        for var_id, alleles in typing_common.iter_database_links(db):
+            assert not var_id in Links
+            Links[var_id] = alleles
+        return Links
     for line in open(fname):
         var_id, alleles = line.strip().split('\t')
         alleles = alleles.split()
@@ -1794,6 +1684,7 @@ def genotyping_locus(base_fname,
                      error_correction,
                      discordant,
                      display_alleles,
+                     check_allele_seqs,
                      verbose,
                      debug_instr):
     if not os.path.exists("hisatgenotype_db"):
@@ -1877,8 +1768,7 @@ def genotyping_locus(base_fname,
 
     # Read alleles (names and sequences)
     refGenes, refGene_loci = {}, {}
-    for line in open("%s.locus" % (genotype_genome if genotype_genome != "" else base_fname)):
-        fields = line.strip().split()
+    for fields in typing_common.read_locus("%s.locus" % (genotype_genome if genotype_genome != "" else base_fname)):
         if genotype_genome != "" and base_fname != fields[0].lower():
             continue
         if genotype_genome != "":
@@ -1915,7 +1805,8 @@ def genotyping_locus(base_fname,
         read_Gene_alleles_from_vars(Vars, Var_list, Links, Genes)
 
     # Sanity Check
-    if os.path.exists(base_fname + "_backbone.fa") and \
+    if check_allele_seqs and \
+       os.path.exists(base_fname + "_backbone.fa") and \
        os.path.exists(base_fname + "_sequences.fa"):
         Genes2 = {}
         read_Gene_alleles(base_fname + "_backbone.fa", Genes2)
@@ -1936,8 +1827,8 @@ def genotyping_locus(base_fname,
     Gene_lengths = {}
     for Gene_gene, Gene_alleles in Genes.items():
         Gene_lengths[Gene_gene] = {}
-        for allele_name, seq in Gene_alleles.items():
-            Gene_lengths[Gene_gene][allele_name] = len(seq)
+        for allele_name in Gene_alleles.keys():
+            Gene_lengths[Gene_gene][allele_name] = Gene_alleles.get_length(allele_name)
 
     # Test HLA typing
     test_list = []
@@ -2240,6 +2131,10 @@ if __name__ == '__main__':
                         type=str,
                         default="",
                         help="A comma-separated list of alleles to display in HTML (default: empty)")
+    parser.add_argument("--check-allele-seqs",
+                        dest="check_allele_seqs",
+                        action="store_true",
+                        help="Check allele sequences made from variants against <base>_sequences.fa")
 
     args = parser.parse_args()
     if args.locus_list == "":
@@ -2330,6 +2225,7 @@ if __name__ == '__main__':
                      args.error_correction,
                      args.discordant,
                      display_alleles,
+                     args.check_allele_seqs,
                      args.verbose_level,
                      debug)
 
@@ -1,74 +1,64 @@
 #!/usr/bin/env python
 
 import sys
-import math, random
+import math, random, bisect
+from array import array
 from datetime import datetime, date, time
 from collections import deque
 from copy import deepcopy
+import hisatgenotype_typing_common as typing_common
+
+
+# Nucleotides that a node position may represent, indexed by their codes
+#   insertions are represented as 'I' followed by the inserted base
+Node_nts = ["A", "C", "G", "T", "D", "N", "IA", "IC", "IG", "IT"]
+Node_nt_codes = dict([(nt, code) for code, nt in enumerate(Node_nts)])
+NT_D, NT_N, NT_I = Node_nt_codes['D'], Node_nt_codes['N'], Node_nt_codes["IA"] # codes >= NT_I are insertions
+
+# Variant IDs interned into integer indexes that are shared by all the nodes
+Node_var_ids = [""]
+Node_var_index = {"" : 0}
 
 
 #
-def get_major_nt(nt_dic):
-    nt = ''
+def get_var_index(var_id):
+    var_idx = Node_var_index.get(var_id)
+    if var_idx == None:
+        var_idx = len(Node_var_ids)
+        Node_var_index[var_id] = var_idx
+        Node_var_ids.append(var_id)
+    return var_idx
+
+
+# Get the code of the most frequent nucleotide in a row of counts
+def get_major_nt(counts):
+    code = -1
     max_count = 0
-    for tmp_nt, tmp_value in nt_dic.items():
-        tmp_count, tmp_var_id = tmp_value
-        if len(tmp_nt) == 1:
-            assert tmp_nt in "ACGTDN"
-        else:
-            assert len(tmp_nt) == 2 and tmp_nt[0] == 'I' and tmp_nt[1] in "ACGT"
+    for tmp_code in range(len(counts)):
+        tmp_count = counts[tmp_code]
         if tmp_count > max_count:
             max_count = tmp_count
-            nt = tmp_nt
-    if len(nt) == 1:
-        assert nt in "ACGTDN"
-    else:
-        assert len(nt) == 2 and nt[0] == 'I' and nt[1] in "ACGT"
-    return nt                
+            code = tmp_code
+    assert code >= 0
+    return code
 
 
 #
-def match_score(nt_dic1, nt_dic2):
-    sum_1 = sum([count for count, _ in nt_dic1.values()])
-    sum_2 = sum([count for count, _ in nt_dic2.values()])
+def match_score(entries1, entries2):
+    sum_1 = sum([count for _, count, _ in entries1])
+    sum_2 = sum([count for _, count, _ in entries2])
     total1, total2 = sum_1 * 2.0, sum_2 * 2.0
+    counts2 = dict([(code, count) for code, count, _ in entries2])
     best = 0.0
-    for nt in "ACGT":
-        if nt not in nt_dic1 or nt not in nt_dic2:
+    for code, count, _ in entries1:
+        if code >= NT_D or code not in counts2:
             continue
-        tmp_best = nt_dic1[nt][0] / total1 + nt_dic2[nt][0] / total2
+        tmp_best = count / total1 + counts2[code] / total2
         if tmp_best > best:
             best = tmp_best
     return best
 
 
-#
-def get_ungapped_seq(seq):
-    ungapped_seq = []
-    for i in range(len(seq)):
-        nt_dic = seq[i]
-        nt = get_major_nt(nt_dic)
-        if nt == 'D':
-            continue
-        ungapped_seq.append(nt_dic)
-    return ungapped_seq
-
-
-#
-def get_ungapped_seq_pos(seq, pos):
-    tot_del_len, tot_ins_len = 0, 0
-    for i in range(len(seq)):
-        nt_dic = seq[i]
-        nt = get_major_nt(nt_dic)
-        if nt == 'D':
-            tot_del_len += 1
-        elif nt[0] == 'I':
-            tot_ins_len += 1
-        if i - tot_ins_len == pos:
-            return pos - tot_del_len
-    return -1
-
-
 # Get mate node id
 #  HSQ1008:141:D0CC8ACXX:3:2304:4780:36964|L to HSQ1008:141:D0CC8ACXX:3:2304:4780:36964|R or vice versa
 def get_mate_node_id(node_id):
@@ -82,7 +72,24 @@ def get_mate_node_id(node_id):
 
 
 
-class Node:
+class Node(object):
+    __slots__ = ["next",
+                 "id",
+                 "left",
+                 "right",
+                 "ins_len",
+                 "codes",
+                 "counts",
+                 "var_idxs",
+                 "amb",
+                 "qual",
+                 "read_ids",
+                 "mate_ids",
+                 "avg",
+                 "ref_seq",
+                 "ref_vars",
+                 "mpileup"]
+
     # Initialize
     def __init__(self,
                  id,
@@ -103,20 +110,17 @@ class Node:
 
         # sequence that node represents
         #   with information about how the sequence is related to backbone
+        #   codes[i], counts[i], and var_idxs[i] are the major nucleotide at position i,
+        #   its count, and its interned variant ID
+        #   amb[i] holds [counts, var_idxs] of all the nucleotides only where position i is ambiguous
         assert len(seq) == len(var)
         assert len(seq) == len(qual)
-        self.seq = []
-        self.ins_len = 0
-        for s in range(len(seq)):
-            nt = seq[s]
-            if len(nt) == 1:
-                assert nt in "ACGTDN"
-            else:
-                assert len(nt) == 2 and nt[0] == 'I' and nt[1] in "ACGT"
-                self.ins_len += 1                
-            var_id = var[s]
-            self.seq.append({nt : [1, var_id]})
-        self.qual = []
+        self.codes = array('B', [Node_nt_codes[nt] for nt in seq])
+        self.counts = array('l', [1]) * len(seq)
+        self.var_idxs = array('l', [get_var_index(var_id) for var_id in var])
+        self.amb = {}
+        self.ins_len = len(seq) - len([code for code in self.codes if code < NT_I])
+        self.qual = array('B')
         for q in qual:
             if q != '':
                 self.qual.append(max(0, ord(q) / 10 - 3))
@@ -135,19 +139,94 @@ class Node:
 
         self.mpileup = mpileup
 
-        
+
+    # Copy a node, sharing the reference sequence, variants, and mpileup
+    def __deepcopy__(self, memo):
+        node = Node.__new__(Node)
+        for name in Node.__slots__:
+            value = getattr(self, name)
+            if name not in ["ref_seq", "ref_vars", "mpileup"]:
+                value = deepcopy(value, memo)
+            setattr(node, name, value)
+        return node
+
+
+    # Return the length of the sequence including deletions and insertions
+    def __len__(self):
+        return len(self.codes)
+
+
+    # Return the major nucleotide at position i
+    def get_nt(self, i):
+        return Node_nts[self.codes[i]]
+
+
+    # Return nucleotides at position i as a list of [code, count, var_idx]
+    def get_nt_entries(self, i):
+        if i in self.amb:
+            counts, var_idxs = self.amb[i]
+            return [[code, counts[code], var_idxs[code]] for code in range(len(Node_nts)) if counts[code] > 0]
+        return [[self.codes[i], self.counts[i], self.var_idxs[i]]]
+
+
+    # Return nucleotides at position i as a dictionary (e.g. {'C': [1, '']})
+    def get_nt_dic(self, i):
+        nt_dic = {}
+        for code, count, var_idx in self.get_nt_entries(i):
+            nt_dic[Node_nts[code]] = [count, Node_var_ids[var_idx]]
+        return nt_dic
+
+
+    # Add the nucleotides at position j of the other node to position i
+    def add_nt_entries(self, i, other, j):
+        if i not in self.amb:
+            if j not in other.amb and self.codes[i] == other.codes[j]:
+                self.counts[i] += other.counts[j]
+                return
+            counts, var_idxs = array('l', [0]) * len(Node_nts), array('l', [0]) * len(Node_nts)
+            code = self.codes[i]
+            counts[code], var_idxs[code] = self.counts[i], self.var_idxs[i]
+            self.amb[i] = [counts, var_idxs]
+        counts, var_idxs = self.amb[i]
+        for code, count, var_idx in other.get_nt_entries(j):
+            if counts[code] == 0:
+                var_idxs[code] = var_idx
+            counts[code] += count
+        code = get_major_nt(counts)
+        self.codes[i], self.counts[i], self.var_idxs[i] = code, counts[code], var_idxs[code]
+
+
+    # Return positions of the sequence without deletions
+    def get_ungapped_idxs(self):
+        return [i for i in range(len(self.codes)) if self.codes[i] != NT_D]
+
+
+    # Convert a position into the one in the sequence without deletions
+    def get_ungapped_pos(self, pos):
+        tot_del_len, tot_ins_len = 0, 0
+        for i in range(len(self.codes)):
+            code = self.codes[i]
+            if code == NT_D:
+                tot_del_len += 1
+            elif code >= NT_I:
+                tot_ins_len += 1
+            if i - tot_ins_len == pos:
+                return pos - tot_del_len
+        return -1
+
+
     # Check how compatible allele is in regard to read or pair
     def compatible_with_rnode(self, rnode):
         assert False
-        assert rnode.left + len(rnode.seq) <= len(self.seq)
+        assert rnode.left + len(rnode) <= len(self)
         score = 0
-        for i in range(len(rnode.seq)):
-            allele_bp = self.seq[rnode.left + i]
-            read_bp = rnode.seq[i]
+        for i in range(len(rnode)):
+            allele_bp = self.get_nt(rnode.left + i)
+            read_bp = rnode.get_nt(i)
             if allele_bp == read_bp:
                 score += 1
 
-        return float(score) / len(rnode.seq)
+        return float(score) / len(rnode)
 
 
     # Check how nodes overlap with each other without considering deletions
@@ -155,30 +234,29 @@ class Node:
         assert self.left <= other.left
         if self.right < other.left:
             return -1, -1
-        seq = get_ungapped_seq(self.seq)
-        other_seq = get_ungapped_seq(other.seq)
+        seq = self.get_ungapped_idxs()
+        other_seq = other.get_ungapped_idxs()
         add_mm = len(self.mate_ids & other.mate_ids)
-        i_left = get_ungapped_seq_pos(self.seq, other.left - self.left)
+        i_left = self.get_ungapped_pos(other.left - self.left)
         for i in range(i_left - 5, i_left + 6):
             max_mm = 0.012 * (len(seq) - i) # 1 mismatch per 83 bases
             tmp_mm = 0.0
             for j in range(len(other_seq)):
                 if i + j >= len(seq):
                     break
-                nt_dic, other_nt_dic = seq[i+j], other_seq[j]
-                nt, other_nt = get_major_nt(nt_dic), get_major_nt(other_nt_dic)
+                s, other_s = seq[i+j], other_seq[j]
+                code, other_code = self.codes[s], other.codes[other_s]
                 mismatch = 0.0
-                if skipN and (nt == 'N' or other_nt == 'N'):
+                if skipN and (code == NT_N or other_code == NT_N):
                     mismatch = 0.0
-                elif nt != other_nt:
-                    mismatch = 1.0 - match_score(seq[i+j], other_seq[j])
-                    
+                elif code != other_code:
+                    mismatch = 1.0 - match_score(self.get_nt_entries(s), other.get_nt_entries(other_s))
+
                     # Higher penalty for mismatches in variants
-                    nt_var, other_nt_var = nt_dic[nt][1], other_nt_dic[other_nt][1]
-                    if nt_var != other_nt_var:
+                    if self.var_idxs[s] != other.var_idxs[other_s]:
                         mismatch = 5.0
-                        adjust = min(1.0, nt_dic[nt][0] / self.get_avg_cov()) * \
-                                 min(1.0, other_nt_dic[other_nt][0] / other.get_avg_cov())
+                        adjust = min(1.0, self.counts[s] / self.get_avg_cov()) * \
+                                 min(1.0, other.counts[other_s] / other.get_avg_cov())
                         mismatch *= adjust
                         if mismatch < 1.0:
                             mismatch = 1.0
@@ -193,10 +271,10 @@ class Node:
 
             if tmp_mm <= max_mm:
                 return i, min(len(seq) - i, len(other_seq)), tmp_mm
-                
+
         return -1, -1, sys.maxint
 
-    
+
     # Combine two nodes with considering deletions
     def combine_with(self, other):
 
@@ -204,94 +282,65 @@ class Node:
         if self.left > other.left:
             self.print_info()
             other.print_info()
-        
+
         assert self.left <= other.left
 
         # Merge two sequences
-        assert len(other.seq) > 0 and 'D' not in other.seq[0].keys()
-        j = 0        
+        assert len(other) > 0 and NT_D not in [code for code, _, _ in other.get_nt_entries(0)]
+        j = 0
         # Merge the overlapped parts
         if self.right >= other.left:
             overlap, ins_len = False, 0
-            for i in range(len(self.seq)):
-                nt_dic = self.seq[i]
-                nt = get_major_nt(nt_dic)
-                if nt.startswith('I'):
+            for i in range(len(self.codes)):
+                if self.codes[i] >= NT_I:
                     ins_len += 1
                 if i == other.left - self.left + ins_len:
                     overlap = True
                     break
             assert overlap
-            new_seq = self.seq[:i]
-            while i < len(self.seq) and j < len(other.seq):
-                nt_dic, nt_dic2 = self.seq[i], other.seq[j]
-                for nt, value in nt_dic2.items():
-                    count, var_id = value
-                    if nt in nt_dic:
-                        nt_dic[nt][0] += count
-                        # if nt != 'D':
-                        #    assert nt_dic[nt][1] == var_id
-                    else:
-                        nt_dic[nt] = [count, var_id]
-                new_seq.append(nt_dic)
+            while i < len(self.codes) and j < len(other.codes):
+                self.add_nt_entries(i, other, j)
                 i += 1
                 j += 1
-            # this node contains the other node
-            if i < len(self.seq):
-                new_seq += self.seq[i:]
         # Fill in the gap between the two nodes if exists
         else:
-            new_seq = self.seq[:]
-            sum_1 = sum([count for count, _ in self.seq[-1].values()])
-            sum_2 = sum([count for count, _ in other.seq[0].values()])
-            flank_cov = (sum_1 + sum_2) / 2.0
-            for k in range(other.left - self.right - 1):
-                ref_nt_dic = self.mpileup[k + 1 + self.right][1]
-                nt_dic = {}
-                # Fill in the gap with Ns for now
-                if len(ref_nt_dic) == 0 or True:
-                    nt_dic = {'N' : [1, ""]}
-                else:
-                    weight = flank_cov / max(1.0, sum([count for count, _ in ref_nt_dic.values()]))
-                    for nt, value in ref_nt_dic.items():
-                        count, var_id = value
-                        nt_dic[nt] = [count * weight, var_id]
-                new_seq.append(nt_dic)
+            # Fill in the gap with Ns for now
+            gap_len = other.left - self.right - 1
+            self.codes.extend(array('B', [NT_N]) * gap_len)
+            self.counts.extend(array('l', [1]) * gap_len)
+            self.var_idxs.extend(array('l', [0]) * gap_len)
+            self.qual.extend(array('B', [0]) * gap_len)
 
         # Append the rest of the other sequence to it
-        if j < len(other.seq):
-            new_seq += deepcopy(other.seq[j:])
+        if j < len(other.codes):
+            offset = len(self.codes) - j
+            self.codes.extend(other.codes[j:])
+            self.counts.extend(other.counts[j:])
+            self.var_idxs.extend(other.var_idxs[j:])
+            self.qual.extend(other.qual[j:])
+            for p, (counts, var_idxs) in other.amb.items():
+                if p >= j:
+                    self.amb[p + offset] = [array('l', counts), array('l', var_idxs)]
         self.read_ids |= other.read_ids
         self.mate_ids |= other.mate_ids
 
-        self.seq = new_seq
-        self.ins_len = 0
-        for i in range(len(self.seq)):
-            nt_dic = self.seq[i]
-            nt = get_major_nt(nt_dic)
-            if nt[0] == 'I':
-                self.ins_len += 1
-        self.right = self.left + len(self.seq) - 1 - self.ins_len
-        
+        self.ins_len = len(self.codes) - len([code for code in self.codes if code < NT_I])
+        self.right = self.left + len(self.codes) - 1 - self.ins_len
+
         # Update coverage
         self.calculate_avg_cov()
 
 
     # Return the length of the ungapped sequence
     def ungapped_length(self):
-        return len(get_ungapped_seq(self.seq))
+        return len(self.codes) - self.codes.count(NT_D)
 
 
     # Contains Ns?
     def contain_Ns(self):
-        for i in range(len(self.seq)):
-            nt_dic = self.seq[i]
-            nt = get_major_nt(nt_dic)
-            if nt == 'N':
-                return True
-        return False
+        return NT_N in self.codes
+
 
-    
     # Get variant ids
     def get_var_ids(self, left = 0, right = sys.maxint):
         vars = []
@@ -300,15 +349,16 @@ class Node:
         ins_len = 0
         for pos in range(left, right + 1):
             var_i = pos - self.left + ins_len
-            while var_i < len(self.seq):
-                nt_dic = self.seq[var_i]
-                nt = get_major_nt(nt_dic)
+            while var_i < len(self.codes):
+                s = var_i
+                nt = self.get_nt(var_i)
                 if nt.startswith('I'):
                     var_i += 1
                     ins_len += 1
                 else:
-                    break            
-            for _, var in nt_dic.values():
+                    break
+            for _, _, var_idx in self.get_nt_entries(s):
+                var = Node_var_ids[var_idx]
                 if var == "" or \
                    var == "unknown":
                     continue
@@ -323,7 +373,7 @@ class Node:
 
         return vars
 
-    
+
     # Get variant ids
     #   left, right are absolute coordinates
     def get_vars(self, left = 0, right = sys.maxint):
@@ -336,13 +386,13 @@ class Node:
             if pos <= skip_pos:
                 continue
             var_i = pos - self.left + ins_len
-            while var_i < len(self.seq):
-                nt_dic = self.seq[var_i]
-                nt = get_major_nt(nt_dic)
+            while var_i < len(self.codes):
+                s = var_i
+                nt = self.get_nt(var_i)
                 if nt.startswith('I'):
                     var_i += 1
                     ins_len += 1
-                    var = nt_dic[nt][1]
+                    var = Node_var_ids[self.var_idxs[s]]
                     if len(vars) > 0 and var != vars[-1][0]:
                         vars.append([var, pos])
                 else:
@@ -351,25 +401,26 @@ class Node:
                 continue
             if nt == 'N':
                 vars.append(["gap", pos])
-                continue            
+                continue
             added = False
-            for _, var in nt_dic.values():
+            var_ids = [Node_var_ids[var_idx] for _, _, var_idx in self.get_nt_entries(s)]
+            for var in var_ids:
                 if var == "" or \
                    var == "unknown":
                     continue
                 if len(vars) > 0 and var == vars[-1][0]:
                     continue
                 assert var in self.ref_vars
-                type, var_pos, data = self.ref_vars[var]                    
+                type, var_pos, data = self.ref_vars[var]
                 if data == nt or (type == "deletion" and nt == 'D'):
                     assert pos >= var_pos
                     if type == "deletion" and pos > var_pos:
-                        continue                    
+                        continue
                     if type == "deletion":
                         skip_pos = pos + int(data) - 1
                     added = True
                     vars.append([var, pos])
-            if not added and "unknown" in [var_id for _, var_id in nt_dic.values()]:
+            if not added and "unknown" in var_ids:
                 vars.append(["unknown", pos])
 
         return vars
@@ -379,29 +430,28 @@ class Node:
     def get_avg_cov(self):
         return self.avg
 
-    
+
     # Calculate average coverage
     def calculate_avg_cov(self):
-        self.avg = 0.0
-        for nt_dic in self.seq:
-            for count, _ in nt_dic.values():
-                self.avg += count
-        self.avg /= len(self.seq)
+        self.avg = float(sum(self.counts))
+        for i, (counts, _) in self.amb.items():
+            self.avg += (sum(counts) - self.counts[i])
+        self.avg /= len(self.codes)
         return self.avg
 
-        
+
     # Display node information
     def print_info(self, output=sys.stderr):
         seq, var_str = "", ""
         prev_var = ""
         ins_len = 0
-        for i in range(len(self.seq)):
+        for i in range(len(self.codes)):
             if (self.left + i - ins_len) % 100 == 0:
                 seq += ("|%d|" % (self.left + i - ins_len))
             elif (self.left + i - ins_len) % 20 == 0:
                 seq += '|'
-            nt_dic = self.seq[i]
-            nt = get_major_nt(nt_dic)
+            nt_dic = self.get_nt_dic(i)
+            nt = self.get_nt(i)
             if nt[0] == 'I':
                 seq += "\033[93m"
             elif nt != self.ref_seq[self.left + i - ins_len]:
@@ -428,7 +478,7 @@ class Node:
             prev_var = var
             if nt[0] == 'I':
                 ins_len += 1
-        
+
         print >> output, "Node ID:", self.id
         print >> output, "Pos: [%d, %d], Avg. coverage: %.1f" % (self.left, self.right, self.get_avg_cov())
         print >> output, "\t", seq
@@ -548,126 +598,115 @@ class Graph:
 
         node_seq = {}
         for id, node in self.nodes.items():
-            s, seq = 0, []
-            while s < len(node.seq):
-                nt_dic = node.seq[s] # {'C': [1, '']}
-                nt = get_major_nt(nt_dic)
-                if nt in "ACGTND":
-                    seq.append(nt)
-                else:
-                    assert len(nt) == 2 and nt[0] == 'I' and nt[1] in "ACGT"
-                s += 1
-
+            seq = ''.join([Node_nts[code] for code in node.codes if code < NT_I])
             if len(seq) < k:
                 continue
 
-            def leftshift(seq, ref_seq):
-                seq_len = len(seq)
-                assert seq_len > 0 and seq[0] != 'D'
+            if DRB1_debug:
+                ref_seq = self.backbone[node.left:node.left + len(seq)]
+                seq = typing_common.leftshift_deletions(ref_seq, [seq], 'D')[0]
+            node_seq[id] = seq
 
-                bp_i = 0
-                while bp_i < seq_len:
-                    bp = seq[bp_i]
-                    if bp != 'D':
-                        bp_i += 1
-                        continue
-                    bp_j = bp_i + 1
-                    while bp_j < seq_len:
-                        bp2 = seq[bp_j]
-                        if bp2 != 'D':
-                            break
-                        else:
-                            bp_j += 1
+        def node_cmp(a, b):
+            if a[1] != b[1]:
+                return a[1] - b[1]
+            else:
+                return a[2] - b[2]
+        nodes = [[id, node.left, node.right] for id, node in self.nodes.items() if id in node_seq]
+        nodes = sorted(nodes, cmp=node_cmp)
 
-                    if bp_j >= seq_len:
-                        bp_i = bp_j
+        # Generate numerical read IDs
+        #   numerical IDs are kept across iterations so that unaffected parts of the graph can be reused
+        id_to_num = {}
+        num_to_id = []
+        for id in [node[0] for node in nodes]:
+            id_to_num[id] = len(id_to_num)
+            num_to_id.append(id)
+        node_present = [True] * len(num_to_id)
+        node_left = [self.nodes[id].left for id in num_to_id]
+        node_kmer_right = [self.nodes[id].left + len(node_seq[id]) - k for id in num_to_id]
+        node_codes = [array('B', [Node_nt_codes[nt] for nt in node_seq[id]]) for id in num_to_id]
+
+        # k-mers are packed into integers, three bits per base as bases include 'D' and 'N'
+        kmer_mask = (1 << (3 * k)) - 1
+        k_m1_mer_mask = (1 << (3 * (k - 1))) - 1
+        def get_kmer(codes, s):
+            kmer = 0
+            for code in codes[s:s+k]:
+                kmer = (kmer << 3) | code
+            return kmer
+
+        # De Bruijn graph with 60-mer
+        #   kmer_index[pos] maps a k-mer to its vertex at pos
+        #   suffix_index[pos] maps the last (k-1) bases of k-mers to their vertices at pos
+        self.debruijn = debruijn = [[] for i in range(len(self.backbone) - k + 1)]
+        kmer_index = [{} for i in range(len(debruijn))]
+        suffix_index = [{} for i in range(len(debruijn))]
+        node_starts = [[] for i in range(len(debruijn))]
+        for n in range(len(num_to_id)):
+            if node_left[n] < len(debruijn):
+                node_starts[node_left[n]].append(n)
+
+        # (Re)construct De Bruijn graph from a given position
+        #   a read stops contributing k-mers once another read further down the sorted list has ended
+        def build_DeBruijn(min_pos):
+            end_nums = sorted([n for n in range(len(num_to_id)) if node_present[n]], key=lambda n: node_kmer_right[n])
+            end_i, max_end_num = 0, -1
+            curr_nums, curr_kmers = [], {}
+            for pos in range(min_pos, len(debruijn)):
+                debruijn[pos], kmer_index[pos], suffix_index[pos] = [], {}, {}
+                ended = False
+                while end_i < len(end_nums) and node_kmer_right[end_nums[end_i]] <= pos - 1:
+                    ended = True
+                    if node_kmer_right[end_nums[end_i]] == pos - 1:
                         break
+                    max_end_num = max(max_end_num, end_nums[end_i])
+                    end_i += 1
+                if pos == min_pos:
+                    for n in range(bisect.bisect_right(node_left, pos)):
+                        if node_present[n] and n > max_end_num and node_kmer_right[n] >= pos:
+                            curr_nums.append(n)
+                            curr_kmers[n] = get_kmer(node_codes[n], pos - node_left[n])
+                else:
+                    if ended:
+                        curr_nums = [n for n in curr_nums if n > max_end_num and node_kmer_right[n] >= pos]
+                    for n in curr_nums:
+                        code = node_codes[n][pos - node_left[n] + k - 1]
+                        curr_kmers[n] = ((curr_kmers[n] << 3) | code) & kmer_mask
+                    for n in node_starts[pos]:
+                        if node_present[n]:
+                            curr_nums.append(n)
+                            curr_kmers[n] = get_kmer(node_codes[n], 0)
+
+                # Add a new vertex or update the De Bruijn graph
+                curr_vertices = debruijn[pos]
+                for n in curr_nums:
+                    kmer = curr_kmers[n]
+                    v = kmer_index[pos].get(kmer)
+                    if v != None:
+                        curr_vertices[v][3].append(n)
+                        continue
 
-                    prev_i, prev_j = bp_i, bp_j
-                    while bp_i > 0 and seq[bp_i-1] in "ACGT" and ref_seq[bp_j-1] in "ACGT":
-                        if seq[bp_i-1] != ref_seq[bp_j-1]:
-                            break
-                        seq[bp_j-1] = seq[bp_i-1]
-                        seq[bp_i-1] = 'D'
-                        bp_i -= 1
-                        bp_j -= 1
-                    bp_i = bp_j
-                    while bp_i < seq_len:
-                        if seq[bp_i] in "ACGT":
-                            break
-                        bp_i += 1
-
-            if DRB1_debug:
-                leftshift(seq, self.backbone[node.left:node.left + len(seq)])
-            node_seq[id] = seq
+                    predecessors = []
+                    if pos > 0:
+                        predecessors = suffix_index[pos - 1].get(kmer >> 3, [])[:]
+                    s = pos - node_left[n]
+                    kmer_seq = node_seq[num_to_id[n]][s:s+k]
+                    assert len(kmer_seq) == k
+                    kmer_index[pos][kmer] = len(curr_vertices)
+                    suffix_index[pos].setdefault(kmer & k_m1_mer_mask, []).append(len(curr_vertices))
+                    curr_vertices.append([kmer_seq[-1],  # base
+                                          kmer_seq[:-1], # (k-1)-mer
+                                          predecessors,  # predecessors
+                                          [n]])          # numeric read IDs
 
         try_hard = False
+        min_pos = 0
         while True:
             delete_ids = set()
-            nodes = []
-            for id, node in self.nodes.items():
-                seq = node_seq[id]
-                if len(seq) < k:
-                    continue
-                kmer, seq = seq[:k], seq[k:]
-                nodes.append([id, node.left, node.right, kmer, seq])
-                
-            def node_cmp(a, b):
-                if a[1] != b[1]:
-                    return a[1] - b[1]
-                else:
-                    return a[2] - b[2]
-            nodes = sorted(nodes, cmp=node_cmp)
-
-            # Generate numerical read IDs
-            id_to_num = {}
-            num_to_id = []
-            for id in [node[0] for node in nodes]:
-                id_to_num[id] = len(id_to_num)
-                num_to_id.append(id)
-
-            # Construct De Bruijn graph with 60-mer
-            self.debruijn = debruijn = [[] for i in range(len(self.backbone) - k + 1)]
-            min_n = 0
-            for pos in range(len(debruijn)):
-                for n in range(min_n, len(nodes)):
-                    id, node_pos, node_right, kmer, seq = nodes[n]
-                    if node_pos < pos:
-                        min_n = n + 1
-                        continue
-                    elif node_pos > pos:
-                        break
-
-                    assert len(kmer) == k
-
-                    # Add a new node or update the De Bruijn graph
-                    curr_vertices = debruijn[pos]
-                    found = False
-                    kmer_seq = ''.join(kmer)
-                    for v in range(len(curr_vertices)):
-                        cmp_nt, cmp_k_m1_mer = curr_vertices[v][:2]
-                        if kmer_seq == cmp_k_m1_mer + cmp_nt:                        
-                            curr_vertices[v][3].append(n)
-                            found = True
-                            break
 
-                    if not found:
-                        predecessors = []
-                        if pos > 0:
-                            prev_vertices = debruijn[pos - 1]
-                            for v in range(len(prev_vertices)):
-                                cmp_nt, cmp_k_m1_mer = prev_vertices[v][:2]
-                                if kmer_seq[:-1] == cmp_k_m1_mer[1:] + cmp_nt:
-                                    predecessors.append(v)
-                        debruijn[pos].append([kmer_seq[-1],           # base
-                                              ''.join(kmer_seq[:-1]), # (k-1)-mer
-                                              predecessors,           # predecessors
-                                              [n]])                   # numeric read IDs
-
-                    # Update k-mer
-                    if len(seq) > 0:
-                        kmer, seq = kmer[1:] + seq[:1], seq[1:]
-                        nodes[n] = [id, node_pos + 1, node_right, kmer, seq]
+            # Rebuild the graph only from where deleted reads begin
+            build_DeBruijn(min_pos)
 
             # Average number of kmers
             total_kmers = 0
@@ -734,13 +773,13 @@ class Graph:
                                     num_id = num_ids[0]
                                     read_id = num_to_id[num_id]
                                     left, seq = pos - self.nodes[read_id].left, node_seq[read_id]
-                                    seq_right = ''.join(seq[left+k:])
+                                    seq_right = seq[left+k:]
                                     seq_right = seq_right.replace('D', '')
                                     success = True
                                     for num_id2 in vertices[v][3]:
                                         read_id2 = num_to_id[num_id2]
                                         left2, seq2 = pos-self.nodes[read_id2].left, node_seq[read_id2]
-                                        seq2_right = ''.join(seq2[left2+k:])
+                                        seq2_right = seq2[left2+k:]
                                         if seq_right.find(seq2_right) != 0:
                                             success = False
                                             break
@@ -774,9 +813,13 @@ class Graph:
                 else:
                     try_hard = True
 
+            min_pos = len(debruijn)
             for num_id in delete_ids:
                 read_id = num_to_id[num_id]
                 del self.nodes[read_id]
+                del id_to_num[read_id]
+                node_present[num_id] = False
+                min_pos = min(min_pos, node_left[num_id])
 
         # Print De Bruijn graph
         # """
@@ -1249,8 +1292,7 @@ class Graph:
                 id, left, right = nodes[n]
                 node = node_dic[id]
                 if p >= left and p <= right:
-                    nt_dic = node.seq[p - left]
-                    nt = get_major_nt(nt_dic)
+                    nt = node.get_nt(p - left)
                     nts.add(nt)
 
             for n in range(len(nodes)):
@@ -1260,8 +1302,7 @@ class Graph:
                 id, left, right = nodes[n]
                 node = node_dic[id]
                 if p >= left and p <= right:
-                    nt_dic = node.seq[p - left]
-                    nt = get_major_nt(nt_dic)
+                    nt = node.get_nt(p - left)
                     seqs[n].append(nt)
                     if nt != self.backbone[p]:
                         if len(nts) > 1:
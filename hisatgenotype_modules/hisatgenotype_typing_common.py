@@ -22,7 +22,13 @@
 import sys, os, subprocess, re
 import math
 import random
+import time
+import marshal
+import heapq, itertools
+import binascii
+from array import array
 from copy import deepcopy
+from collections import OrderedDict
 from datetime import datetime
 
 
@@ -45,28 +51,133 @@ def reverse_complement(seq):
 
 
 """
+Left-shift deletions (runs of gap) of sequences aligned with a reference sequence
+  as far as the bases moved over the deletions match the reference (e.g. ACGG.T -> ACG.GT)
+  Gap runs of all the sequences are found by a regular expression, and only the runs
+  next to a matching base are shifted.  Sequences not as long as the reference are kept as they are.
 """
-def read_genome(genome_file):
-    chr_dic, chr_names, chr_full_names = {}, [], []
-    chr_name, chr_full_name, sequence = "", "", ""
+def leftshift_deletions(ref_seq, seqs, gap = '.'):
+    gap_re = re.compile("%s+" % re.escape(gap))
+    ref_len = len(ref_seq)
+    shifted_seqs = []
+    for seq in seqs:
+        if len(seq) != ref_len or gap not in seq:
+            shifted_seqs.append(seq)
+            continue
+        new_seq = None
+        for gap_run in gap_re.finditer(seq):
+            i, j = gap_run.span()
+            # Neither leading nor trailing deletions are shifted
+            if i == 0 or j >= ref_len:
+                continue
+            # The base before a run is not changed by shifting the previous runs
+            if seq[i-1] != ref_seq[j-1] or seq[i-1] not in "ACGT":
+                continue
+            if new_seq == None:
+                new_seq = list(seq)
+            while i > 0 and new_seq[i-1] in "ACGT" and new_seq[i-1] == ref_seq[j-1]:
+                new_seq[j-1] = new_seq[i-1]
+                new_seq[i-1] = gap
+                i -= 1
+                j -= 1
+        if new_seq == None:
+            shifted_seqs.append(seq)
+        else:
+            shifted_seqs.append(''.join(new_seq))
+    return shifted_seqs
+
+
+"""
+Iterate over the chromosomes of a genome one at a time,
+  so that only one chromosome sequence is kept in memory
+"""
+def read_genome_iter(genome_file):
+    chr_name, chr_full_name, sequence = "", "", []
     for line in genome_file:
         if line.startswith(">"):
             if chr_name and sequence:
-                chr_dic[chr_name] = sequence
-                chr_names.append(chr_name)
+                yield chr_name, chr_full_name, ''.join(sequence)
             chr_full_name = line.strip()[1:]
             chr_name = line.strip().split()[0][1:]
-            chr_full_names.append(chr_full_name)
-            sequence = ""
+            sequence = []
         else:
-            sequence += line.strip()
+            sequence.append(line.strip())
     if chr_name and sequence:
+        yield chr_name, chr_full_name, ''.join(sequence)
+
+
+"""
+"""
+def read_genome(genome_file):
+    chr_dic, chr_names, chr_full_names = {}, [], []
+    for chr_name, chr_full_name, sequence in read_genome_iter(genome_file):
         chr_dic[chr_name] = sequence
         chr_names.append(chr_name)
         chr_full_names.append(chr_full_name)
     return chr_dic, chr_names, chr_full_names
 
 
+"""
+Read a FASTA index file (e.g. genome.fa.fai)
+"""
+def read_fasta_index(fname):
+    fai = {}
+    for line in open(fname):
+        chr, length, offset, line_bases, line_width = line.strip().split('\t')[:5]
+        fai[chr] = [int(length), int(offset), int(line_bases), int(line_width)]
+    return fai
+
+
+"""
+Get the sequence between left and right (0-based, both inclusive) of a chromosome
+  by seeking to the corresponding offset of an indexed FASTA file
+"""
+def get_fasta_seq(fasta_file, fai, chr, left, right):
+    length, offset, line_bases, line_width = fai[chr]
+    left, right = max(0, left), min(length - 1, right)
+    if left > right:
+        return ""
+    start = offset + left / line_bases * line_width + left % line_bases
+    end = offset + right / line_bases * line_width + right % line_bases + 1
+    fasta_file.seek(start)
+    seq = fasta_file.read(end - start)
+    return seq.replace('\n', '').replace('\r', '')
+
+
+"""
+Get the sequences of ranges, [chr, left, right] (0-based, both inclusive), of an indexed FASTA file
+  The index is read once and the ranges are visited in the order of their file offsets.
+"""
+def get_fasta_seqs(fasta_fname, ranges):
+    fai = read_fasta_index(fasta_fname + ".fai")
+    fasta_file = open(fasta_fname)
+    seqs = [""] * len(ranges)
+    order = [i for i in range(len(ranges)) if ranges[i][0] in fai]
+    order = sorted(order, key=lambda i: (fai[ranges[i][0]][1], ranges[i][1]))
+    for i in order:
+        chr, left, right = ranges[i]
+        seqs[i] = get_fasta_seq(fasta_file, fai, chr, left, right)
+    fasta_file.close()
+    return seqs
+
+
+"""
+Get the header (without '>') of a chromosome in an indexed FASTA file
+"""
+def get_fasta_header(fasta_file, fai, chr):
+    offset = fai[chr][1]
+    buf_len = 1024
+    while True:
+        left = max(0, offset - buf_len)
+        fasta_file.seek(left)
+        lines = fasta_file.read(offset - left).rstrip('\r\n').split('\n')
+        if len(lines) > 1 or left == 0:
+            header = lines[-1].strip()
+            assert header.startswith('>')
+            return header[1:]
+        buf_len *= 2
+
+
 ##################################################
 #   Alleles, variants, haplotypes, etc.
 ##################################################
@@ -93,6 +204,9 @@ def read_allele_sequences(fname):
 """
 """
 def read_variants(fname):
+    db, ext = read_database_of(fname)
+    if db != None:
+        return read_variants_from_database(db, ext == ".index.snp")
     allele_vars = {}
     for line in open(fname):
         var_id, type, allele_name, left, data = line.strip().split()
@@ -108,6 +222,9 @@ def read_variants(fname):
 """
 """
 def read_haplotypes(fname):
+    db, _ = read_database_of(fname)
+    if db != None:
+        return read_haplotypes_from_database(db)
     allele_haplotypes = {}
     for line in open(fname):
         haplotype_id, allele_name, left, right, vars = line.strip().split()
@@ -122,6 +239,12 @@ def read_haplotypes(fname):
 """
 """
 def read_links(fname):
+    db, _ = read_database_of(fname)
+    if db != None:
+        links = []
+        for var_id, allele_names in iter_database_links(db):
+            links.append([var_id, ' '.join(allele_names)])
+        return links
     links = []
     for line in open(fname):
         var_id, allele_names = line.strip().split('\t')
@@ -129,6 +252,263 @@ def read_links(fname):
     return links
 
 
+"""
+Read the fields of each line of a .locus file
+"""
+def read_locus(fname):
+    db, _ = read_database_of(fname)
+    if db != None:
+        return [list(fields) for fields in db["locus"]]
+    locus = []
+    for line in open(fname):
+        locus.append(line.strip().split())
+    return locus
+
+
+##################################################
+#   Compiled database (e.g. hla.db)
+##################################################
+
+
+# Text files compiled into a database
+DATABASE_EXTS = [".snp", ".index.snp", ".haplotype", ".link", ".locus"]
+VAR_TYPES = ["single", "insertion", "deletion"]
+
+
+"""
+Compile the text files of a database (e.g. hla.snp, hla.link) into <base>.db.
+  Allele and backbone names are interned into tables and referred to by their indexes,
+  variant-allele links and haplotype variants are in CSR form (offsets and values),
+  and variants are also ordered by backbone, position, and ID.
+  Numeric columns are arrays so that loading a database costs one block read per section.
+  The file consists of a line with the length of a marshalled header that has
+  the sizes and modification times of the text files and the offsets of sections.
+"""
+def compile_database(base):
+    sources = {}
+    for ext in DATABASE_EXTS:
+        if os.path.exists(base + ext):
+            stat = os.stat(base + ext)
+            sources[ext] = [stat.st_size, stat.st_mtime]
+    if ".snp" not in sources:
+        return
+
+    # Variants
+    var_ids, var_types, var_backbones, var_pos, var_data = [], array('b'), array('i'), array('i'), []
+    backbones, backbone_index = [], {}
+    var_index = {}
+    for line in open(base + ".snp"):
+        var_id, type, backbone, pos, data = line.strip().split('\t')
+        if backbone not in backbone_index:
+            backbone_index[backbone] = len(backbones)
+            backbones.append(backbone)
+        var_index[var_id] = len(var_ids)
+        var_ids.append(var_id)
+        var_types.append(VAR_TYPES.index(type))
+        var_backbones.append(backbone_index[backbone])
+        var_pos.append(int(pos))
+        var_data.append(data)
+    var_order = sorted(range(len(var_ids)), key=lambda i: (var_backbones[i], var_pos[i], var_ids[i]))
+    var_order = array('i', var_order)
+
+    index_vars = array('i')
+    if ".index.snp" in sources:
+        for line in open(base + ".index.snp"):
+            index_vars.append(var_index[line.split('\t')[0]])
+
+    # Variant-allele links
+    alleles, allele_index = [], {}
+    link_var_ids, link_offsets, link_alleles = [], array('i', [0]), array('i')
+    if ".link" in sources:
+        for line in open(base + ".link"):
+            var_id, allele_names = line.strip().split('\t')
+            link_var_ids.append(var_id)
+            for allele_name in allele_names.split():
+                if allele_name not in allele_index:
+                    allele_index[allele_name] = len(alleles)
+                    alleles.append(allele_name)
+                link_alleles.append(allele_index[allele_name])
+            link_offsets.append(len(link_alleles))
+
+    # Haplotypes
+    ht_ids, ht_backbones, ht_left, ht_right = [], array('i'), array('i'), array('i')
+    ht_var_offsets, ht_vars = array('i', [0]), array('i')
+    if ".haplotype" in sources:
+        for line in open(base + ".haplotype"):
+            ht_id, backbone, left, right, vars = line.strip().split()
+            if backbone not in backbone_index:
+                backbone_index[backbone] = len(backbones)
+                backbones.append(backbone)
+            ht_ids.append(ht_id)
+            ht_backbones.append(backbone_index[backbone])
+            ht_left.append(int(left))
+            ht_right.append(int(right))
+            for var_id in vars.split(','):
+                ht_vars.append(var_index[var_id])
+            ht_var_offsets.append(len(ht_vars))
+
+    locus = []
+    if ".locus" in sources:
+        for line in open(base + ".locus"):
+            locus.append(line.strip().split())
+
+    sections = [["backbones", backbones],
+                ["var_ids", var_ids],
+                ["var_types", var_types],
+                ["var_backbones", var_backbones],
+                ["var_pos", var_pos],
+                ["var_data", var_data],
+                ["var_order", var_order],
+                ["index_vars", index_vars],
+                ["alleles", alleles],
+                ["link_var_ids", link_var_ids],
+                ["link_offsets", link_offsets],
+                ["link_alleles", link_alleles],
+                ["ht_ids", ht_ids],
+                ["ht_backbones", ht_backbones],
+                ["ht_left", ht_left],
+                ["ht_right", ht_right],
+                ["ht_var_offsets", ht_var_offsets],
+                ["ht_vars", ht_vars],
+                ["locus", locus]]
+    section_offsets, section_data, offset = {}, [], 0
+    for name, value in sections:
+        if isinstance(value, array):
+            typecode, data = value.typecode, value.tostring()
+        else:
+            typecode, data = "", marshal.dumps(value)
+        section_offsets[name] = [offset, len(data), typecode]
+        section_data.append(data)
+        offset += len(data)
+    header = marshal.dumps({"sources" : sources, "sections" : section_offsets})
+
+    tmp_db_fname = "%s.db.%d.tmp" % (base, os.getpid())
+    db_file = open(tmp_db_fname, 'wb')
+    db_file.write("%d\n" % len(header))
+    db_file.write(header)
+    for data in section_data:
+        db_file.write(data)
+    db_file.close()
+    os.rename(tmp_db_fname, base + ".db")
+
+
+database_cache = {}
+"""
+Read <base>.db through a memory map into a dictionary of sections
+  Return None if the database is absent or older than any of its text files.
+"""
+def read_database(base):
+    db_fname = base + ".db"
+    if not os.path.exists(db_fname):
+        return None
+    db_stat = os.stat(db_fname)
+    # Text files are part of the key so that the database is not served once any of them changes
+    source_stats = []
+    for ext in DATABASE_EXTS:
+        if os.path.exists(base + ext):
+            stat = os.stat(base + ext)
+            source_stats.append((ext, stat.st_size, stat.st_mtime))
+    cache_key = (db_fname, db_stat.st_size, db_stat.st_mtime, tuple(source_stats))
+    if cache_key in database_cache:
+        return database_cache[cache_key]
+    db_file = open(db_fname, 'rb')
+    header_len = int(db_file.readline())
+    header = marshal.loads(db_file.read(header_len))
+    for ext in DATABASE_EXTS:
+        if not os.path.exists(base + ext):
+            if ext in header["sources"]:
+                db_file.close()
+                return None
+            continue
+        stat = os.stat(base + ext)
+        if header["sources"].get(ext) != [stat.st_size, stat.st_mtime]:
+            db_file.close()
+            return None
+    begin = db_file.tell()
+    db = {}
+    for name, (offset, length, typecode) in sorted(header["sections"].items(), key=lambda section: section[1][0]):
+        db_file.seek(begin + offset)
+        if typecode == "":
+            db[name] = marshal.loads(db_file.read(length))
+        else:
+            db[name] = array(typecode)
+            db[name].fromfile(db_file, length / db[name].itemsize)
+    db_file.close()
+    database_cache.clear()
+    database_cache[cache_key] = db
+    return db
+
+
+"""
+Read the database of a text file (e.g. hla.link -> hla.db)
+  Return the database (None if not available) and the extension of the text file
+"""
+def read_database_of(fname):
+    for ext in [".index.snp"] + DATABASE_EXTS:
+        if fname.endswith(ext):
+            return read_database(fname[:-len(ext)]), ext
+    return None, ""
+
+
+"""
+Iterate over variants, [ID, type, backbone name, position, data], in the order of
+  the .snp file, the .index.snp file (index_only), or backbones and positions (sort)
+"""
+def iter_database_vars(db, index_only = False, sort = False):
+    var_ids, var_types, var_backbones, var_pos, var_data = \
+        db["var_ids"], db["var_types"], db["var_backbones"], db["var_pos"], db["var_data"]
+    backbones = db["backbones"]
+    if index_only:
+        var_indexes = db["index_vars"]
+    elif sort:
+        var_indexes = db["var_order"]
+    else:
+        var_indexes = xrange(len(var_ids))
+    for i in var_indexes:
+        yield var_ids[i], VAR_TYPES[var_types[i]], backbones[var_backbones[i]], var_pos[i], var_data[i]
+
+
+"""
+Variants of each backbone as read_variants returns
+"""
+def read_variants_from_database(db, index_only = False):
+    allele_vars = {}
+    for var_id, type, allele_name, left, data in iter_database_vars(db, index_only):
+        if type == "deletion":
+            data = int(data)
+        if allele_name not in allele_vars:
+            allele_vars[allele_name] = []
+        allele_vars[allele_name].append([left, type, data, var_id])
+    return allele_vars
+
+
+"""
+Haplotypes of each backbone as read_haplotypes returns
+"""
+def read_haplotypes_from_database(db):
+    var_ids, backbones = db["var_ids"], db["backbones"]
+    ht_backbones, ht_left, ht_right = db["ht_backbones"], db["ht_left"], db["ht_right"]
+    ht_var_offsets, ht_vars = db["ht_var_offsets"], db["ht_vars"]
+    allele_haplotypes = {}
+    for h in xrange(len(ht_backbones)):
+        allele_name = backbones[ht_backbones[h]]
+        vars = map(var_ids.__getitem__, ht_vars[ht_var_offsets[h]:ht_var_offsets[h+1]])
+        if allele_name not in allele_haplotypes:
+            allele_haplotypes[allele_name] = []
+        allele_haplotypes[allele_name].append([ht_left[h], ht_right[h], vars])
+    return allele_haplotypes
+
+
+"""
+Iterate over variants and the names of their alleles
+"""
+def iter_database_links(db):
+    alleles, link_var_ids = db["alleles"], db["link_var_ids"]
+    link_offsets, link_alleles = db["link_offsets"], db["link_alleles"]
+    for l in xrange(len(link_var_ids)):
+        yield link_var_ids[l], map(alleles.__getitem__, link_alleles[link_offsets[l]:link_offsets[l+1]])
+
+
 """
 Compare two variants
 """
@@ -216,23 +596,24 @@ def clone_hisatgenotype_database():
 
 """
 """
-def extract_database_if_not_exists(base,
-                                   locus_list,
-                                   inter_gap = 30,
-                                   intra_gap = 50,
-                                   partial = True,
-                                   verbose = False):
-    fnames = [base + "_backbone.fa",
-              base + "_sequences.fa",
-              base + ".locus",
-              base + ".snp",
-              base + ".index.snp",
-              base + ".haplotype",
-              base + ".link",
-              base + ".partial"]
-    if check_files(fnames):
-        return
+def get_database_fnames(base):
+    return [base + "_backbone.fa",
+            base + "_sequences.fa",
+            base + ".locus",
+            base + ".snp",
+            base + ".index.snp",
+            base + ".haplotype",
+            base + ".link",
+            base + ".partial"]
 
+
+"""
+"""
+def get_extract_database_cmd(base,
+                             locus_list,
+                             inter_gap,
+                             intra_gap,
+                             partial):
     extract_cmd = ["hisatgenotype_extract_vars.py"]
     extract_cmd += ["--base", base]
     if len(locus_list) > 0:
@@ -252,6 +633,26 @@ def extract_database_if_not_exists(base,
 
     # DK - debugging purposes
     # extract_cmd += ["--ext-seq", "300"]
+    return extract_cmd
+
+
+"""
+"""
+def extract_database_if_not_exists(base,
+                                   locus_list,
+                                   inter_gap = 30,
+                                   intra_gap = 50,
+                                   partial = True,
+                                   verbose = False):
+    fnames = get_database_fnames(base)
+    if check_files(fnames):
+        return
+
+    extract_cmd = get_extract_database_cmd(base,
+                                           locus_list,
+                                           inter_gap,
+                                           intra_gap,
+                                           partial)
     if verbose:
         print >> sys.stderr, "\tRunning:", ' '.join(extract_cmd)
     proc = subprocess.Popen(extract_cmd, stdout=open("/dev/null", 'w'), stderr=open("/dev/null", 'w'))
@@ -261,6 +662,48 @@ def extract_database_if_not_exists(base,
         print >> sys.stderr, "Error: hisatgenotype_extract_vars failed!"
         sys.exit(1)
 
+
+"""
+Extract databases (e.g. hla, codis, cyp) independently of one another,
+  running up to 'threads' hisatgenotype_extract_vars.py at a time.
+  The output of each extraction goes to <database>.extract.log.
+"""
+def extract_databases_if_not_exist(bases,
+                                   inter_gap = 30,
+                                   intra_gap = 50,
+                                   partial = True,
+                                   threads = 1,
+                                   verbose = False):
+    bases = [base for base in bases if not check_files(get_database_fnames(base))]
+    running = []
+    while len(bases) > 0 or len(running) > 0:
+        while len(bases) > 0 and len(running) < max(1, threads):
+            base = bases.pop(0)
+            extract_cmd = get_extract_database_cmd(base,
+                                                   [],    # locus_list
+                                                   inter_gap,
+                                                   intra_gap,
+                                                   partial)
+            if verbose:
+                print >> sys.stderr, "\tRunning:", ' '.join(extract_cmd)
+            log_fname = "%s.extract.log" % base
+            proc = subprocess.Popen(extract_cmd,
+                                    stdout=open(log_fname, 'w'),
+                                    stderr=subprocess.STDOUT)
+            running.append([base, proc, datetime.now()])
+
+        time.sleep(1)
+        for base, proc, start_time in running[:]:
+            if proc.poll() is None:
+                continue
+            running.remove([base, proc, start_time])
+            if not check_files(get_database_fnames(base)):
+                print >> sys.stderr, "Error: hisatgenotype_extract_vars failed for %s (see %s.extract.log)!" % (base, base)
+                for base2, proc2, _ in running:
+                    proc2.kill()
+                sys.exit(1)
+            print >> sys.stderr, "\t%s extracted in %s (log: %s.extract.log)" % (base, datetime.now() - start_time, base)
+
         
 """
 """
@@ -662,30 +1105,345 @@ def align_reads(aligner,
 
 
 """
-HISAT-genotype's mpileup
+Read the alignments of a region (output of samtools view) in one pass into a columnar batch,
+  a dictionary of columns (lists of strings, arrays of integers) indexed by alignment.
+  The optional fields are kept as they are (tags) in addition to NM, NH, MD, Zs, and YT,
+  where a missing NM or NH is sys.maxint and a missing MD, Zs, or YT is "".
+"""
+def read_alignment_batch(alignview_cmd):
+    batch = {"read_id" : [],
+             "flag"    : array('l'),
+             "chr"     : [],
+             "pos"     : array('l'),
+             "mapQ"    : array('l'),
+             "cigar"   : [],
+             "mate"    : [],
+             "seq"     : [],
+             "qual"    : [],
+             "tags"    : [],
+             "NM"      : array('l'),
+             "NH"      : array('l'),
+             "MD"      : [],
+             "Zs"      : [],
+             "YT"      : []}
+    read_ids, flags, chrs, poss, mapQs, cigars, mates, seqs, quals, tagss = \
+        [batch[col] for col in ["read_id", "flag", "chr", "pos", "mapQ", "cigar", "mate", "seq", "qual", "tags"]]
+    NMs, NHs, MDs, Zss, YTs = [batch[col] for col in ["NM", "NH", "MD", "Zs", "YT"]]
+
+    proc = subprocess.Popen(alignview_cmd,
+                            stdout=subprocess.PIPE,
+                            stderr=open("/dev/null", 'w'))
+    for line in proc.stdout:
+        cols = line.strip().split('\t')
+        read_ids.append(cols[0])
+        flags.append(int(cols[1]))
+        chrs.append(cols[2])
+        poss.append(int(cols[3]))
+        mapQs.append(int(cols[4]))
+        cigars.append(cols[5])
+        mates.append('\t'.join(cols[6:9]))
+        seqs.append(cols[9])
+        quals.append(cols[10])
+        tagss.append('\t'.join(cols[11:]))
+
+        NM, NH, MD, Zs, YT = sys.maxint, sys.maxint, "", "", ""
+        for col in cols[11:]:
+            tag = col[:2]
+            if tag == "NM":
+                NM = int(col[5:])
+            elif tag == "NH":
+                NH = int(col[5:])
+            elif tag == "MD":
+                MD = col[5:]
+            elif tag == "Zs":
+                Zs = col[5:]
+            elif tag == "YT":
+                YT = col[5:]
+        NMs.append(NM)
+        NHs.append(NH)
+        MDs.append(MD)
+        Zss.append(Zs)
+        YTs.append(YT)
+    proc.communicate()
+
+    return batch
+
+
+"""
+Alignment i of a batch as a line of SAM
+"""
+def get_alignment_line(batch, i):
+    line = "%s\t%d\t%s\t%d\t%d\t%s\t%s\t%s\t%s" % \
+        (batch["read_id"][i], batch["flag"][i], batch["chr"][i], batch["pos"][i], batch["mapQ"][i],
+         batch["cigar"][i], batch["mate"][i], batch["seq"][i], batch["qual"][i])
+    if batch["tags"][i] != "":
+        line += "\t" + batch["tags"][i]
+    return line
+
+
+"""
+Group the alignments of a batch (sorted by position) by read name, yielding the indexes
+  of the alignments of a read (pair) as soon as both mates are seen.
+  Reads whose mates are not seen yet are buffered only until the alignment
+  position passes their mate positions (or the chromosome changes).
+  The batch is already fully read (see read_alignment_batch), so this replaces sorting
+  the alignments by read name rather than streaming them; typing starts after a locus
+  is read as a whole, as it needs the mpileup of all its alignments anyway.
+"""
+def get_alignment_pairs(batch, simulation = False):
+    read_ids, flags, chrs, poss, mates, NHs = \
+        [batch[col] for col in ["read_id", "flag", "chr", "pos", "mate", "NH"]]
+    
+    # read name -> [position after which no more alignments are expected, order, alignment indexes, flags]
+    pending = {}
+    pending_heap = []
+    num_groups = 0
+    prev_chr = None
+    for aln_i in range(len(read_ids)):
+        read_id, flag, chr, pos = read_ids[aln_i], flags[aln_i], chrs[aln_i], poss[aln_i]
+        if chr != prev_chr:
+            for _, _, aln_idxs, _ in sorted(pending.values(), key = lambda group: group[1]):
+                yield aln_idxs
+            pending, pending_heap = {}, []
+            prev_chr = chr
+        else:
+            while len(pending_heap) > 0 and pending_heap[0][0] < pos:
+                ready_pos, order, name = heapq.heappop(pending_heap)
+                if name in pending and pending[name][:2] == [ready_pos, order]:
+                    yield pending[name][2]
+                    del pending[name]
+        
+        name = read_id.split('|')[0] if simulation else read_id
+        ready_pos = pos
+        if flag & 0x1 != 0 and flag & 0x8 == 0:
+            mate_chr, mate_pos = mates[aln_i].split('\t')[:2]
+            mate_pos = int(mate_pos)
+            if mate_chr in ["=", chr] and mate_pos > ready_pos:
+                ready_pos = mate_pos
+            
+        if name not in pending:
+            # Single-end reads
+            if flag & 0x1 == 0:
+                yield [aln_i]
+                continue
+            group = pending[name] = [ready_pos, num_groups, [], 0]
+            num_groups += 1
+            heapq.heappush(pending_heap, group[:2] + [name])
+        else:
+            group = pending[name]
+            if ready_pos > group[0]:
+                group[0] = ready_pos
+                heapq.heappush(pending_heap, group[:2] + [name])
+        group[2].append(aln_i)
+        if NHs[aln_i] == 1:
+            group[3] |= flag & 0xc0
+
+        # Both mates of a uniquely aligned pair
+        if group[3] == 0xc0:
+            yield group[2]
+            del pending[name]
+
+    for _, _, aln_idxs, _ in sorted(pending.values(), key = lambda group: group[1]):
+        yield aln_idxs
+
+
+"""
+Types of the edit operations decoded from CIGAR, MD, and Zs
 """
-def get_mpileup(alignview_cmd,
+EDIT_MATCH, EDIT_MISMATCH, EDIT_INSERTION, EDIT_DELETION, EDIT_SOFTCLIP, EDIT_INTRON = range(6)
+
+
+"""
+Decode CIGAR, MD, and Zs of the alignments of a batch into flat arrays of edit operations,
+  (op, ref_pos, read_pos, len, var_idx) where ref_pos is relative to base_locus,
+  and the operations of alignment i are from edit_offset[i] to edit_offset[i+1].
+  Matches and mismatches are split from M using MD, and var_idx is the index (in var_ids)
+  of a variant that Zs reports for a mismatch, insertion, or deletion (-1 if none).
+  Variants not in var_ids yet are added to var_ids and var_index.
+"""
+def decode_alignment_edits(batch,
+                           base_locus,
+                           var_ids,
+                           var_index):
+    flags, poss, cigar_strs, MDs, Zss = \
+        [batch[col] for col in ["flag", "pos", "cigar", "MD", "Zs"]]
+    edit_offset = array('l', [0])
+    edit_op, edit_ref_pos, edit_read_pos, edit_len, edit_var_idx = \
+        array('b'), array('l'), array('l'), array('l'), array('l')
+    cigar_ops = {'M' : EDIT_MATCH, 'I' : EDIT_INSERTION, 'D' : EDIT_DELETION, 'S' : EDIT_SOFTCLIP, 'N' : EDIT_INTRON}
+    cigar_re = re.compile('(\d+)(\w)')
+    MD_re = re.compile('(\d+)|(\^[ACGT]*)|([A-Z])')
+
+    def get_var_idx(var_id):
+        if var_id not in var_index:
+            var_index[var_id] = len(var_ids)
+            var_ids.append(var_id)
+        return var_index[var_id]
+
+    for aln_i in range(len(flags)):
+        MD = MDs[aln_i]
+        if flags[aln_i] & 0x4 != 0 or MD == "":
+            edit_offset.append(len(edit_op))
+            continue
+
+        # Zs as [read position, type, variant index]
+        Zs = []
+        if Zss[aln_i] != "":
+            for Zs_item in Zss[aln_i].split(','):
+                Zs_item = Zs_item.split('|')
+                Zs.append([int(Zs_item[0]), Zs_item[1], get_var_idx(Zs_item[2])])
+        Zs_pos, Zs_i = 0, 0
+        if Zs_i < len(Zs):
+            Zs_pos += Zs[Zs_i][0]
+
+        MD_items = MD_re.findall(MD)
+        MD_i, MD_num = 0, 0
+        cigars = cigar_re.findall(cigar_strs[aln_i])
+        ref_pos, read_pos = poss[aln_i] - (base_locus + 1), 0
+        for i in range(len(cigars)):
+            length, cigar_op = int(cigars[i][0]), cigar_ops[cigars[i][1]]
+            if cigar_op == EDIT_MATCH:
+                used = 0
+                while used < length:
+                    if MD_num == 0 and MD_i < len(MD_items) and MD_items[MD_i][0] != "":
+                        MD_num = int(MD_items[MD_i][0])
+                        MD_i += 1
+                        continue
+                    if MD_num > 0:
+                        num = min(MD_num, length - used)
+                        edit_op.append(EDIT_MATCH)
+                        edit_ref_pos.append(ref_pos + used)
+                        edit_read_pos.append(read_pos + used)
+                        edit_len.append(num)
+                        edit_var_idx.append(-1)
+                        MD_num -= num
+                        used += num
+                        continue
+
+                    assert MD_items[MD_i][2] in "ACGT"
+                    MD_i += 1
+                    var_idx = -1
+                    if read_pos + used == Zs_pos and Zs_i < len(Zs):
+                        assert Zs[Zs_i][1] == 'S'
+                        var_idx = Zs[Zs_i][2]
+                        Zs_i += 1
+                        Zs_pos += 1
+                        if Zs_i < len(Zs):
+                            Zs_pos += Zs[Zs_i][0]
+                    edit_op.append(EDIT_MISMATCH)
+                    edit_ref_pos.append(ref_pos + used)
+                    edit_read_pos.append(read_pos + used)
+                    edit_len.append(1)
+                    edit_var_idx.append(var_idx)
+                    used += 1
+            else:
+                var_idx = -1
+                if cigar_op == EDIT_INSERTION:
+                    if read_pos == Zs_pos and Zs_i < len(Zs):
+                        assert Zs[Zs_i][1] == 'I'
+                        var_idx = Zs[Zs_i][2]
+                        Zs_i += 1
+                        if Zs_i < len(Zs):
+                            Zs_pos += Zs[Zs_i][0]
+                elif cigar_op == EDIT_DELETION:
+                    if MD_num == 0 and MD_i < len(MD_items) and MD_items[MD_i][0] == "0":
+                        MD_i += 1
+                    assert MD_num == 0 and MD_items[MD_i][1] != ""
+                    MD_i += 1
+                    if read_pos == Zs_pos and \
+                       Zs_i < len(Zs) and \
+                       Zs[Zs_i][1] == 'D':
+                        var_idx = Zs[Zs_i][2]
+                        Zs_i += 1
+                        if Zs_i < len(Zs):
+                            Zs_pos += Zs[Zs_i][0]
+                elif cigar_op == EDIT_SOFTCLIP:
+                    if i == 0:
+                        Zs_pos += length
+                    else:
+                        assert i + 1 == len(cigars)
+                edit_op.append(cigar_op)
+                edit_ref_pos.append(ref_pos)
+                edit_read_pos.append(read_pos)
+                edit_len.append(length)
+                edit_var_idx.append(var_idx)
+
+            if cigar_op in [EDIT_MATCH, EDIT_INTRON, EDIT_DELETION]:
+                ref_pos += length
+            if cigar_op in [EDIT_MATCH, EDIT_INSERTION, EDIT_SOFTCLIP]:
+                read_pos += length
+
+        edit_offset.append(len(edit_op))
+
+    batch["edit_offset"] = edit_offset
+    batch["edit_op"] = edit_op
+    batch["edit_ref_pos"] = edit_ref_pos
+    batch["edit_read_pos"] = edit_read_pos
+    batch["edit_len"] = edit_len
+    batch["edit_var_idx"] = edit_var_idx
+
+
+"""
+HISAT-genotype's mpileup, where the counts of A, C, G, T, D (deletion), and N (and other bases)
+  at each position are kept in an array of integers, and nt_sets are the representative bases
+"""
+class Mpileup:
+    nts = "ACGTDN"
+    nt_codes = [5] * 256
+    for nt_i in range(len(nts)):
+        nt_codes[ord(nts[nt_i])] = nt_i
+    
+    # Initialize
+    def __init__(self, length):
+        self.length = length
+        self.counts = array('l', [0]) * (length * len(self.nts))
+        self.nt_sets = [""] * length
+
+        # (position, base) -> variant id (e.g. (100, 'A') -> "hv10", (120, 'D') -> "hv12")
+        self.var_ids = {}
+
+    def __len__(self):
+        return self.length
+
+    # Count of a base (A, C, G, T, D, or N) at a position
+    def get_count(self, pos, nt):
+        return self.counts[pos * len(self.nts) + self.nts.index(nt)]
+
+    # Number of bases (including deletions) at a position
+    def get_depth(self, pos):
+        nt_len = len(self.nts)
+        return sum(self.counts[pos * nt_len:(pos + 1) * nt_len])
+
+    # Dictionary of bases at a position, base -> [count, variant id]
+    def get_nt_dic(self, pos):
+        nt_dic = {}
+        nt_len = len(self.nts)
+        for nt_i in range(nt_len):
+            count = self.counts[pos * nt_len + nt_i]
+            if count > 0:
+                nt = self.nts[nt_i]
+                nt_dic[nt] = [count, self.var_ids.get((pos, nt), "")]
+        return nt_dic
+
+
+"""
+Mpileup of a batch of alignments
+"""
+def get_mpileup(alignments,
                 ref_seq,
                 base_locus,
                 vars,
                 allow_discordant):
     ref_seq_len = len(ref_seq)
-    mpileup = []
-    for i in range(ref_seq_len):
-        mpileup.append([[], {}])
+    mpileup = Mpileup(ref_seq_len)
+    counts, nt_codes, nt_len = mpileup.counts, Mpileup.nt_codes, len(Mpileup.nts)
+    D_code = Mpileup.nts.index('D')
         
-    proc = subprocess.Popen(alignview_cmd,
-                            stdout=subprocess.PIPE,
-                            stderr=open("/dev/null", 'w'))
-
-    prev_pos = -1
-    cigar_re = re.compile('\d+\w')
-    for line in proc.stdout:
-        line = line.strip()
-        cols = line.split()
-        read_id, flag, _, pos, _, cigar_str = cols[:6]
-        read_seq = cols[9]
-        flag, pos = int(flag), int(pos)
+    cigar_re = re.compile('(\\d+)(\\w)')
+    flags, poss, cigar_strs, read_seqs = \
+        alignments["flag"], alignments["pos"], alignments["cigar"], alignments["seq"]
+    for aln_i in range(len(flags)):
+        flag, pos = flags[aln_i], poss[aln_i]
         # Unalined?
         if flag & 0x4 != 0:
             continue
@@ -702,23 +1460,18 @@ def get_mpileup(alignview_cmd,
         if not allow_discordant and not concordant:
             continue
 
-        read_pos, left_pos = 0, pos
-        right_pos = left_pos
-        cigars = cigar_re.findall(cigar_str)
-        cigars = [[cigar[-1], int(cigar[:-1])] for cigar in cigars]
-        for i in range(len(cigars)):
-            cigar_op, length = cigars[i]
+        read_seq = read_seqs[aln_i]
+        read_pos, right_pos = 0, pos
+        for length, cigar_op in cigar_re.findall(cigar_strs[aln_i]):
+            length = int(length)
             if cigar_op in "MD":
-                for j in range(length):
-                    if cigar_op == 'M':
-                        read_nt = read_seq[read_pos + j]
-                    else:
-                        read_nt = 'D'
-                    if right_pos + j < len(mpileup):
-                        if read_nt not in mpileup[right_pos + j][1]:
-                            mpileup[right_pos + j][1][read_nt] = 1
-                        else:
-                            mpileup[right_pos + j][1][read_nt] += 1
+                length_ = min(length, ref_seq_len - right_pos)
+                if cigar_op == 'M':
+                    for j in range(length_):
+                        counts[(right_pos + j) * nt_len + nt_codes[ord(read_seq[read_pos + j])]] += 1
+                else:
+                    for j in range(length_):
+                        counts[(right_pos + j) * nt_len + D_code] += 1
 
             if cigar_op in "MND":
                 right_pos += length
@@ -726,48 +1479,46 @@ def get_mpileup(alignview_cmd,
             if cigar_op in "MIS":
                 read_pos += length
 
-    # Choose representative bases or 'D'
-    for i in range(len(mpileup)):
-        nt_dic = mpileup[i][1]
-        num_nt = sum(nt_dic.values())
-        nt_set = []
-        if num_nt >= 20:
-            for nt, count in nt_dic.items():
-                if nt not in "ACGT":
-                    continue
-                if count >= num_nt * 0.2 or count >= 7:
-                    nt_set.append(nt)
-        mpileup[i][0] = nt_set
+    # Choose representative bases (A, C, G, or T) at positions with enough coverage
+    for i in range(ref_seq_len):
+        nt_counts = counts[i * nt_len:(i + 1) * nt_len]
+        num_nt = sum(nt_counts)
+        if num_nt < 20:
+            continue
+        mpileup.nt_sets[i] = ''.join([nt for nt, count in zip("ACGT", nt_counts) if count >= num_nt * 0.2 or count >= 7])
 
-    # Sort variants
-    var_list = [[] for i in range(len(mpileup))]
+    # Index known variants by position
+    single_vars, del_var_list = {}, {}
     for var_id, value in vars.items():
         var_type, var_pos, var_data = value
-        assert var_pos < len(var_list)
-        var_list[var_pos].append([var_id, var_type, var_data])
-
-    # Assign known or unknown variants
+        assert var_pos < ref_seq_len
+        if var_type == "single":
+            if (var_pos, var_data) not in single_vars:
+                single_vars[(var_pos, var_data)] = var_id
+        elif var_type == "deletion":
+            if var_pos not in del_var_list:
+                del_var_list[var_pos] = []
+            del_var_list[var_pos].append([var_id, int(var_data)])
+
+    # Assign known variants
     skip_i, prev_del_var_id = -1, ""
-    for i in range(len(mpileup)):
-        nt_dic = mpileup[i][1]
+    for i in range(ref_seq_len):
         ref_nt = ref_seq[i]
-        new_nt_dic = {}
-        for nt, count in nt_dic.items():
+        for nt_i in range(nt_len):
+            if counts[i * nt_len + nt_i] == 0:
+                continue
+            nt = Mpileup.nts[nt_i]
             var_id = ""
             if nt == 'D':
                 if i <= skip_i:
                     assert prev_del_var_id != ""
                     var_id = prev_del_var_id
                 else:
-                    for var_id_, var_type, var_data in var_list[i]:
-                        if var_type != "deletion":
-                            continue
-                        del_len = int(var_data)
+                    for var_id_, del_len in del_var_list.get(i, []):
                         del_exist = True
                         for j in range(i + 1, i + del_len):
-                            assert j < len(mpileup)
-                            nt_dic2 = mpileup[j][1]
-                            if 'D' not in nt_dic2:
+                            assert j < ref_seq_len
+                            if counts[j * nt_len + D_code] == 0:
                                 del_exist = False
                                 break
                         if del_exist:
@@ -776,45 +1527,25 @@ def get_mpileup(alignview_cmd,
                             skip_i = i + del_len - 1
                             break                                                
             elif nt != 'N' and nt != ref_nt:
-                assert nt in "ACGT"
-                id = "unknown"
-                for var_id_, var_type, var_data in var_list[i]:
-                    if var_type != "single":
-                        continue
-                    if nt == var_data:
-                        var_id = var_id_
-                        break
-            new_nt_dic[nt] = [count, var_id]
-                        
-        mpileup[i][1] = new_nt_dic
+                var_id = single_vars.get((i, nt), "")
+            if var_id != "":
+                mpileup.var_ids[(i, nt)] = var_id
 
     return mpileup
 
 
 """
 """
-def get_pair_interdist(alignview_cmd,
+def get_pair_interdist(alignments,
                        simulation,
                        verbose):
-    bamview_proc = subprocess.Popen(alignview_cmd,
-                                    stdout=subprocess.PIPE,
-                                    stderr=open("/dev/null", 'w'))
-    sort_read_cmd = ["sort", "-k", "1,1", "-s"] # -s for stable sorting
-    alignview_proc = subprocess.Popen(sort_read_cmd,
-                                      stdin=bamview_proc.stdout,
-                                      stdout=subprocess.PIPE,
-                                      stderr=open("/dev/null", 'w'))
-
     dist_list = []
     prev_read_id = None
     cigar_re = re.compile('\d+\w')
     reads = []
-    for line in alignview_proc.stdout:
-        line = line.strip()
-        cols = line.split()
-        read_id, flag, _, pos, _, cigar_str = cols[:6]
-        read_seq = cols[9]
-        flag, pos = int(flag), int(pos)
+    for aln_i in itertools.chain.from_iterable(get_alignment_pairs(alignments, simulation)):
+        read_id, flag, pos, cigar_str = \
+            alignments["read_id"][aln_i], alignments["flag"][aln_i], alignments["pos"][aln_i], alignments["cigar"][aln_i]
         # Unalined?
         if flag & 0x4 != 0:
             continue
@@ -828,13 +1559,7 @@ def get_pair_interdist(alignview_cmd,
         else:
             concordant = False
 
-        NH, YT = sys.maxint, ""
-        for i in range(11, len(cols)):
-             col = cols[i]
-             if col.startswith("NH"):
-                 NH = int(col[5:])
-             elif col.startswith("YT"):
-                 YT = col[5:]
+        NH, YT = alignments["NH"][aln_i], alignments["YT"][aln_i]
         if NH > 1 or YT != "CP":
             continue
 
@@ -871,6 +1596,246 @@ def get_pair_interdist(alignview_cmd,
     return dist_median
 
 
+##################################################
+#   Allele bitsets
+##################################################
+
+
+"""
+Make a bitset (a long integer) of alleles, where bit i is for the allele whose index is i
+"""
+def get_allele_bits(alleles, allele_index):
+    bits = bytearray((len(allele_index) + 7) / 8)
+    for allele in alleles:
+        if allele not in allele_index:
+            continue
+        i = allele_index[allele]
+        bits[i >> 3] |= (1 << (i & 7))
+    if len(bits) == 0:
+        return 0
+    bits.reverse()
+    return int(binascii.hexlify(bits), 16)
+
+
+"""
+Indexes of the set bits of a bitset in increasing order
+"""
+def get_bit_indexes(bits):
+    bit_str = bin(bits)[:1:-1]
+    indexes = []
+    i = bit_str.find('1')
+    while i >= 0:
+        indexes.append(i)
+        i = bit_str.find('1', i + 1)
+    return indexes
+
+
+"""
+Add one to the counts of the alleles in a bitset
+  A counter is a list of bit planes, where plane p has bit p of every allele's count.
+"""
+def add_bit_counter(counter, bits):
+    p = 0
+    while bits and p < len(counter):
+        counter[p], bits = counter[p] ^ bits, counter[p] & bits
+        p += 1
+    if bits:
+        counter.append(bits)
+
+
+"""
+Bitset of the alleles (among all_bits) with the highest count in a counter
+"""
+def get_max_bit_counter(counter, all_bits):
+    max_bits = all_bits
+    for plane in reversed(counter):
+        if max_bits & plane:
+            max_bits &= plane
+    return max_bits
+
+
+"""
+Count of the allele at index i in a counter
+"""
+def get_bit_counter_value(counter, i):
+    count = 0
+    for p in range(len(counter)):
+        count |= ((counter[p] >> i) & 1) << p
+    return count
+
+
+"""
+Bounded cache that drops the least recently used entry when full
+"""
+class LRUCache:
+    # Initialize
+    def __init__(self, max_size):
+        assert max_size > 0
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    # Value of key (None if not cached), which becomes the most recently used
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value != None:
+            self.entries[key] = value
+        return value
+
+    # Cache value of key
+    def put(self, key, value):
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.max_size:
+            self.entries.popitem(last = False)
+        self.entries[key] = value
+
+
+##################################################
+#   Allele sequences
+##################################################
+
+
+"""
+Allele sequences of a gene, kept as a backbone sequence and the variants of each allele
+  (indexes into var_ids), where allele sequences are made on demand and the recently used ones are cached.
+  It can be used in place of a dictionary of allele sequences, e.g. Genes["A"]["A*01:01:01:01"]
+"""
+class AlleleSeqs:
+    # Initialize
+    def __init__(self,
+                 backbone_name,
+                 backbone_seq,
+                 Vars,
+                 cache_size = 32):
+        self.backbone_name = backbone_name
+        self.backbone_seq = backbone_seq
+        self.Vars = Vars
+        self.var_ids, self.var_index = [], {}
+        self.allele_vars = {backbone_name : array('l')}
+        self.allele_lengths = {backbone_name : len(backbone_seq)}
+        self.seq_cache = LRUCache(cache_size)
+
+    # Add an allele with its variants (sorted by position)
+    def add_allele(self, allele_name, var_ids):
+        var_idxs = array('l')
+        length, prev_pos = 0, 0
+        for var_id in var_ids:
+            if var_id not in self.var_index:
+                self.var_index[var_id] = len(self.var_ids)
+                self.var_ids.append(var_id)
+            var_idxs.append(self.var_index[var_id])
+            type, pos, data = self.Vars[var_id]
+            assert prev_pos <= pos
+            length += (pos - prev_pos)
+            if type == "single":
+                prev_pos = pos + 1
+                length += 1
+            elif type == "deletion":
+                prev_pos = pos + int(data)
+            else:
+                assert type == "insertion"
+                length += len(data)
+                prev_pos = pos
+        if prev_pos < len(self.backbone_seq):
+            length += (len(self.backbone_seq) - prev_pos)
+        self.allele_vars[allele_name] = var_idxs
+        self.allele_lengths[allele_name] = length
+
+    # Make the sequence of an allele from the backbone sequence
+    def get_seq(self, allele_name):
+        seq = []
+        prev_pos = 0
+        for var_idx in self.allele_vars[allele_name]:
+            type, pos, data = self.Vars[self.var_ids[var_idx]]
+            if pos > prev_pos:
+                seq.append(self.backbone_seq[prev_pos:pos])
+            if type == "single":
+                prev_pos = pos + 1
+                seq.append(data)
+            elif type == "deletion":
+                prev_pos = pos + int(data)
+            else:
+                seq.append(data)
+                prev_pos = pos
+        if prev_pos < len(self.backbone_seq):
+            seq.append(self.backbone_seq[prev_pos:])
+        return ''.join(seq)
+
+    def get_length(self, allele_name):
+        return self.allele_lengths[allele_name]
+
+    def __getitem__(self, allele_name):
+        if allele_name == self.backbone_name:
+            return self.backbone_seq
+        seq = self.seq_cache.get(allele_name)
+        if seq == None:
+            seq = self.get_seq(allele_name)
+            self.seq_cache.put(allele_name, seq)
+        return seq
+
+    def __contains__(self, allele_name):
+        return allele_name in self.allele_vars
+
+    def __len__(self):
+        return len(self.allele_vars)
+
+    def __iter__(self):
+        return iter(self.allele_vars)
+
+    def keys(self):
+        return self.allele_vars.keys()
+
+    def items(self):
+        return [(allele_name, self[allele_name]) for allele_name in self.allele_vars]
+
+
+##################################################
+#   Variants
+##################################################
+
+
+"""
+Variants of a gene, where novel variants (e.g. nv0, nv1) are layered on top of the loaded variants
+  (e.g. Vars["A"]), which are shared and left unchanged.
+  It can be used in place of a dictionary of variants, e.g. Vars["A"]["hv326"] = ["single", 604, "C"]
+"""
+class VarOverlay:
+    # Initialize
+    def __init__(self,
+                 Vars,
+                 novel_prefix = "nv"):
+        self.Vars = Vars
+        self.novel_prefix = novel_prefix
+        self.novel_vars = {}
+
+    # Add a novel variant, and return its id
+    def add_novel_var(self, var_type, var_pos, var_data):
+        var_id = "%s%d" % (self.novel_prefix, len(self.novel_vars))
+        assert var_id not in self.Vars
+        self.novel_vars[var_id] = [var_type, var_pos, var_data]
+        return var_id
+
+    def __getitem__(self, var_id):
+        if var_id in self.novel_vars:
+            return self.novel_vars[var_id]
+        return self.Vars[var_id]
+
+    def __contains__(self, var_id):
+        return var_id in self.novel_vars or var_id in self.Vars
+
+    def __len__(self):
+        return len(self.Vars) + len(self.novel_vars)
+
+    def __iter__(self):
+        return itertools.chain(self.Vars, self.novel_vars)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return self.Vars.items() + self.novel_vars.items()
+
+
 ##################################################
 #   Statistical routines
 ##################################################